@@ -0,0 +1,122 @@
+"""
+Bulk load of accounts with their currencies and opening balances from CSV (`id,currency,balance` header) or
+NDJSON files (one `{"id": ..., "currency": ..., "balance": ...}` object per line).
+Rows are loaded in chunks, each one in its own transaction: through a `COPY` into a staging table on PostgreSQL,
+with `bulk_create` elsewhere. Accounts which exist already are left as they are, so a chunk may be loaded twice.
+"""
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Optional, Set
+
+from django.db import connection, transaction
+
+from .models import Account, Currency, CENT
+
+__all__ = ('AccountRow', 'InvalidRowError', 'read_rows', 'chunks', 'load_currencies', 'load_accounts')
+
+MAX_BALANCE = Decimal(10) ** (Account._meta.get_field('balance').max_digits - 2)
+STAGING_TABLE = 'core_account_import'
+
+
+class InvalidRowError(ValueError):
+    pass
+
+
+class AccountRow:
+    __slots__ = ('id', 'currency_id', 'balance')
+
+    def __init__(self, id: str, currency_id: str, balance: Decimal) -> None:
+        self.id = id
+        self.currency_id = currency_id
+        self.balance = balance
+
+    @classmethod
+    def parse(cls, record: dict, line: int) -> 'AccountRow':
+        account_id, currency_id = str(record.get('id') or '').strip(), str(record.get('currency') or '').strip()
+        if not account_id:
+            raise InvalidRowError(f'line {line}: id is missing')
+        if not currency_id or len(currency_id) > Currency._meta.get_field('code').max_length:
+            raise InvalidRowError(f'line {line}: invalid currency {currency_id!r}')
+        try:
+            # JSON numbers come as strings, floats would round the balance
+            balance = Decimal(str(record.get('balance') or 0).strip())
+        except InvalidOperation:
+            raise InvalidRowError(f'line {line}: invalid balance {record.get("balance")!r}')
+        if not balance.is_finite() or balance < 0 or balance >= MAX_BALANCE or balance != balance.quantize(CENT):
+            raise InvalidRowError(f'line {line}: invalid balance {record.get("balance")!r}')
+        return cls(account_id, currency_id, balance)
+
+
+def read_rows(path: Path) -> Iterator[AccountRow]:
+    """ Parsed rows of a `.csv` file, or of an NDJSON one otherwise """
+    with path.open(newline='') as f:
+        if path.suffix.lower() == '.csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield AccountRow.parse(record, reader.line_num)
+            return
+
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text, parse_float=str, parse_int=str)
+            except ValueError as e:
+                raise InvalidRowError(f'line {line}: {e}')
+            if not isinstance(record, dict):
+                raise InvalidRowError(f'line {line}: not an object')
+            yield AccountRow.parse(record, line)
+
+
+def chunks(rows: Iterator[AccountRow], size: int) -> Iterator[List[AccountRow]]:
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_currencies(codes: Set[str], create: bool = True) -> Set[str]:
+    """
+    Makes sure all the `codes` exist with a single query for the ones missing from `Currency.codes()`, then
+    creates them with a single insert if `create` is set. Returns the codes which are still missing.
+    """
+    missing = codes - Currency.codes()
+    if missing:
+        # the cached codes may be behind the ones other processes created
+        missing -= set(Currency.objects.filter(code__in=missing).values_list('code', flat=True))
+    if missing and create:
+        Currency.objects.bulk_create((Currency(code=code) for code in missing), ignore_conflicts=True)
+        # bulk inserts send no `post_save`
+        for code in missing:
+            Currency(code=code).refresh_cache()
+        missing = set()
+    return missing
+
+
+def load_accounts(rows: List[AccountRow]) -> Optional[int]:
+    """
+    Inserts the accounts of `rows` which don't exist yet in a single transaction.
+    Returns the number of accounts inserted, None if the backend can't tell.
+    """
+    with transaction.atomic():
+        if connection.vendor != 'postgresql':
+            Account.objects.bulk_create((Account(id=row.id, currency_id=row.currency_id, balance=row.balance)
+                                         for row in rows), batch_size=5000, ignore_conflicts=True)
+            return None
+
+        data = io.StringIO()
+        csv.writer(data).writerows((row.id, row.currency_id, row.balance) for row in rows)
+        data.seek(0)
+        with connection.cursor() as cursor:
+            # COPY can't skip the existing accounts, the staging table is merged into the accounts with ON CONFLICT
+            cursor.execute(f'CREATE TEMPORARY TABLE {STAGING_TABLE} (id text, currency_id text, balance numeric) '
+                           f'ON COMMIT DROP')
+            cursor.copy_expert(f'COPY {STAGING_TABLE} (id, currency_id, balance) FROM STDIN WITH (FORMAT csv)', data)
+            cursor.execute(f'INSERT INTO {Account._meta.db_table} (id, currency_id, balance, shard_count) '
+                           f'SELECT id, currency_id, balance, 0 FROM {STAGING_TABLE} ON CONFLICT (id) DO NOTHING')
+            return cursor.rowcount
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        # connects the receivers keeping the account and currency caches up to date
+        from . import signals  # noqa: F401
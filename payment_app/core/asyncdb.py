@@ -0,0 +1,82 @@
+"""
+Native asyncio access to PostgreSQL for the async endpoints. Coroutines waiting for a connection or for row locks
+don't hold a thread, so a single process can keep thousands of transfers in flight. The pool size bounds the number
+of DB sessions instead of the threads.
+"""
+import asyncio
+import functools
+from typing import Optional, Callable, Awaitable, TypeVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+__all__ = ('is_available', 'get_pool', 'close_pool', 'is_lock_conflict', 'in_worker_thread')
+
+T = TypeVar('T')
+
+# PostgreSQL error codes of lock conflicts, same as `core.models` retries on
+LOCK_CONFLICT_CODES = ('40001', '40P01', '55P03')
+
+_pool = None
+_pool_lock: Optional[asyncio.Lock] = None
+
+
+def is_available() -> bool:
+    """ Whether the native path can be used: asyncpg is installed and the database is PostgreSQL """
+    return asyncpg is not None and 'postgresql' in settings.DATABASES['default']['ENGINE']
+
+
+async def get_pool() -> 'asyncpg.pool.Pool':
+    """ Connection pool of the running event loop, created on first use from the `default` database settings """
+    global _pool, _pool_lock
+    if _pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                db = settings.DATABASES['default']
+                _pool = await asyncpg.create_pool(
+                    host=db.get('HOST') or None,
+                    port=db.get('PORT') or None,
+                    user=db.get('USER') or None,
+                    password=db.get('PASSWORD') or None,
+                    database=db.get('NAME') or None,
+                    min_size=settings.ASYNC_DB_POOL_MIN_SIZE,
+                    max_size=settings.ASYNC_DB_POOL_MAX_SIZE,
+                )
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+def is_lock_conflict(error: Exception) -> bool:
+    """ Async counterpart of `core.models.is_lock_conflict` for asyncpg errors """
+    return getattr(error, 'sqlstate', None) in LOCK_CONFLICT_CODES
+
+
+def in_worker_thread(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """
+    `func` as a coroutine run in a worker thread, so ORM work doesn't wait for the other requests on a single thread.
+    Worker threads see no request signals, so their Django connections are closed here the way a request closes
+    them: before and after the call if they are broken or older than `CONN_MAX_AGE`.
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs) -> T:
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run, thread_sensitive=False)
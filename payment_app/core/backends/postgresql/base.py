@@ -0,0 +1,90 @@
+"""
+PostgreSQL backend for persistent connections (`CONN_MAX_AGE`): a reused connection is health checked before
+its first use in a request, and the hot statements run as server-side prepared statements, so they are parsed
+and planned once per connection instead of on every request.
+"""
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.base import Database
+
+from .statements import PreparedStatements, is_preparable, to_server_placeholders
+
+__all__ = ('DatabaseWrapper',)
+
+# PostgreSQL error code of a missing prepared statement
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = True
+        self.prepared_statements = PreparedStatements(settings.DB_PREPARE_THRESHOLD,
+                                                      settings.DB_PREPARED_STATEMENTS_MAX)
+        if settings.DB_PREPARE_THRESHOLD > 0:
+            self.execute_wrappers.append(self._execute_prepared)
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # prepared statements live as long as the session which prepared them
+        self.prepared_statements.clear()
+        self.health_check_done = True
+        return connection
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # called when a request starts and ends, the kept connection is checked once it is used again
+        if self.connection is not None:
+            self.health_check_done = False
+
+    def ensure_connection(self):
+        if (self.connection is not None and not self.health_check_done and not self.in_atomic_block
+                and settings.DB_CONN_HEALTH_CHECKS):
+            self.health_check_done = True
+            if not self.is_usable():
+                self.close()
+        super().ensure_connection()
+
+    def _execute_prepared(self, execute, sql, params, many, context):
+        # server-side cursors (`QuerySet.iterator`) run a single `DECLARE` of their statement, which can't `EXECUTE`
+        if (many or not isinstance(params, (list, tuple)) or not is_preparable(sql)
+                or context['cursor'].cursor.name is not None):
+            return execute(sql, params, many, context)
+
+        name = self.prepared_statements.get(sql)
+        if name is None and self.prepared_statements.hit(sql):
+            name = self._prepare(sql)
+        if name is None:
+            return execute(sql, params, many, context)
+
+        arguments = f' ({", ".join(["%s"] * len(params))})' if params else ''
+        try:
+            return execute(f'EXECUTE {name}{arguments}', params, many, context)
+        except DatabaseError as e:
+            if getattr(e.__cause__, 'pgcode', None) == INVALID_SQL_STATEMENT_NAME:
+                # the session lost them behind our back (e.g. `DISCARD ALL`), they are prepared again when needed
+                self.prepared_statements.clear()
+            raise
+
+    def _prepare(self, sql: str):
+        """ Prepares the statement with a raw psycopg2 cursor of its own, returns its name or None if it can't be """
+        name, evicted = self.prepared_statements.add(sql)
+        # a failed PREPARE must not abort the transaction the statement runs in
+        in_transaction = not self.connection.autocommit
+        with self.connection.cursor() as cursor:
+            try:
+                if in_transaction:
+                    cursor.execute('SAVEPOINT prepare_statement')
+                if evicted is not None:
+                    cursor.execute(f'DEALLOCATE {evicted}')
+                cursor.execute(f'PREPARE {name} AS {to_server_placeholders(sql)}')
+                if in_transaction:
+                    cursor.execute('RELEASE SAVEPOINT prepare_statement')
+            except Database.Error:
+                if in_transaction:
+                    cursor.execute('ROLLBACK TO SAVEPOINT prepare_statement')
+                self.prepared_statements.discard(sql)
+                return None
+        return name
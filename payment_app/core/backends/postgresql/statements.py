@@ -0,0 +1,75 @@
+import re
+from collections import OrderedDict
+from itertools import count
+from typing import Optional, Tuple
+
+__all__ = ('PreparedStatements', 'is_preparable', 'to_server_placeholders')
+
+_PREPARABLE = ('select', 'insert', 'update', 'delete', 'with')
+_PLACEHOLDER = re.compile(r'%[s%]')
+
+
+def is_preparable(sql: str) -> bool:
+    """ Only plain DML can be prepared, DDL, savepoints and the like are run as is """
+    return sql.lstrip()[:6].lower().startswith(_PREPARABLE) and '%(' not in sql
+
+
+def to_server_placeholders(sql: str) -> str:
+    """ Turns the client side `%s` placeholders of psycopg2 into the `$1, $2, ...` ones of `PREPARE` """
+    numbers = count(1)
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f'${next(numbers)}', sql)
+
+
+class PreparedStatements:
+    """
+    Server-side prepared statements of a single DB connection. A statement gets prepared once it has been run
+    `threshold` times, so only the hot ones are. No more than `maxsize` are kept, least recently used are evicted.
+    """
+
+    def __init__(self, threshold: int, maxsize: int) -> None:
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._names = OrderedDict()
+        # executions of the statements which aren't prepared yet, None if they can't be
+        self._counts = OrderedDict()
+        self._ids = count(1)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def get(self, sql: str) -> Optional[str]:
+        """ Name of the prepared statement """
+        name = self._names.get(sql)
+        if name is not None:
+            self._names.move_to_end(sql)
+        return name
+
+    def hit(self, sql: str) -> bool:
+        """ Counts an execution of a statement which isn't prepared, whether it should be prepared now """
+        executions = self._counts.pop(sql, 0)
+        if executions is None:
+            self._counts[sql] = None
+            return False
+        self._counts[sql] = executions + 1
+        if len(self._counts) > self.maxsize * 10:
+            self._counts.popitem(last=False)
+        return executions + 1 >= self.threshold
+
+    def add(self, sql: str) -> Tuple[str, Optional[str]]:
+        """ Registers a statement, returns its name and the name of the evicted one to deallocate """
+        self._counts.pop(sql, None)
+        name = f'payments_stmt_{next(self._ids)}'
+        self._names[sql] = name
+        evicted = None
+        if len(self._names) > self.maxsize:
+            _, evicted = self._names.popitem(last=False)
+        return name, evicted
+
+    def discard(self, sql: str) -> None:
+        """ Forgets a statement and never tries to prepare it again """
+        self._names.pop(sql, None)
+        self._counts[sql] = None
+
+    def clear(self) -> None:
+        self._names.clear()
+        self._counts.clear()
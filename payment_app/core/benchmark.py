@@ -0,0 +1,169 @@
+"""
+Helpers shared by the `bench_*` management commands.
+
+Benchmarks run against a throwaway database created the same way `manage.py test` creates its one,
+so they never touch the data of the configured database.
+"""
+import random
+import statistics
+import threading
+import time
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import List, Callable, Iterator, Dict
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, close_old_connections
+from django.db.models import Sum
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .metrics import collect_timings
+from .models import Currency, Account, AccountSummary, Transaction, Payment
+
+__all__ = ('scratch_database', 'seed', 'pick_account', 'measure', 'percentile', 'total_balance', 'drive_transfers',
+           'RequestSample', 'summarize')
+
+# single request made by `drive_transfers`, durations are in seconds
+RequestSample = namedtuple('RequestSample', ('status', 'latency', 'statements', 'lock_wait'))
+
+
+@contextmanager
+def scratch_database(verbosity: int = 0) -> Iterator[None]:
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def pick_account(account_ids: List[str], rng: random.Random, hot_accounts: int = 0, hot_share: float = 0) -> str:
+    """ Random account where `hot_share` of the picks fall on the first `hot_accounts` accounts """
+    if hot_accounts and rng.random() < hot_share:
+        return account_ids[rng.randrange(hot_accounts)]
+    return rng.choice(account_ids)
+
+
+def seed(accounts: int, payments: int, *, balance: Decimal = Decimal('1000000'), currency: str = 'USD',
+         hot_accounts: int = 0, hot_share: float = 0, batch_size: int = 5000, rng: random.Random = None) -> List[str]:
+    """
+    Inserts `accounts` accounts and `payments` payments (two per transaction) with bulk inserts.
+    Seeded transactions don't move balances, every account simply starts with `balance`.
+    """
+    rng = rng or random.Random(0)
+    ccy, _ = Currency.objects.get_or_create(code=currency)
+    account_ids = [f'acc{i:08d}' for i in range(accounts)]
+    Account.objects.bulk_create((Account(id=acc_id, balance=balance, currency=ccy) for acc_id in account_ids),
+                                batch_size=batch_size)
+
+    tx_id = (Transaction.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    remaining = payments // 2
+    while remaining:
+        txs = []
+        for _ in range(min(batch_size, remaining)):
+            from_account_id = pick_account(account_ids, rng)
+            to_account_id = pick_account(account_ids, rng, hot_accounts, hot_share)
+            txs.append(Transaction(id=tx_id, from_account_id=from_account_id, to_account_id=to_account_id,
+                                   amount=Decimal(rng.randrange(1, 10000)) / 100, state=Transaction.STATE_SUCCEED))
+            tx_id += 1
+        # explicit ids, so this works on backends which can't return ids from bulk inserts
+        Transaction.objects.bulk_create(txs)
+        if not settings.SINGLE_ROW_PAYMENTS:
+            Payment.objects.bulk_create([p for tx in txs for p in Payment.build_for_transaction(tx)])
+        remaining -= len(txs)
+    AccountSummary.rebuild()
+
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Transaction, Payment]):
+            cursor.execute(sql)
+        cursor.execute('ANALYZE')
+    return account_ids
+
+
+def measure(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """ Runs `func` `repeat` times and returns timing stats in milliseconds """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'median': statistics.median(timings), 'p99': percentile(timings, 99)}
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def total_balance() -> Decimal:
+    """ Sum of all the account balances, including shards and pending ledger credits """
+    return Account.objects.with_current_balance().aggregate(total=Sum('current_balance'))['total'] or Decimal(0)
+
+
+def drive_transfers(account_ids: List[str], requests: int, concurrency: int, *, amount: Decimal = Decimal('1'),
+                    currency: str = 'USD', hot_accounts: int = 0, hot_share: float = 0,
+                    seed_: int = 0, close_connections: bool = False) -> List[RequestSample]:
+    """
+    Posts `requests` random transfers to `transfer/create/` from `concurrency` threads, each with its own
+    client and DB connection. `hot_share` of the transfers go to one of the first `hot_accounts` accounts.
+    With `close_connections` connections are closed or kept around each request according to `CONN_MAX_AGE`,
+    like the real request handlers do (the test client doesn't), and the reconnects are part of the latency.
+    """
+    samples = []
+    samples_lock = threading.Lock()
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(worker_id: int, count: int) -> None:
+        rng = random.Random(seed_ * 1000 + worker_id)
+        client = Client()
+        worker_samples = []
+        try:
+            for _ in range(count):
+                from_account_id = pick_account(account_ids, rng)
+                to_account_id = pick_account(account_ids, rng, hot_accounts, hot_share)
+                with CaptureQueriesContext(connection) as queries, collect_timings() as timings:
+                    started = time.perf_counter()
+                    if close_connections:
+                        close_old_connections()
+                    response = client.post('/api/v1/transfer/create/', data={
+                        'from_account': from_account_id,
+                        'to_account': to_account_id,
+                        'amount': amount,
+                        'currency': currency,
+                    })
+                    if close_connections:
+                        close_old_connections()
+                    latency = time.perf_counter() - started
+                worker_samples.append(RequestSample(response.status_code, latency, len(queries),
+                                                    timings['lock_wait']))
+        finally:
+            connection.close()
+            with samples_lock:
+                samples.extend(worker_samples)
+
+    threads = [threading.Thread(target=worker, args=(i, count)) for i, count in enumerate(counts) if count]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def summarize(samples: List[RequestSample], elapsed: float) -> Dict[str, object]:
+    latencies = [s.latency * 1000 for s in samples]
+    lock_waits = [s.lock_wait * 1000 for s in samples]
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'statuses': dict(Counter(s.status for s in samples)),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'statements': statistics.mean(s.statements for s in samples) if samples else 0.0,
+        'lock_wait_mean': statistics.mean(lock_waits) if samples else 0.0,
+        'lock_wait_p99': percentile(lock_waits, 99),
+    }
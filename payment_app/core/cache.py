@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Iterable
+
+from django.core.cache import caches
+
+__all__ = ('LRUCache', 'TieredCache')
+
+
+class LRUCache:
+    """
+    Thread safe in-process cache which evicts the least recently used entry once `maxsize` is reached.
+    With a `ttl` (in seconds) entries also expire that long after they were set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            value, expires_at = self._data[key]
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache:
+    """
+    `LRUCache` in front of an optional cache shared by all the processes: one of the Django `CACHES`, e.g. Redis,
+    or the local memory one as a stand-in. Misses of the process tier are filled from the shared one.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float = None, shared: str = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.shared = caches[shared] if shared else None
+
+    def _key(self, key: str) -> str:
+        return f'{self.name}:{key}'
+
+    def get(self, key: str, default: Any = None) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(self._key(key))
+            if value is not None:
+                self.local.set(key, value)
+        return default if value is None else value
+
+    def set(self, key: str, value: Any) -> None:
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(self._key(key), value, timeout=self.ttl)
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        for key in keys:
+            self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete_many([self._key(key) for key in keys])
+
+    def clear(self) -> None:
+        """ Clears the process tier only, the shared one may be used by other caches too """
+        self.local.clear()
@@ -1,7 +1,7 @@
 from rest_framework.exceptions import APIException
 
-__all__ = ('AccountNotFoundException', 'DifferentCurrenciesException',
-           'InsufficientFundsException', 'ErrorProcessingException')
+__all__ = ('AccountNotFoundException', 'DifferentCurrenciesException', 'InsufficientFundsException',
+           'InvalidAmountException', 'ErrorProcessingException', 'IdempotencyKeyReusedException')
 
 
 class AccountNotFoundException(APIException):
@@ -22,6 +22,18 @@ class InsufficientFundsException(APIException):
     default_code = 'bad_request'
 
 
+class InvalidAmountException(APIException):
+    status_code = 400
+    default_detail = 'Amount must be positive'
+    default_code = 'bad_request'
+
+
+class IdempotencyKeyReusedException(APIException):
+    status_code = 422
+    default_detail = 'Idempotency key was already used for another request'
+    default_code = 'unprocessable_entity'
+
+
 class ErrorProcessingException(APIException):
     status_code = 500
     default_detail = 'Unknown error'
@@ -0,0 +1,51 @@
+import csv
+import json
+from typing import Iterable, Iterator, Tuple
+
+from django.db.models import QuerySet
+
+from .serializers import format_amount
+
+__all__ = ('EXPORT_FIELDS', 'EXPORT_FORMATS', 'payment_rows', 'ndjson_lines', 'csv_lines')
+
+EXPORT_FIELDS = ('id', 'account', 'from_account', 'to_account', 'amount', 'direction')
+# keys skipped in NDJSON output when empty, same as `PaymentSerializer` does
+_NONE_KEYS_TO_SKIP = {'from_account', 'to_account'}
+
+
+def payment_rows(queryset: QuerySet, chunk_size: int) -> Iterator[Tuple]:
+    """
+    Plain tuples in `EXPORT_FIELDS` order, fetched through a server-side cursor in chunks of `chunk_size`,
+    so the memory used doesn't depend on how many payments match.
+    """
+    return queryset.order_by('id').values_list(
+        'id', 'account_id', 'from_account_id', 'to_account_id', 'amount', 'direction',
+    ).iterator(chunk_size=chunk_size)
+
+
+def ndjson_lines(rows: Iterable[Tuple]) -> Iterator[str]:
+    for row in rows:
+        entry = {key: value for key, value in zip(EXPORT_FIELDS, row)
+                 if value is not None or key not in _NONE_KEYS_TO_SKIP}
+        entry['amount'] = format_amount(entry['amount'])
+        yield json.dumps(entry) + '\n'
+
+
+class _Echo:
+    """ File-like object which returns what is written instead of buffering it """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def csv_lines(rows: Iterable[Tuple]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row_id, account, from_account, to_account, amount, direction in rows:
+        yield writer.writerow((row_id, account, from_account, to_account, format_amount(amount), direction))
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+    'csv': ('text/csv', csv_lines),
+}
@@ -1,11 +1,30 @@
 import django_filters
 
-from .models import Payment
+from .models import Payment, DerivedPayment
 
-__all__ = ('PaymentFilter',)
+__all__ = ('PaymentFilter', 'DerivedPaymentFilter', 'StatementFilter')
 
 
 class PaymentFilter(django_filters.FilterSet):
+    # payments are partitioned by `created_at` on PostgreSQL, so a date range only scans the partitions it covers
+    created_after = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lt')
+
     class Meta:
         model = Payment
-        fields = ('from_account', 'to_account', 'direction')
+        fields = ('account', 'from_account', 'to_account', 'direction', 'created_after', 'created_before')
+
+
+class DerivedPaymentFilter(PaymentFilter):
+    """ Same filters on the payments derived from the transactions, see `SINGLE_ROW_PAYMENTS` """
+
+    class Meta(PaymentFilter.Meta):
+        model = DerivedPayment
+
+
+class StatementFilter(django_filters.FilterSet):
+    """ Date or id range of an account statement, see `Account.statement_lines` """
+    created_after = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lt')
+    id_after = django_filters.NumberFilter(field_name='id', lookup_expr='gt')
+    id_before = django_filters.NumberFilter(field_name='id', lookup_expr='lt')
@@ -0,0 +1,33 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core import partitions
+
+
+class Command(BaseCommand):
+    help = ('Writes the monthly payment partitions older than --keep-months to gzipped CSV files in --directory, '
+            'then detaches and drops them. Account summaries keep counting the archived payments')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=12, help='Months kept besides the current one')
+        parser.add_argument('--directory', type=Path, required=True)
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 0:
+            raise CommandError('number of months can\'t be negative')
+        directory = Path(options['directory'])
+        if not directory.is_dir():
+            raise CommandError(f'{directory} is not a directory')
+
+        with connection.cursor() as cursor:
+            if not partitions.is_partitioned(cursor):
+                raise CommandError('payments are partitioned on PostgreSQL only')
+
+            keep_from = partitions.add_months(partitions.month_start(timezone.now()), -options['keep_months'])
+            for month in partitions.partition_months(cursor):
+                if month < keep_from:
+                    path = partitions.archive_partition(cursor, month, directory)
+                    self.stdout.write(f'Archived {partitions.partition_name(month)} to {path}')
@@ -0,0 +1,64 @@
+import logging
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from core.benchmark import scratch_database, seed, drive_transfers, summarize
+
+# name, `CONN_MAX_AGE` and `DB_PREPARE_THRESHOLD` (None: the --prepare-threshold option) of the compared modes
+MODES = (
+    ('connection per request', 0, 0),
+    ('persistent connections', None, 0),
+    ('persistent + prepared', None, None),
+)
+
+
+class Command(BaseCommand):
+    help = ('Seeds a scratch database and drives transfer/create/ with a new connection per request, with persistent '
+            'connections and with persistent connections and prepared statements, reports latency per request '
+            'and the number of connections opened')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument('--payments', type=int, default=10000, help='Payments seeded before the run')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per mode')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of client threads')
+        parser.add_argument('--prepare-threshold', type=int, default=5)
+
+    def handle(self, *args, **options):
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        max_age = connection.settings_dict['CONN_MAX_AGE']
+        results = []
+        with scratch_database():
+            account_ids = seed(options['accounts'], options['payments'])
+            if options['verbosity'] < 2:
+                logging.disable(logging.ERROR)
+            connection_created.connect(count_connection)
+            try:
+                for name, conn_max_age, threshold in MODES:
+                    threshold = options['prepare_threshold'] if threshold is None else threshold
+                    # worker threads create their connections from this very dict
+                    connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+                    opened.clear()
+                    started = time.perf_counter()
+                    with override_settings(DB_PREPARE_THRESHOLD=threshold):
+                        samples = drive_transfers(account_ids, options['requests'], options['concurrency'],
+                                                  amount=Decimal('1'), close_connections=True)
+                    results.append((name, summarize(samples, time.perf_counter() - started), len(opened)))
+            finally:
+                connection_created.disconnect(count_connection)
+                connection.settings_dict['CONN_MAX_AGE'] = max_age
+                logging.disable(logging.NOTSET)
+
+        self.stdout.write(f'{"mode":<24} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"connections":>12}  statuses')
+        for name, stats, connections in results:
+            self.stdout.write(f'{name:<24} {stats["throughput"]:>8.1f} {stats["latency_p50"]:>8.2f} '
+                              f'{stats["latency_p99"]:>8.2f} {connections:>12}  {stats["statuses"]}')
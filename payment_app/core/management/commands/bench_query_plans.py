@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+
+from core.benchmark import scratch_database, seed, measure
+from core.models import Account, Transaction, Payment
+
+# single column foreign key indexes the composite indexes replaced
+BASELINE_INDEXES = {
+    Payment: [
+        models.Index(fields=['account'], name='bench_payment_account_idx'),
+        models.Index(fields=['from_account'], name='bench_payment_from_idx'),
+        models.Index(fields=['to_account'], name='bench_payment_to_idx'),
+    ],
+    Transaction: [
+        models.Index(fields=['from_account'], name='bench_tx_from_idx'),
+    ],
+}
+
+
+class Command(BaseCommand):
+    help = ('Seeds a scratch database and compares query plans and timings of the payment list access paths '
+            'with the single column foreign key indexes and with the composite indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument('--payments', type=int, default=200000)
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            self.stdout.write(f'Seeding {options["accounts"]} accounts and {options["payments"]} payments...')
+            account_ids = seed(options['accounts'], options['payments'], hot_accounts=1, hot_share=0.2)
+            queries = self.queries(account_ids[0], options['page_size'])
+
+            self.swap_indexes(drop=self.composite_indexes(), add=BASELINE_INDEXES)
+            before = self.run(queries, options['repeat'])
+            self.swap_indexes(drop=BASELINE_INDEXES, add=self.composite_indexes())
+            after = self.run(queries, options['repeat'])
+
+        for name in queries:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+            for label, results in (('before', before), ('after', after)):
+                plan, timing = results[name]
+                self.stdout.write(f'{label}: median {timing["median"]:.3f}ms, p99 {timing["p99"]:.3f}ms')
+                self.stdout.write(plan)
+
+    @staticmethod
+    def queries(account_id: str, page_size: int):
+        account = Account(id=account_id)
+        querysets = {
+            'payments by account': Payment.objects.filter(account=account_id),
+            'payments by account and direction': Payment.objects.filter(account=account_id,
+                                                                        direction=Payment.INCOMING),
+            'payments by from_account': Payment.objects.filter(from_account=account_id),
+            'payments by to_account': Payment.objects.filter(to_account=account_id),
+            'incoming payments': account.incoming_payments,
+            'outgoing payments': account.outgoing_payments,
+        }
+        # first page, the way the cursor pagination queries them
+        return {name: queryset.order_by('id')[:page_size] for name, queryset in querysets.items()}
+
+    @staticmethod
+    def composite_indexes():
+        return {model: model._meta.indexes for model in (Payment, Transaction)}
+
+    @staticmethod
+    def swap_indexes(*, drop, add):
+        with connection.schema_editor() as editor:
+            for model, indexes in drop.items():
+                for index in indexes:
+                    editor.remove_index(model, index)
+            for model, indexes in add.items():
+                for index in indexes:
+                    editor.add_index(model, index)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    @staticmethod
+    def run(queries, repeat):
+        analyze = connection.vendor == 'postgresql'
+        return {
+            name: (queryset.explain(analyze=analyze) if analyze else queryset.explain(),
+                   measure(lambda: list(queryset.all()), repeat))
+            for name, queryset in queries.items()
+        }
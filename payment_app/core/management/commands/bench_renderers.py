@@ -0,0 +1,50 @@
+import random
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from core.benchmark import measure
+from core.models import Payment
+from core.renderers import ORJSONRenderer, MsgPackRenderer
+from core.serializers import PaymentRowSerializer
+
+RENDERERS = (JSONRenderer, ORJSONRenderer, MsgPackRenderer)
+
+
+class Command(BaseCommand):
+    help = ('Renders a large page of payments, as `payments/` returns it, with the JSON, orjson and msgpack '
+            'renderers and reports the encode time and the bytes per payment')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=10000, help='Payments per page')
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        rows = []
+        for payment_id in range(1, options['payments'] + 1):
+            account_id, other_id = (f'acc{rng.randrange(options["accounts"]):08d}' for _ in range(2))
+            incoming = payment_id % 2 == 0
+            rows.append({
+                'id': payment_id,
+                'account_id': account_id,
+                'from_account_id': other_id if incoming else None,
+                'to_account_id': None if incoming else other_id,
+                'amount': Decimal(rng.randrange(1, 1000000)) / 100,
+                'direction': Payment.INCOMING if incoming else Payment.OUTGOING,
+            })
+        # same shape as the `IdCursorPagination` responses
+        data = {'next': None, 'previous': None, 'results': PaymentRowSerializer(rows, many=True).data}
+
+        self.stdout.write(f'{"renderer":<10} {"median ms":>10} {"p99 ms":>8} {"bytes/payment":>14}')
+        for renderer_class in RENDERERS:
+            if not getattr(renderer_class, 'available', True):
+                self.stdout.write(f'{renderer_class.format:<10} not installed')
+                continue
+            renderer = renderer_class()
+            size = len(renderer.render(data))
+            timings = measure(lambda: renderer.render(data), options['repeat'])
+            self.stdout.write(f'{renderer.format:<10} {timings["median"]:>10.2f} {timings["p99"]:>8.2f} '
+                              f'{size / len(rows):>14.1f}')
@@ -0,0 +1,61 @@
+import logging
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from core.benchmark import scratch_database, seed, drive_transfers, summarize, total_balance
+from core.metrics import transfer_lock_retries
+from core.models import Account
+
+
+class Command(BaseCommand):
+    help = ('Seeds a scratch database and drives transfer/create/ from concurrent threads, reports throughput, '
+            'latency, SQL statements and lock wait per request and checks that the total balance is conserved')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=1000)
+        parser.add_argument('--payments', type=int, default=10000, help='Payments seeded before the run')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of client threads')
+        parser.add_argument('--hot-accounts', type=int, default=1, help='Number of hot receiving accounts')
+        parser.add_argument('--hot-share', type=float, default=0.5,
+                            help='Share of the transfers which go to the hot accounts')
+        parser.add_argument('--amount', type=Decimal, default=Decimal('1'))
+        parser.add_argument('--shards', type=int, default=0, help='Split the hot accounts into that many shards')
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            account_ids = seed(options['accounts'], options['payments'], hot_accounts=options['hot_accounts'],
+                               hot_share=options['hot_share'])
+            if options['shards']:
+                for account_id in account_ids[:options['hot_accounts']]:
+                    Account.split_into_shards(account_id, options['shards'])
+
+            total_before = total_balance()
+            retries_before = transfer_lock_retries.value
+            if options['verbosity'] < 2:
+                # failed requests are counted in the report, their tracebacks would drown it
+                logging.disable(logging.ERROR)
+            started = time.perf_counter()
+            try:
+                samples = drive_transfers(account_ids, options['requests'], options['concurrency'],
+                                          amount=options['amount'], hot_accounts=options['hot_accounts'],
+                                          hot_share=options['hot_share'])
+            finally:
+                logging.disable(logging.NOTSET)
+            elapsed = time.perf_counter() - started
+            Account.compact_ledger()
+            total_after = total_balance()
+
+        stats = summarize(samples, elapsed)
+        self.stdout.write(f'requests:        {stats["requests"]} in {elapsed:.2f}s, statuses {stats["statuses"]}')
+        self.stdout.write(f'throughput:      {stats["throughput"]:.1f} req/s')
+        self.stdout.write(f'latency:         p50 {stats["latency_p50"]:.2f}ms, p99 {stats["latency_p99"]:.2f}ms')
+        self.stdout.write(f'SQL statements:  {stats["statements"]:.2f} per request')
+        self.stdout.write(f'lock wait:       mean {stats["lock_wait_mean"]:.2f}ms, p99 {stats["lock_wait_p99"]:.2f}ms')
+        self.stdout.write(f'lock retries:    {transfer_lock_retries.value - retries_before}')
+        if total_before == total_after:
+            self.stdout.write(self.style.SUCCESS(f'total balance:   conserved ({total_after})'))
+        else:
+            self.stdout.write(self.style.ERROR(f'total balance:   {total_before} before, {total_after} after'))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import Account, AccountSummary
+
+
+class Command(BaseCommand):
+    help = ('Folds pending ledger credits into the account balances and pending summary deltas into the account '
+            'summaries, once or periodically')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between compaction rounds, runs a single round if not set')
+        parser.add_argument('--limit', type=int, default=1000, help='Max number of accounts compacted per round')
+        parser.add_argument('--summary-limit', type=int, default=10000,
+                            help='Max number of summary deltas folded per round')
+
+    def handle(self, *args, **options):
+        while True:
+            compacted = Account.compact_ledger(limit=options['limit'])
+            folded = AccountSummary.fold_deltas(limit=options['summary_limit'])
+            if options['verbosity'] > 1 or not options['interval']:
+                self.stdout.write(f'Compacted {compacted} accounts, folded {folded} summary deltas')
+            if not options['interval']:
+                return
+            # keep going right away while there is a backlog
+            if compacted < options['limit'] and folded < options['summary_limit']:
+                time.sleep(options['interval'])
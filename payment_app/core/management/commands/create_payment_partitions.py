@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core import partitions
+
+
+class Command(BaseCommand):
+    help = ('Creates the monthly payment partitions up to --months-ahead months after the current one, '
+            'run it at least monthly so payments don\'t pile up in the default partition')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3)
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            if not partitions.is_partitioned(cursor):
+                raise CommandError('payments are partitioned on PostgreSQL only')
+
+            existing = set(partitions.partition_months(cursor))
+            month = partitions.month_start(timezone.now())
+            for _ in range(options['months_ahead'] + 1):
+                if month not in existing:
+                    partitions.create_partition(cursor, month)
+                    self.stdout.write(f'Created {partitions.partition_name(month)}')
+                month = partitions.add_months(month, 1)
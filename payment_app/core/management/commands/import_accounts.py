@@ -0,0 +1,67 @@
+import json
+import time
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.account_import import InvalidRowError, read_rows, chunks, load_currencies, load_accounts
+
+
+class Command(BaseCommand):
+    help = ('Loads accounts, their currencies and opening balances from a CSV (id,currency,balance) or NDJSON file in '
+            'chunks. Progress is checkpointed after every chunk and an interrupted import resumes from there, '
+            'accounts which exist already are skipped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', type=Path)
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Rows loaded per transaction')
+        parser.add_argument('--checkpoint', type=Path, help='Progress file, <file>.checkpoint by default')
+        parser.add_argument('--restart', action='store_true', help='Ignore the progress of a previous run')
+        parser.add_argument('--no-create-currencies', dest='create_currencies', action='store_false',
+                            help='Fail on unknown currencies instead of creating them')
+
+    def handle(self, *args, **options):
+        path = Path(options['file'])
+        if not path.is_file():
+            raise CommandError(f'{path} not found')
+        checkpoint = Path(options['checkpoint'] or path.with_name(f'{path.name}.checkpoint'))
+        size = path.stat().st_size
+
+        done = 0
+        if checkpoint.exists() and not options['restart']:
+            progress = json.loads(checkpoint.read_text())
+            if progress['size'] != size:
+                raise CommandError(f'{path} changed since {checkpoint} was written, rerun with --restart')
+            done = progress['rows']
+            self.stdout.write(f'Resuming after {done} rows')
+
+        rows, resumed = read_rows(path), done
+        inserted, started = 0, time.perf_counter()
+        try:
+            # rows before the checkpoint are parsed again, but not loaded
+            for _ in islice(rows, done):
+                pass
+            for chunk in chunks(rows, options['chunk_size']):
+                missing = load_currencies({row.currency_id for row in chunk}, options['create_currencies'])
+                if missing:
+                    raise CommandError(f'Unknown currencies after row {done}: {", ".join(sorted(missing))}')
+                count = load_accounts(chunk)
+                # bulk_create can't tell how many accounts existed already
+                inserted = None if count is None or inserted is None else inserted + count
+                done += len(chunk)
+                # a chunk loaded but not checkpointed is loaded again on resume and skipped as existing
+                incomplete = checkpoint.with_name(f'{checkpoint.name}.part')
+                incomplete.write_text(json.dumps({'size': size, 'rows': done}))
+                incomplete.replace(checkpoint)
+                self.stdout.write(f'{done} rows loaded{self._inserted(inserted)}, '
+                                  f'{(done - resumed) / (time.perf_counter() - started):.0f} rows/s')
+        except InvalidRowError as e:
+            raise CommandError(f'{path}: {e}')
+
+        checkpoint.unlink(missing_ok=True)
+        self.stdout.write(f'Imported {done} rows{self._inserted(inserted)}')
+
+    @staticmethod
+    def _inserted(inserted) -> str:
+        return '' if inserted is None else f', {inserted} accounts inserted'
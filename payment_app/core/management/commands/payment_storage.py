@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Payment, DerivedPayment
+
+SINGLE_ROW = 'single-row'
+TWO_ROWS = 'two-rows'
+
+
+class Command(BaseCommand):
+    help = (f'Prepares the DB for a payment storage mode. Run "{SINGLE_ROW}" before setting SINGLE_ROW_PAYMENTS=1: '
+            f'creates the indexes of the derived payments. Run "{TWO_ROWS}" once it is unset again: stores the '
+            f'payments of the transactions made meanwhile and drops those indexes. The indexes are created and '
+            f'dropped CONCURRENTLY on PostgreSQL, so it must not run inside a transaction')
+
+    def add_arguments(self, parser):
+        parser.add_argument('mode', choices=(SINGLE_ROW, TWO_ROWS))
+
+    def handle(self, *args, **options):
+        if options['mode'] == SINGLE_ROW:
+            DerivedPayment.create_indexes()
+            self.stdout.write('Indexes of the derived payments are created, set SINGLE_ROW_PAYMENTS=1')
+        else:
+            stored = Payment.copy_derived()
+            DerivedPayment.drop_indexes()
+            self.stdout.write(f'Stored {stored} payments, indexes of the derived payments are dropped')
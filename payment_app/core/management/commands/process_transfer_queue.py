@@ -0,0 +1,43 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.models import QueuedTransfer
+
+
+class Command(BaseCommand):
+    help = ('Makes the transfers queued in queue mode, in batches which lock every account once, '
+            'once or continuously from a pool of worker processes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Max number of transfers per DB transaction')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds to wait once the queue is empty, drains the queue once if not set')
+        parser.add_argument('--processes', type=int, default=1, help='Number of worker processes')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            self.work(options)
+            return
+
+        # forked workers must not share the connections of the parent
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=self.work, args=(options,)) for _ in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, options):
+        while True:
+            processed = QueuedTransfer.process(options['batch_size'])
+            if options['verbosity'] > 1 or (processed and not options['interval']):
+                self.stdout.write(f'Processed {processed} transfers')
+            # keep going right away while there is a backlog
+            if processed < options['batch_size']:
+                if not options['interval']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exceptions import AccountNotFoundException
+from core.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Spreads the funds of a high fan-in account over balance shards, 0 shards brings them back together'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_id')
+        parser.add_argument('shards', type=int)
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError('number of shards can\'t be negative')
+
+        try:
+            Account.split_into_shards(options['account_id'], options['shards'])
+        except AccountNotFoundException as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'{options["account_id"]} has {options["shards"]} shards')
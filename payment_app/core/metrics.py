@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+__all__ = ('Counter', 'EndpointMetrics', 'transfer_lock_retries', 'endpoint_metrics', 'collect_timings', 'timed',
+           'render_prometheus')
+
+# durations of the `timed` blocks of the current request, set by `collect_timings`
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('timings', default=None)
+
+
+class Counter:
+    """ Monotonic, thread safe process-local counter """
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return f'{self.name} {self._value}'
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.description}\n# TYPE {self.name} counter\n{self.name} {self._value}\n'
+
+
+class EndpointMetrics:
+    """ Thread safe process-local totals of the request measurements, per endpoint and response status """
+
+    # name of the total and its description, by the measurement
+    SERIES = {
+        'requests': ('payments_http_requests_total', 'Number of handled requests'),
+        'duration': ('payments_http_request_duration_seconds_total', 'Time spent handling requests'),
+        'queries': ('payments_http_request_db_queries_total', 'Number of SQL statements executed'),
+        'db': ('payments_http_request_db_seconds_total', 'Time spent in the database'),
+        'serializer': ('payments_http_request_serializer_seconds_total', 'Time spent building the representations'),
+        'lock_wait': ('payments_http_request_lock_wait_seconds_total', 'Time spent acquiring the transfer locks'),
+        'response_size': ('payments_http_response_bytes_total', 'Size of the response bodies'),
+    }
+
+    def __init__(self) -> None:
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, method: str, status: int, **measurements: float) -> None:
+        with self._lock:
+            totals = self._totals[(endpoint, method, status)]
+            totals['requests'] += 1
+            for name, value in measurements.items():
+                totals[name] += value
+
+    def render(self) -> str:
+        with self._lock:
+            totals = {labels: dict(values) for labels, values in self._totals.items()}
+
+        lines = []
+        for measurement, (name, description) in self.SERIES.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} counter')
+            for (endpoint, method, status), values in sorted(totals.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}",method="{method}",status="{status}"}} '
+                             f'{values.get(measurement, 0):g}')
+        return '\n'.join(lines) + '\n'
+
+
+transfer_lock_retries = Counter(
+    'transfer_lock_retries_total', 'Transfers retried after a deadlock, serialization failure or lock timeout',
+)
+endpoint_metrics = EndpointMetrics()
+
+
+def render_prometheus() -> str:
+    """ All the process metrics in the Prometheus text exposition format """
+    return endpoint_metrics.render() + transfer_lock_retries.render()
+
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """ Sums up the durations (in seconds) of the `timed` blocks run inside, by their names """
+    timings = defaultdict(float)
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _timings.get()
+        if timings is not None:
+            timings[name] += time.perf_counter() - started
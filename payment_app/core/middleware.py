@@ -0,0 +1,76 @@
+import asyncio
+import time
+from typing import Dict
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import collect_timings, endpoint_metrics
+
+__all__ = ('RequestMetricsMiddleware',)
+
+
+class RequestMetricsMiddleware:
+    """
+    Measures every request: number of SQL statements and time spent in the database, building the representations
+    and acquiring the transfer locks, and the response size. Totals per endpoint are exposed by `/metrics`,
+    the request's own numbers are sent back in the `Server-Timing` header.
+
+    Under ASGI the statements run in other threads or on the `asyncdb` pool, so only the timings are measured there.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks us as a coroutine function for Django, so async views run without a thread, see `__acall__`
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        db = {'queries': 0, 'time': 0.0}
+
+        def measure_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                db['queries'] += 1
+                db['time'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(measure_query), collect_timings() as timings:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+        return self._record(request, response, duration, timings, db)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with collect_timings() as timings:
+            response = await self.get_response(request)
+        duration = time.perf_counter() - started
+        return self._record(request, response, duration, timings)
+
+    @staticmethod
+    def _record(request, response, duration: float, timings: Dict[str, float], db: Dict[str, float] = None):
+        # streamed bodies are produced after the request is handled, their size is unknown here
+        response_size = 0 if response.streaming else len(response.content)
+        match = request.resolver_match
+        endpoint_metrics.observe(
+            match.view_name if match else 'unmatched', request.method, response.status_code,
+            duration=duration, queries=db['queries'] if db else 0, db=db['time'] if db else 0,
+            serializer=timings['serializer'], lock_wait=timings['lock_wait'], response_size=response_size,
+        )
+
+        if settings.SERVER_TIMING_HEADER:
+            entries = [f'db;dur={db["time"] * 1000:.2f};desc="{db["queries"]} queries"'] if db else []
+            entries += [
+                f'serializer;dur={timings["serializer"] * 1000:.2f}',
+                f'lock;dur={timings["lock_wait"] * 1000:.2f}',
+                f'total;dur={duration * 1000:.2f}',
+            ]
+            response['Server-Timing'] = ', '.join(entries)
+        return response
@@ -0,0 +1,59 @@
+# Generated by Django 3.1.3 on 2026-10-18 03:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        # composite indexes are created first, so the account columns are never left without an index
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['account', 'id'], name='payment_account_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['account', 'direction', 'id'], name='payment_account_dir_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(from_account__isnull=False), fields=['from_account', 'id'], name='payment_from_account_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(to_account__isnull=False), fields=['to_account', 'id'], name='payment_to_account_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['from_account', 'id'], name='tx_from_account_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(state='succeed'), fields=['to_account', 'id'], name='tx_to_account_succeed_idx'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='account',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='account', to='core.account'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='from_account',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='from_account+', to='core.account'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='to_account',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='to_account+', to='core.account'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='from_account',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='from_account', to='core.account'),
+        ),
+    ]
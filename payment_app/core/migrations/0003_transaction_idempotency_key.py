@@ -0,0 +1,22 @@
+# Generated by Django 3.1.3 on 2026-10-18 03:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_payment_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='idempotency_key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(idempotency_key__isnull=False), fields=('idempotency_key',), name='tx_idempotency_key_uniq'),
+        ),
+    ]
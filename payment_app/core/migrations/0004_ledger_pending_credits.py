@@ -0,0 +1,22 @@
+# Generated by Django 3.1.3 on 2026-10-18 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_transaction_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='credit_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(credit_pending=True), fields=['to_account', 'id'], name='tx_pending_credit_idx'),
+        ),
+    ]
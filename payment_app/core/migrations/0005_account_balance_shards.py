@@ -0,0 +1,32 @@
+# Generated by Django 3.1.3 on 2026-10-18 03:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_ledger_pending_credits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='AccountBalanceShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='core.account')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accountbalanceshard',
+            constraint=models.UniqueConstraint(fields=('account', 'index'), name='account_shard_uniq'),
+        ),
+    ]
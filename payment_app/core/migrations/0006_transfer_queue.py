@@ -0,0 +1,36 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_account_balance_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedTransfer',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('from_account_id', models.TextField()),
+                ('to_account_id', models.TextField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('currency_code', models.CharField(max_length=3)),
+                ('idempotency_key', models.CharField(max_length=64, null=True)),
+                ('state', models.CharField(choices=[('queued', 'queued'), ('succeed', 'succeed'), ('failed', 'failed')], default='queued', max_length=8)),
+                ('error', models.TextField(null=True)),
+                ('transaction', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.transaction')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedtransfer',
+            index=models.Index(condition=models.Q(state='queued'), fields=['id'], name='queued_transfer_pending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='queuedtransfer',
+            constraint=models.UniqueConstraint(condition=models.Q(idempotency_key__isnull=False), fields=('idempotency_key',), name='queued_transfer_idempotency_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:14
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def summarize_payments(apps, schema_editor):
+    AccountSummary = apps.get_model('core', 'AccountSummary')
+    Payment = apps.get_model('core', 'Payment')
+    incoming, outgoing = Q(direction='incoming'), Q(direction='outgoing')
+    amount = models.DecimalField(max_digits=17, decimal_places=2)
+    rows = Payment.objects.order_by().values('account_id').annotate(
+        total_in=Coalesce(Sum('amount', filter=incoming), Value(0), output_field=amount),
+        total_out=Coalesce(Sum('amount', filter=outgoing), Value(0), output_field=amount),
+        count_in=Count('id', filter=incoming),
+        count_out=Count('id', filter=outgoing),
+        last_payment_id=Max('id'),
+    )
+    AccountSummary.objects.bulk_create((AccountSummary(**row) for row in rows.iterator()), batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_transfer_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSummary',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='core.account')),
+                ('total_in', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('total_out', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('count_in', models.BigIntegerField(default=0)),
+                ('count_out', models.BigIntegerField(default=0)),
+                ('last_payment_id', models.BigIntegerField(null=True)),
+            ],
+        ),
+        migrations.RunPython(summarize_payments, migrations.RunPython.noop),
+    ]
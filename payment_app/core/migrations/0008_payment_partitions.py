@@ -0,0 +1,94 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:18
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.utils.timezone
+
+# months after the current one which get their partitions right away, see the `create_payment_partitions` command
+MONTHS_AHEAD = 3
+
+
+# the helpers of `core.partitions` as of this migration, it must not change along with the models
+def _month_start(value: datetime.datetime) -> datetime.datetime:
+    value = value.astimezone(datetime.timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def _create_partition(schema_editor, table: str, month: datetime.datetime) -> None:
+    """ Partition `<table>_pYYYYMM` of `month`, the table is still empty """
+    start, end = month.isoformat(), _add_months(month, 1).isoformat()
+    schema_editor.execute(f"CREATE TABLE {table}_p{month:%Y%m} PARTITION OF {table} "
+                          f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def _rebuild_payment_table(apps, schema_editor, partitioned: bool):
+    """ Copies the payments into a new (un)partitioned table, PostgreSQL only """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Payment = apps.get_model('core', 'Payment')
+    table, old = Payment._meta.db_table, f'{Payment._meta.db_table}_old'
+    execute = schema_editor.execute
+    execute(f'ALTER TABLE {table} RENAME TO {old}')
+    execute(f'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS)'
+            + (' PARTITION BY RANGE (created_at)' if partitioned else ''))
+    if partitioned:
+        execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'SELECT min(created_at) FROM {old}')
+            first = cursor.fetchone()[0]
+        month = _month_start(first or timezone.now())
+        last = _add_months(_month_start(timezone.now()), MONTHS_AHEAD)
+        while month <= last:
+            _create_partition(schema_editor, table, month)
+            month = _add_months(month, 1)
+    execute(f'INSERT INTO {table} SELECT * FROM {old}')
+    execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+    # the indexes and constraints of the old table go with it, so they can be created again with the same names
+    execute(f'DROP TABLE {old}')
+
+    # a primary key of a partitioned table has to include the partition key
+    execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY '
+            + ('(id, created_at)' if partitioned else '(id)'))
+    for name in ('transaction', 'account', 'from_account', 'to_account'):
+        field = Payment._meta.get_field(name)
+        execute(schema_editor._create_fk_sql(Payment, field, '_fk_%(to_table)s_%(to_column)s'))
+        for sql in schema_editor._field_indexes_sql(Payment, field):
+            execute(sql)
+    for index in Payment._meta.indexes:
+        schema_editor.add_index(Payment, index)
+
+
+def partition_payments(apps, schema_editor):
+    _rebuild_payment_table(apps, schema_editor, partitioned=True)
+
+
+def unpartition_payments(apps, schema_editor):
+    _rebuild_payment_table(apps, schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_account_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(partition_payments, unpartition_payments),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+# an incoming and an outgoing payment per succeeded transaction, ordered by id like the stored ones
+CREATE_VIEW = """
+CREATE VIEW core_derived_payment AS
+SELECT id * 2 AS id, id AS transaction_id, 'incoming' AS direction, to_account_id AS account_id,
+       from_account_id, NULL AS to_account_id, amount, created_at
+FROM core_transaction WHERE state = 'succeed'
+UNION ALL
+SELECT id * 2 + 1, id, 'outgoing', from_account_id, NULL, to_account_id, amount, created_at
+FROM core_transaction WHERE state = 'succeed'
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_payment_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DerivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('direction', models.CharField(choices=[('incoming', 'incoming'), ('outgoing', 'outgoing')], max_length=10)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('created_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'core_derived_payment',
+                'managed': False,
+            },
+        ),
+        migrations.RunSQL(CREATE_VIEW, 'DROP VIEW core_derived_payment'),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_derived_payment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountsummary',
+            name='modified_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='accountsummary',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
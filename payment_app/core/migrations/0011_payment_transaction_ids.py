@@ -0,0 +1,35 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:45
+
+from django.db import migrations, models
+from django.db.models import F, Case, When, Value
+
+
+def renumber_payments(apps, schema_editor):
+    """ Gives the stored payments the ids of the derived ones, see `_PaymentMixin` """
+    Payment = apps.get_model('core', 'Payment')
+    AccountSummary = apps.get_model('core', 'AccountSummary')
+    # negative ids first, the new ids of some payments are the old ones of others
+    Payment.objects.update(id=-F('id'))
+    outgoing = Case(When(direction='outgoing', then=Value(1)), default=Value(0), output_field=models.BigIntegerField())
+    Payment.objects.update(id=F('transaction_id') * 2 + outgoing)
+    # the view has the payments of all the transactions, whichever way they were stored
+    schema_editor.execute(
+        f'UPDATE {AccountSummary._meta.db_table} SET last_payment_id = (SELECT max(d.id) FROM core_derived_payment d '
+        f'WHERE d.account_id = {AccountSummary._meta.db_table}.account_id)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_summary_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='id',
+            field=models.BigIntegerField(primary_key=True, serialize=False),
+        ),
+        # the old ids are gone, the reverse only gives the ids a sequence again
+        migrations.RunPython(renumber_payments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_payment_transaction_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSummaryDelta',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('total_in', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('total_out', models.DecimalField(decimal_places=2, default=0, max_digits=17)),
+                ('count_in', models.BigIntegerField(default=0)),
+                ('count_out', models.BigIntegerField(default=0)),
+                ('last_payment_id', models.BigIntegerField(null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summary_deltas', to='core.account')),
+            ],
+        ),
+    ]
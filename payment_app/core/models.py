@@ -1,29 +1,183 @@
+import asyncio
 import logging
-from decimal import Decimal
-from typing import TypeVar, Type, Optional, Union, List
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, ROUND_DOWN
+from itertools import chain, count
+from typing import TypeVar, Type, Optional, Union, List, Dict, Iterable, Callable, FrozenSet
 
-from django.db import models, transaction
-from django.db.models import F
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import models, transaction, connection, OperationalError, IntegrityError, InterfaceError
+from django.db.models import (F, Q, OuterRef, Subquery, Sum, Count, Max, Value, ExpressionWrapper, DecimalField, Case,
+                              When, Window, FloatField)
 from django.db.models import QuerySet
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from rest_framework.exceptions import APIException
 
+from . import asyncdb
+from .cache import LRUCache, TieredCache
 from .exceptions import *
+from .metrics import transfer_lock_retries, timed
 
-__all__ = ('Currency', 'Account', 'Transaction', 'Payment')
+__all__ = ('Currency', 'AccountQuerySet', 'Account', 'AccountBalanceShard', 'Transaction', 'Payment', 'DerivedPayment',
+           'Transfer', 'TransferOutcome', 'QueuedTransfer', 'AccountSummary', 'AccountSummaryDelta',
+           'IDEMPOTENCY_KEY_MAX_LENGTH')
 
 TransactionType = TypeVar('TransactionType', bound='Transaction')
 AccountType = TypeVar('AccountType', bound='Account')
 PaymentType = TypeVar('PaymentType', bound='Payment')
+ShardType = TypeVar('ShardType', bound='AccountBalanceShard')
+QueuedType = TypeVar('QueuedType', bound='QueuedTransfer')
+SummaryType = TypeVar('SummaryType', bound='AccountSummary')
+T = TypeVar('T')
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+CENT = Decimal('0.01')
+
+# PostgreSQL error codes of lock conflicts
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+LOCK_NOT_AVAILABLE = '55P03'
+
+# single transfer order as accepted by `Transaction.create_batch`
+Transfer = namedtuple('Transfer', ('from_account_id', 'to_account_id', 'amount', 'currency_code', 'idempotency_key'),
+                      defaults=(None,))
+# per-transfer result of a batch: exactly one of `transaction` and `error` is set
+TransferOutcome = namedtuple('TransferOutcome', ('transaction', 'error'))
+
+
+# business rejections of a transfer, reported to the client as they are
+TRANSFER_REJECTIONS = (AccountNotFoundException, DifferentCurrenciesException, InsufficientFundsException,
+                       InvalidAmountException)
+
+
+class _TransferRejected(Exception):
+    """ Rolls back a transfer and carries the API exception describing why it was rejected """
+
+    def __init__(self, reason: APIException) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _placeholders(rows: int, columns: int) -> str:
+    """ `($1, $2), ($3, $4)` for a multi-row `VALUES` of asyncpg """
+    return ', '.join('(' + ', '.join(f'${row * columns + column + 1}' for column in range(columns)) + ')'
+                     for row in range(rows))
+
+
+class _DecimalWindow(Window):
+    """
+    `Window` over a decimal aggregate. Django 3.1 puts the SQLite cast of the aggregate between it and `OVER`,
+    which is a syntax error, so there the aggregate is computed as a float and the window result is cast instead.
+    """
+
+    def as_sqlite(self, compiler, connection):
+        copy = self.copy()
+        aggregate, *rest = copy.get_source_expressions()
+        aggregate = aggregate.copy()
+        aggregate.output_field = FloatField()
+        copy.set_source_expressions([aggregate, *rest])
+        sql, params = copy.as_sql(compiler, connection)
+        return f'CAST({sql} AS NUMERIC)', params
+
+
+class _AsyncUnsupported(Exception):
+    """ Rolls back a native async transfer which only `Transaction.create_new` can make (sharded accounts) """
+
+
+def is_lock_conflict(error: OperationalError) -> bool:
+    """ Whether the error is a lock conflict which is worth retrying the whole transaction for """
+    cause = error.__cause__
+    if getattr(cause, 'pgcode', None) in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED, LOCK_NOT_AVAILABLE):
+        return True
+    # SQLite has no row locks, concurrent writers conflict on the whole database (or shared cache table) instead
+    return 'database is locked' in str(error) or 'database table is locked' in str(error)
 
 
 class Currency(models.Model):
     code = models.CharField(max_length=3, primary_key=True)
     description = models.TextField(null=True)
 
+    # codes of all the currencies, kept up to date by the `core.signals` receivers and reloaded every
+    # `CURRENCY_CACHE_TTL` seconds to pick up the changes made by other processes
+    _codes: Optional[FrozenSet[str]] = None
+    _codes_loaded_at = 0.0
+
+    @classmethod
+    def codes(cls) -> FrozenSet[str]:
+        if cls._codes is None or time.monotonic() - cls._codes_loaded_at > settings.CURRENCY_CACHE_TTL:
+            cls._codes = frozenset(cls.objects.values_list('code', flat=True))
+            cls._codes_loaded_at = time.monotonic()
+        return cls._codes
+
+    @classmethod
+    def is_known(cls, code: str) -> bool:
+        return code in cls.codes()
+
+    def refresh_cache(self) -> None:
+        # once committed, a rolled back currency must not stay known
+        transaction.on_commit(lambda: Currency._update_codes(add={self.code}))
+
+    def drop_cache(self) -> None:
+        transaction.on_commit(lambda: Currency._update_codes(remove={self.code}))
+
+    @classmethod
+    def _update_codes(cls, add: FrozenSet[str] = frozenset(), remove: FrozenSet[str] = frozenset()) -> None:
+        if cls._codes is not None:
+            cls._codes = (cls._codes | add) - remove
+
+
+class AccountQuerySet(models.QuerySet):
+    def with_current_balance(self) -> 'AccountQuerySet':
+        """
+        Annotates `current_balance`: the balance snapshot plus the balances of its shards and the ledger credits
+        which are not folded into it yet. Both come from small index lookups.
+        """
+        shards = AccountBalanceShard.objects.filter(account=OuterRef('pk')).order_by().values(
+            'account').annotate(total=Sum('balance')).values('total')
+        pending = Transaction.objects.filter(to_account=OuterRef('pk'), credit_pending=True).order_by().values(
+            'to_account').annotate(total=Sum('amount')).values('total')
+        return self.annotate(current_balance=ExpressionWrapper(
+            F('balance') + Coalesce(Subquery(shards), Value(0)) + Coalesce(Subquery(pending), Value(0)),
+            output_field=DecimalField(max_digits=15, decimal_places=2),
+        ))
+
+    def with_summary_version(self) -> 'AccountQuerySet':
+        """
+        Annotates `version` and `modified_at` of the summary of the account. Its pending `AccountSummaryDelta`s count
+        as the versions they add once folded, so the version changes with every transfer anyway.
+        """
+        pending = AccountSummaryDelta.objects.filter(account=OuterRef('pk')).order_by().values('account').annotate(
+            count=Count('id')).values('count')
+        return self.annotate(
+            version=ExpressionWrapper(Coalesce(F('summary__version'), Value(0)) + Coalesce(Subquery(pending), Value(0)),
+                                      output_field=models.BigIntegerField()),
+            modified_at=F('summary__modified_at'),
+        )
+
 
 class Account(models.Model):
     id = models.TextField(primary_key=True)
+    # in ledger mode credits are appended as pending transactions first, see `Transaction.create_new`
     balance = models.DecimalField(default=0, max_digits=15, decimal_places=2)
     currency = models.ForeignKey('Currency', on_delete=models.PROTECT)
+    # number of `AccountBalanceShard`s holding the funds of a high fan-in account, 0 if not sharded
+    shard_count = models.PositiveSmallIntegerField(default=0)
+
+    objects = AccountQuerySet.as_manager()
+
+    # currency by id of the existing accounts, see `prevalidate_transfer`. The TTL bounds how long a currency changed
+    # by another process keeps rejecting transfers without a read
+    _currency_cache = TieredCache('account-currency', settings.ACCOUNT_CACHE_SIZE,
+                                  ttl=settings.ACCOUNT_CURRENCY_CACHE_TTL, shared=settings.ACCOUNT_SHARED_CACHE)
+    # `with_current_balance` rows by id, invalidated once a transfer touching the account commits. The TTL bounds
+    # the staleness of a row read concurrently with a transfer and cached after it was invalidated.
+    _balance_cache = TieredCache('account-balance', settings.ACCOUNT_CACHE_SIZE,
+                                 ttl=settings.ACCOUNT_BALANCE_CACHE_TTL, shared=settings.ACCOUNT_SHARED_CACHE)
 
     def __str__(self) -> str:
         return self.id
@@ -35,6 +189,218 @@ class Account(models.Model):
         except Account.DoesNotExist:
             raise AccountNotFoundException(f'{account_id} not found')
 
+    @classmethod
+    def get_cached_currencies(cls, account_ids: Iterable[str]) -> Dict[str, str]:
+        """ Currency by id of the cached accounts among `account_ids` """
+        currencies = {account_id: cls._currency_cache.get(account_id) for account_id in set(account_ids)}
+        return {account_id: currency_id for account_id, currency_id in currencies.items() if currency_id is not None}
+
+    @classmethod
+    def prevalidate_transfer(cls, from_account_id: str, to_account_id: str, amount: Decimal,
+                             currency_code: str) -> None:
+        """
+        Rejects transfers which can't succeed before a write transaction is opened and anything is locked: a wrong
+        amount, unknown accounts, a wrong currency or insufficient funds. Costs no query at all for a wrong amount
+        or cached accounts in a wrong currency, a single unlocked read of both accounts otherwise.
+        The checks under the locks in `Transaction._transfer` stay authoritative.
+        """
+        Transaction.check_amount(amount)
+        currencies = cls.get_cached_currencies((from_account_id, to_account_id))
+        if len(currencies) == len({from_account_id, to_account_id}):
+            Transaction.check_currencies(cls(id=from_account_id, currency_id=currencies[from_account_id]),
+                                         cls(id=to_account_id, currency_id=currencies[to_account_id]), currency_code)
+
+        accounts = {}
+        for account_id, currency_id, balance in cls.objects.with_current_balance().filter(
+                id__in={from_account_id, to_account_id}).values_list('id', 'currency_id', 'current_balance'):
+            cls._currency_cache.set(account_id, currency_id)
+            accounts[account_id] = cls(id=account_id, currency_id=currency_id, balance=balance)
+        Transaction.check_transfer(cls.pick_or_raise(accounts, from_account_id),
+                                   cls.pick_or_raise(accounts, to_account_id), amount, currency_code)
+
+    @classmethod
+    def statement_lines(cls, account_id: str) -> QuerySet:
+        """
+        Payments of the account ordered by id, annotated with `signed_amount` (negative for the outgoing ones) and
+        `running_total`: the sum of the signed amounts of the selected payments up to this one, computed by
+        a window function. Filters narrow the selection before the window is computed.
+        """
+        model = Payment.read_model()
+        return model.objects.filter(account_id=account_id).annotate(
+            signed_amount=Payment.signed_amount(),
+            running_total=_DecimalWindow(Sum(Payment.signed_amount()), order_by=F('id').asc()),
+        ).order_by('id')
+
+    @classmethod
+    def balance_before(cls, account_id: str, payment_id: Optional[int]) -> Optional[Decimal]:
+        """
+        Balance of the account right before its payment `payment_id` (the current one if None): the current
+        balance less the payments since, read in a single statement. None if there is no such account.
+        """
+        amount_field = DecimalField(max_digits=15, decimal_places=2)
+        since = Value(0, output_field=amount_field)
+        if payment_id is not None:
+            payments_since = Payment.read_model().objects.filter(account_id=OuterRef('pk'), id__gte=payment_id)
+            total = payments_since.order_by().values('account_id').annotate(
+                total=Sum(Payment.signed_amount())).values('total')
+            since = Coalesce(Subquery(total), since, output_field=amount_field)
+        row = cls.objects.with_current_balance().filter(id=account_id).annotate(since=since).values_list(
+            'current_balance', 'since').first()
+        return None if row is None else row[0] - row[1]
+
+    @classmethod
+    def get_current_balance_row(cls, account_id: str) -> Optional[dict]:
+        """
+        `id`, `current_balance` and `currency_id` of the account with the `version` and `modified_at` of its summary,
+        read through the cache
+        """
+        row = cls._balance_cache.get(account_id)
+        if row is None:
+            row = cls.objects.with_current_balance().with_summary_version().values(
+                'id', 'current_balance', 'currency_id', 'version', 'modified_at').filter(id=account_id).first()
+            if row is not None:
+                cls._balance_cache.set(account_id, row)
+        return row
+
+    @classmethod
+    def invalidate_balances(cls, account_ids: Iterable[str]) -> None:
+        cls._balance_cache.delete_many(account_ids)
+
+    @classmethod
+    def invalidate_balances_on_commit(cls, account_ids: Iterable[str]) -> None:
+        """ Drops the cached balances once the current transaction commits, so they aren't read again before """
+        account_ids = list(account_ids)
+        transaction.on_commit(lambda: cls.invalidate_balances(account_ids))
+
+    def refresh_cache(self) -> None:
+        # a rolled back currency must not reject transfers, it is cached once committed
+        account_id, currency_id = self.id, self.currency_id
+        self._currency_cache.delete_many([account_id])
+        transaction.on_commit(lambda: Account._currency_cache.set(account_id, currency_id))
+        self.invalidate_balances([account_id])
+        self.invalidate_balances_on_commit([account_id])
+
+    def drop_cache(self) -> None:
+        account_id = self.id
+        self._currency_cache.delete_many([account_id])
+        transaction.on_commit(lambda: Account._currency_cache.delete_many([account_id]))
+        self.invalidate_balances([account_id])
+        self.invalidate_balances_on_commit([account_id])
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.shard_count > 0
+
+    @classmethod
+    def lock_in_order(cls: Type[AccountType], account_ids: Iterable[str], *conditions: Q,
+                      **filters) -> Dict[str, AccountType]:
+        """
+        Locks the accounts with a single `SELECT ... FOR UPDATE ORDER BY id`. As every transfer takes its locks
+        in the same order, transfers between the same accounts in opposite directions can't deadlock.
+        """
+        with timed('lock_wait'):
+            return {acc.id: acc for acc in cls.objects.select_for_update().filter(
+                *conditions, id__in=set(account_ids), **filters).order_by('id')}
+
+    @classmethod
+    def lock_for_transfer(cls: Type[AccountType], from_account_id: str, to_account_id: str) -> Dict[str, AccountType]:
+        """
+        Locks the accounts whose row the transfer changes: both of them in order, except the sharded ones (their
+        shards are locked instead) and, in ledger mode, the credited one. A sharded debited account is locked too
+        while its row holds funds, see `AccountBalanceShard.credit`. Accounts which aren't locked are only read,
+        the funds in the row of an unlocked sharded account can't be spent, so they read as 0.
+        """
+        lock_ids = [from_account_id] if settings.LEDGER_MODE else [from_account_id, to_account_id]
+        accounts = cls.lock_in_order(lock_ids, Q(shard_count=0) | Q(id=from_account_id, balance__gt=0))
+        unlocked = {from_account_id, to_account_id} - accounts.keys()
+        if unlocked:
+            for acc in cls.objects.in_bulk(unlocked).values():
+                if acc.is_sharded:
+                    acc.balance = Decimal(0)
+                accounts[acc.id] = acc
+        return accounts
+
+    @classmethod
+    def fold_pending_credits(cls, account_id: str) -> Decimal:
+        """
+        Moves ledger credits of the account which are still pending into its balance snapshot, returns the folded
+        amount. The caller must hold the lock of the account.
+        """
+        pending = list(Transaction.objects.filter(to_account_id=account_id, credit_pending=True).values_list(
+            'id', 'amount'))
+        if not pending:
+            return Decimal(0)
+
+        total = sum(amount for _, amount in pending)
+        Transaction.objects.filter(id__in=[tx_id for tx_id, _ in pending]).update(credit_pending=False)
+        cls.objects.filter(id=account_id).update(balance=F('balance') + total)
+        return total
+
+    @classmethod
+    async def fold_pending_credits_async(cls, conn, account_id: str) -> Decimal:
+        """ `fold_pending_credits` on an `asyncdb` connection, in a single statement """
+        return await conn.fetchval(
+            f'WITH folded AS (UPDATE {Transaction._meta.db_table} SET credit_pending = false '
+            f'WHERE to_account_id = $1 AND credit_pending RETURNING amount), '
+            f'total AS (SELECT COALESCE(SUM(amount), 0) AS amount FROM folded), '
+            f'credited AS (UPDATE {cls._meta.db_table} SET balance = balance + (SELECT amount FROM total) '
+            f'WHERE id = $1) '
+            f'SELECT amount FROM total', account_id)
+
+    @classmethod
+    async def get_current_balance_row_async(cls, account_id: str) -> Optional[dict]:
+        """ `id`, `current_balance` and `currency_id` of the account, see `AccountQuerySet.with_current_balance` """
+        if not asyncdb.is_available():
+            return await asyncdb.in_worker_thread(cls.objects.with_current_balance().values(
+                'id', 'current_balance', 'currency_id').filter(id=account_id).first)()
+
+        pool = await asyncdb.get_pool()
+        row = await pool.fetchrow(
+            f'SELECT a.id, a.currency_id, a.balance '
+            f'+ COALESCE((SELECT SUM(s.balance) FROM {AccountBalanceShard._meta.db_table} s '
+            f'WHERE s.account_id = a.id), 0) '
+            f'+ COALESCE((SELECT SUM(t.amount) FROM {Transaction._meta.db_table} t '
+            f'WHERE t.to_account_id = a.id AND t.credit_pending), 0) AS current_balance '
+            f'FROM {cls._meta.db_table} a WHERE a.id = $1', account_id)
+        return dict(row) if row is not None else None
+
+    @classmethod
+    def split_into_shards(cls, account_id: str, shard_count: int) -> None:
+        """
+        Spreads the funds of the account evenly over `shard_count` balance shards, 0 brings them back into
+        the account balance.
+        """
+        with transaction.atomic():
+            account = cls.pick_or_raise(cls.lock_in_order([account_id]), account_id)
+            total = account.balance + cls.fold_pending_credits(account_id)
+            total += sum(shard.balance for shard in AccountBalanceShard.lock_all(account_id))
+
+            AccountBalanceShard.objects.filter(account_id=account_id).delete()
+            AccountBalanceShard.objects.bulk_create(AccountBalanceShard.spread(account_id, total, shard_count))
+            cls.objects.filter(id=account_id).update(balance=0 if shard_count else total, shard_count=shard_count)
+
+    @staticmethod
+    def pick_or_raise(accounts: Dict[str, AccountType], account_id: str) -> AccountType:
+        try:
+            return accounts[account_id]
+        except KeyError:
+            raise AccountNotFoundException(f'{account_id} not found')
+
+    @classmethod
+    def compact_ledger(cls, limit: int = None) -> int:
+        """ Folds pending credits of up to `limit` accounts into their balances, returns how many were compacted """
+        account_ids = Transaction.objects.filter(credit_pending=True).order_by().values_list(
+            'to_account_id', flat=True).distinct()
+        if limit:
+            account_ids = account_ids[:limit]
+
+        account_ids = list(account_ids)
+        for account_id in account_ids:
+            with transaction.atomic():
+                cls.lock_in_order([account_id])
+                cls.fold_pending_credits(account_id)
+        return len(account_ids)
+
     @property
     def incoming_payments(self) -> Union[QuerySet, List['Transaction']]:
         return Transaction.objects.filter(state=Transaction.STATE_SUCCEED, to_account=self)
@@ -47,105 +413,1063 @@ class Account(models.Model):
         return self.currency_id == currency_code
 
 
+class AccountBalanceShard(models.Model):
+    """
+    Part of the funds of a sharded account. Credits go to a random shard and debits lock only the shards they
+    need, so transfers to and from a high fan-in account don't serialize on a single row lock.
+    """
+    account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='shards')
+    index = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(default=0, max_digits=15, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'index'], name='account_shard_uniq'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.account_id} #{self.index}'
+
+    @classmethod
+    def spread(cls: Type[ShardType], account_id: str, total: Decimal, shard_count: int) -> List[ShardType]:
+        """ Unsaved shards sharing `total` evenly, the cents which don't split evenly go to the first one """
+        if not shard_count:
+            return []
+        share = (total / shard_count).quantize(CENT, rounding=ROUND_DOWN)
+        shards = [cls(account_id=account_id, index=index, balance=share) for index in range(shard_count)]
+        shards[0].balance += total - share * shard_count
+        return shards
+
+    @classmethod
+    def lock_all(cls: Type[ShardType], account_id: str) -> List[ShardType]:
+        with timed('lock_wait'):
+            return list(cls.objects.select_for_update().filter(account_id=account_id).order_by('index'))
+
+    @classmethod
+    def lock_for_debit(cls: Type[ShardType], account_id: str, amount: Decimal) -> List[ShardType]:
+        """
+        Locks only as many shards as needed to cover `amount`, picked richest first by their unlocked balances.
+        If they don't cover it anymore once locked, all shards of the account are locked.
+        """
+        balances = list(cls.objects.filter(account_id=account_id).order_by('-balance').values_list('index', 'balance'))
+        picked, covered = [], Decimal(0)
+        for index, balance in balances:
+            if covered >= amount:
+                break
+            picked.append(index)
+            covered += balance
+
+        with timed('lock_wait'):
+            shards = list(cls.objects.select_for_update().filter(account_id=account_id, index__in=picked).order_by(
+                'index'))
+        if sum(shard.balance for shard in shards) < amount and len(shards) < len(balances):
+            shards = cls.lock_all(account_id)
+        return shards
+
+    @classmethod
+    def debit(cls, shards: List['AccountBalanceShard'], amount: Decimal) -> None:
+        """ Takes `amount` from the locked shards, richest first """
+        remaining = amount
+        for shard in sorted(shards, key=lambda s: s.balance, reverse=True):
+            if remaining <= 0:
+                break
+            taken = min(shard.balance, remaining)
+            cls.objects.filter(pk=shard.pk).update(balance=F('balance') - taken)
+            remaining -= taken
+
+    @classmethod
+    def credit(cls, account: Account, amount: Decimal) -> None:
+        """
+        Adds `amount` to a random shard which no other transaction holds. A credit never waits for a shard, so it
+        can't close a deadlock with a transfer in the opposite direction holding the shards it debits. If all
+        of them are busy the account row is credited, it may wait for a batch or `Account.split_into_shards`
+        holding it (deadlocks with them are retried, see `Transaction._run_atomic`). Debits spend those funds first.
+        """
+        with timed('lock_wait'):
+            shard_id = cls.objects.select_for_update(skip_locked=True).filter(account_id=account.id).order_by(
+                '?').values_list('id', flat=True).first()
+        credited = cls.objects.filter(id=shard_id).update(balance=F('balance') + amount) if shard_id else 0
+        if not credited:
+            # all the shards are busy, or they were changed by `Account.split_into_shards` meanwhile. The balance of
+            # the account row counts anyway
+            Account.objects.filter(id=account.id).update(balance=F('balance') + amount)
+
+
 class Transaction(models.Model):
     STATE_SUCCEED = 'succeed'
     STATE_FAILED = 'failed'
 
     id = models.BigAutoField(primary_key=True)
 
-    from_account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='from_account')
+    # single column index is replaced by (from_account, id), see `Meta.indexes`
+    from_account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='from_account',
+                                     db_index=False)
     to_account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='to_account')
 
     amount = models.DecimalField(max_digits=15, decimal_places=2)
     state = models.CharField(max_length=8, choices=((STATE_FAILED, STATE_FAILED), (STATE_SUCCEED, STATE_SUCCEED)))
+    # ledger mode credit which is not folded into the balance of `to_account` yet
+    credit_pending = models.BooleanField(default=False)
+    # client supplied `Idempotency-Key` the transaction was created with
+    idempotency_key = models.CharField(max_length=IDEMPOTENCY_KEY_MAX_LENGTH, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
 
-    def __str__(self):
-        return f'{self.amount} ({self.account.currency}) from {self.account} to {self.to_account}'
+    # recently created transactions by idempotency key, short-circuits hot client retries
+    _idempotency_cache = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE)
 
-    @classmethod
-    def create_new(cls: Type[TransactionType], *, from_account_id: str, to_account_id: str,
-                   amount: Decimal, currency_code: str) -> Optional[TransactionType]:
-        from_account = Account.get_or_raise(from_account_id)
-        to_account = Account.get_or_raise(to_account_id)
+    class Meta:
+        indexes = [
+            # `Account.outgoing_payments`
+            models.Index(fields=['from_account', 'id'], name='tx_from_account_id_idx'),
+            # `Account.incoming_payments`
+            models.Index(fields=['to_account', 'id'], name='tx_to_account_succeed_idx',
+                         condition=Q(state='succeed')),
+            # ledger tail, see `AccountQuerySet.with_current_balance` and `Account.compact_ledger`
+            models.Index(fields=['to_account', 'id'], name='tx_pending_credit_idx',
+                         condition=Q(credit_pending=True)),
+        ]
+        constraints = [
+            # partial, so transactions created without a key don't bloat the index
+            models.UniqueConstraint(fields=['idempotency_key'], name='tx_idempotency_key_uniq',
+                                    condition=Q(idempotency_key__isnull=False)),
+        ]
 
+    def __str__(self):
+        return f'{self.amount} ({self.from_account.currency_id}) from {self.from_account_id} to {self.to_account_id}'
+
+    @staticmethod
+    def check_currencies(from_account: Account, to_account: Account, currency_code: str) -> None:
         if not from_account.can_use_currency(currency_code):
             raise DifferentCurrenciesException('withdrawal account has currency different from payment currency')
 
         if not to_account.can_use_currency(currency_code):
             raise DifferentCurrenciesException('target account has currency different from payment currency')
 
+    @staticmethod
+    def check_amount(amount: Decimal) -> None:
+        if amount <= 0:
+            raise InvalidAmountException('amount must be positive')
+
+    @classmethod
+    def check_transfer(cls, from_account: Account, to_account: Account, amount: Decimal, currency_code: str) -> None:
+        cls.check_amount(amount)
+        cls.check_currencies(from_account, to_account, currency_code)
+
         if from_account.balance < amount:
             raise InsufficientFundsException('insufficient funds')
 
+    @classmethod
+    def create_new(cls: Type[TransactionType], *, from_account_id: str, to_account_id: str,
+                   amount: Decimal, currency_code: str, idempotency_key: str = None) -> Optional[TransactionType]:
+        """
+        Makes a transfer in stages: replays a known `idempotency_key`, pre-checks the transfer on an unlocked read
+        of both accounts and only then locks them and commits. Rejections are raised as their own API exceptions,
+        almost all of them by the pre-check, without opening a write transaction.
+
+        With an `idempotency_key` a transfer is made at most once: a retry with the same key gets the originally
+        created transaction back, without touching the accounts.
+        """
+        if idempotency_key is not None:
+            replayed = cls.get_by_idempotency_key(idempotency_key)
+            if replayed is not None:
+                return cls._check_replay(replayed, from_account_id, to_account_id, amount, currency_code)
+
+        cls._prevalidate(from_account_id, to_account_id, amount, currency_code)
         try:
-            with transaction.atomic():
-                from_account = Account.objects.select_for_update().filter(id=from_account_id).last()
-                to_account = Account.get_or_raise(to_account_id)
-                if from_account.balance < amount:
-                    raise InsufficientFundsException(f'{from_account_id} has insufficient funds')
-
-                from_account.balance = F('balance') - amount
-                from_account.save()
-                to_account.balance = F('balance') + amount
-                to_account.save()
-
-                tx = cls.objects.create(
-                    from_account=from_account,
-                    to_account=to_account,
-                    amount=amount,
-                    state=cls.STATE_SUCCEED,
-                )
-                Payment.new_incoming_from_transaction(tx)
-                Payment.new_outgoing_from_transaction(tx)
-                return tx
-        except Exception as e:
-            logging.exception(f'Failed to process transaction from {from_account_id} to {to_account_id}: {e}')
-            raise ErrorProcessingException('Unknown exception')
-
-
-class Payment(models.Model):
+            return cls._run_atomic(
+                f'transaction from {from_account_id} to {to_account_id}',
+                cls._transfer, from_account_id, to_account_id, amount, currency_code, idempotency_key,
+            )
+        except ErrorProcessingException:
+            # a concurrent request with the same key may have won the race on the unique index
+            replayed = cls.get_by_idempotency_key(idempotency_key) if idempotency_key is not None else None
+            if replayed is None:
+                raise
+            return cls._check_replay(replayed, from_account_id, to_account_id, amount, currency_code)
+
+    @staticmethod
+    def _prevalidate(from_account_id: str, to_account_id: str, amount: Decimal, currency_code: str) -> None:
+        """
+        `Account.prevalidate_transfer`. If its read fails, e.g. on a locked SQLite table or a dead connection,
+        the checks under the locks decide.
+        """
+        try:
+            Account.prevalidate_transfer(from_account_id, to_account_id, amount, currency_code)
+        except (OperationalError, InterfaceError) as e:
+            logging.warning(f'Transfer pre-check failed: {e}')
+
+    @classmethod
+    def get_by_idempotency_key(cls: Type[TransactionType], idempotency_key: str) -> Optional[TransactionType]:
+        tx = cls._idempotency_cache.get(idempotency_key)
+        if tx is None:
+            # transfers are made in the currency of their accounts
+            tx = cls.objects.filter(idempotency_key=idempotency_key).annotate(
+                currency_code=F('from_account__currency_id')).first()
+            if tx is not None:
+                cls._idempotency_cache.set(idempotency_key, tx)
+        return tx
+
+    @staticmethod
+    def _check_replay(tx: TransactionType, from_account_id: str, to_account_id: str, amount: Decimal,
+                      currency_code: str) -> TransactionType:
+        """
+        Returns the replayed `tx` (a transaction or a queued transfer) if it is the same transfer. Transactions
+        have no currency of their own, their `currency_code` is the one of their accounts set when they are cached.
+        """
+        if ((tx.from_account_id, tx.to_account_id, tx.amount, tx.currency_code) !=
+                (from_account_id, to_account_id, amount, currency_code)):
+            raise IdempotencyKeyReusedException(f'idempotency key {tx.idempotency_key} was used for another transfer')
+        return tx
+
+    @classmethod
+    def _transfer(cls: Type[TransactionType], from_account_id: str, to_account_id: str,
+                  amount: Decimal, currency_code: str, idempotency_key: Optional[str]) -> TransactionType:
+        # in ledger mode the credit is only appended, so hot receivers don't serialize transfers on their row lock,
+        # sharded accounts avoid that by spreading their funds over several rows
+        accounts = Account.lock_for_transfer(from_account_id, to_account_id)
+        try:
+            from_account = Account.pick_or_raise(accounts, from_account_id)
+            to_account = Account.pick_or_raise(accounts, to_account_id)
+            debited_shards, from_row = None, Decimal(0)
+            if from_account.is_sharded:
+                # funds of a sharded account are in its shards, only the locked ones can be spent, and in its row when
+                # credits found all the shards busy. Those are spent first, the shards are locked after the row.
+                from_row = min(from_account.balance, amount)
+                debited_shards = (AccountBalanceShard.lock_for_debit(from_account_id, amount - from_row)
+                                  if from_row < amount else [])
+                from_account.balance += sum(shard.balance for shard in debited_shards)
+            elif settings.LEDGER_MODE and from_account.balance < amount:
+                from_account.balance += Account.fold_pending_credits(from_account_id)
+            cls.check_transfer(from_account, to_account, amount, currency_code)
+        except TRANSFER_REJECTIONS as e:
+            raise _TransferRejected(e)
+
+        if debited_shards is not None:
+            if from_row:
+                Account.objects.filter(id=from_account_id).update(balance=F('balance') - from_row)
+            AccountBalanceShard.debit(debited_shards, amount - from_row)
+        else:
+            Account.objects.filter(id=from_account_id).update(balance=F('balance') - amount)
+
+        credit_pending = False
+        if to_account.is_sharded:
+            AccountBalanceShard.credit(to_account, amount)
+        elif settings.LEDGER_MODE:
+            credit_pending = True
+        else:
+            Account.objects.filter(id=to_account_id).update(balance=F('balance') + amount)
+
+        tx = cls(
+            from_account_id=from_account_id,
+            to_account_id=to_account_id,
+            amount=amount,
+            state=cls.STATE_SUCCEED,
+            credit_pending=credit_pending,
+            idempotency_key=idempotency_key,
+        )
+        tx.currency_code = currency_code
+        # the summary rows of the accounts the ledger or the shards take the load off would serialize their transfers
+        # again, the totals are appended instead
+        deferred = {acc.id for acc in (from_account, to_account) if acc.is_sharded}
+        if credit_pending:
+            deferred.add(to_account_id)
+        cls._insert_with_payments(tx, deferred)
+        Account.invalidate_balances_on_commit((from_account_id, to_account_id))
+        if idempotency_key is not None:
+            transaction.on_commit(lambda: cls._idempotency_cache.set(idempotency_key, tx))
+        return tx
+
+    @classmethod
+    async def create_new_async(cls: Type[TransactionType], *, from_account_id: str, to_account_id: str,
+                               amount: Decimal, currency_code: str,
+                               idempotency_key: str = None) -> Optional[TransactionType]:
+        """
+        Asyncio version of `create_new`. On PostgreSQL with asyncpg installed the transfer runs on a connection of
+        the `asyncdb` pool, so waiting for the row locks holds no thread. Otherwise, and for sharded accounts,
+        `create_new` is run in a worker thread.
+        """
+        transfer = dict(from_account_id=from_account_id, to_account_id=to_account_id, amount=amount,
+                        currency_code=currency_code, idempotency_key=idempotency_key)
+        if asyncdb.is_available():
+            pool = await asyncdb.get_pool()
+            async with pool.acquire() as conn:
+                try:
+                    return await cls._create_new_native(conn, **transfer)
+                except _AsyncUnsupported:
+                    pass
+        return await asyncdb.in_worker_thread(cls.create_new)(**transfer)
+
+    @classmethod
+    async def _create_new_native(cls: Type[TransactionType], conn, *, from_account_id: str, to_account_id: str,
+                                 amount: Decimal, currency_code: str,
+                                 idempotency_key: Optional[str]) -> TransactionType:
+        if idempotency_key is not None:
+            replayed = await cls.get_by_idempotency_key_async(conn, idempotency_key)
+            if replayed is not None:
+                return cls._check_replay(replayed, from_account_id, to_account_id, amount, currency_code)
+
+        # an unlocked read, it doesn't hold the thread for long
+        await asyncdb.in_worker_thread(cls._prevalidate)(
+            from_account_id, to_account_id, amount, currency_code)
+        try:
+            tx = await cls._run_atomic_async(
+                conn, f'transaction from {from_account_id} to {to_account_id}',
+                cls._transfer_async, from_account_id, to_account_id, amount, currency_code, idempotency_key,
+            )
+        except ErrorProcessingException:
+            # a concurrent request with the same key may have won the race on the unique index
+            replayed = None
+            if idempotency_key is not None:
+                replayed = await cls.get_by_idempotency_key_async(conn, idempotency_key)
+            if replayed is None:
+                raise
+            return cls._check_replay(replayed, from_account_id, to_account_id, amount, currency_code)
+
+        # committed, so the cached balances are stale now
+        await sync_to_async(Account.invalidate_balances, thread_sensitive=False)((from_account_id, to_account_id))
+        if idempotency_key is not None:
+            cls._idempotency_cache.set(idempotency_key, tx)
+        return tx
+
+    @classmethod
+    async def get_by_idempotency_key_async(cls: Type[TransactionType], conn,
+                                           idempotency_key: str) -> Optional[TransactionType]:
+        tx = cls._idempotency_cache.get(idempotency_key)
+        if tx is None:
+            row = await conn.fetchrow(
+                f'SELECT t.id, t.from_account_id, t.to_account_id, t.amount, t.state, t.credit_pending, '
+                f't.idempotency_key, t.created_at, a.currency_id FROM {cls._meta.db_table} t '
+                f'JOIN {Account._meta.db_table} a ON a.id = t.from_account_id WHERE t.idempotency_key = $1',
+                idempotency_key)
+            if row is not None:
+                row = dict(row)
+                currency_code = row.pop('currency_id')
+                tx = cls(**row)
+                tx.currency_code = currency_code
+                cls._idempotency_cache.set(idempotency_key, tx)
+        return tx
+
+    @classmethod
+    async def _transfer_async(cls: Type[TransactionType], conn, from_account_id: str, to_account_id: str,
+                              amount: Decimal, currency_code: str, idempotency_key: Optional[str]) -> TransactionType:
+        """ `_transfer` in raw SQL, same locks and checks """
+        account_table = Account._meta.db_table
+        select = f'SELECT id, balance, currency_id, shard_count FROM {account_table} WHERE id = ANY($1::text[])'
+
+        lock_ids = [from_account_id] if settings.LEDGER_MODE else [from_account_id, to_account_id]
+        with timed('lock_wait'):
+            rows = await conn.fetch(f'{select} AND shard_count = 0 ORDER BY id FOR UPDATE', lock_ids)
+        accounts = {row['id']: Account(**dict(row)) for row in rows}
+        unlocked = {from_account_id, to_account_id} - accounts.keys()
+        if unlocked:
+            accounts.update({row['id']: Account(**dict(row)) for row in await conn.fetch(select, list(unlocked))})
+
+        try:
+            from_account = Account.pick_or_raise(accounts, from_account_id)
+            to_account = Account.pick_or_raise(accounts, to_account_id)
+            if from_account.is_sharded or to_account.is_sharded:
+                raise _AsyncUnsupported()
+            if settings.LEDGER_MODE and from_account.balance < amount:
+                from_account.balance += await Account.fold_pending_credits_async(conn, from_account_id)
+            cls.check_transfer(from_account, to_account, amount, currency_code)
+        except TRANSFER_REJECTIONS as e:
+            raise _TransferRejected(e)
+
+        await conn.execute(f'UPDATE {account_table} SET balance = balance - $2 WHERE id = $1', from_account_id, amount)
+        credit_pending = bool(settings.LEDGER_MODE)
+        if not credit_pending:
+            await conn.execute(f'UPDATE {account_table} SET balance = balance + $2 WHERE id = $1',
+                               to_account_id, amount)
+
+        tx = cls(
+            from_account_id=from_account_id,
+            to_account_id=to_account_id,
+            amount=amount,
+            state=cls.STATE_SUCCEED,
+            credit_pending=credit_pending,
+            idempotency_key=idempotency_key,
+        )
+        tx.currency_code = currency_code
+        tx.id = await conn.fetchval(
+            f'INSERT INTO {cls._meta.db_table} '
+            f'(from_account_id, to_account_id, amount, state, credit_pending, idempotency_key, created_at) '
+            f'VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id',
+            tx.from_account_id, tx.to_account_id, tx.amount, tx.state, tx.credit_pending, tx.idempotency_key,
+            tx.created_at)
+        if settings.SINGLE_ROW_PAYMENTS:
+            payments = DerivedPayment.build_for_transaction(tx)
+        else:
+            payments = list(Payment.build_for_transaction(tx))
+            columns = ('id', 'transaction_id', 'direction', 'account_id', 'from_account_id', 'to_account_id',
+                       'amount', 'created_at')
+            await conn.execute(
+                f'INSERT INTO {Payment._meta.db_table} ({", ".join(columns)}) '
+                f'VALUES {_placeholders(len(payments), 8)}',
+                *chain.from_iterable([getattr(p, c) for c in columns] for p in payments))
+
+        deltas = AccountSummary.deltas(payments)
+        if credit_pending:
+            # see `_transfer`
+            pending = AccountSummaryDelta.of(deltas.pop(to_account_id))
+            columns = ('account_id',) + AccountSummary.TOTALS
+            await conn.execute(
+                f'INSERT INTO {AccountSummaryDelta._meta.db_table} ({", ".join(columns)}) '
+                f'VALUES {_placeholders(1, len(columns))}', *(getattr(pending, c) for c in columns))
+        deltas = deltas.values()
+        columns = ('account_id', 'total_in', 'total_out', 'count_in', 'count_out', 'last_payment_id', 'version',
+                   'modified_at')
+        await conn.execute(
+            f'INSERT INTO {AccountSummary._meta.db_table} AS s ({", ".join(columns)}) '
+            f'VALUES {_placeholders(len(deltas), 8)} ON CONFLICT (account_id) DO UPDATE SET '
+            f'total_in = s.total_in + EXCLUDED.total_in, total_out = s.total_out + EXCLUDED.total_out, '
+            f'count_in = s.count_in + EXCLUDED.count_in, count_out = s.count_out + EXCLUDED.count_out, '
+            f'last_payment_id = GREATEST(s.last_payment_id, EXCLUDED.last_payment_id), '
+            f'version = s.version + 1, modified_at = EXCLUDED.modified_at',
+            *chain.from_iterable([getattr(d, c) for c in columns] for d in deltas))
+        return tx
+
+    @staticmethod
+    async def _run_atomic_async(conn, description: str, func: Callable[..., T], *args) -> T:
+        """ `_run_atomic` on an `asyncdb` connection: the backoff between retries doesn't block the event loop """
+        retries = settings.TRANSFER_LOCK_RETRIES
+        for attempt in count():
+            try:
+                async with conn.transaction():
+                    return await func(conn, *args)
+            except _TransferRejected as rejection:
+                raise rejection.reason
+            except _AsyncUnsupported:
+                raise
+            except Exception as e:
+                if attempt < retries and asyncdb.is_lock_conflict(e):
+                    transfer_lock_retries.inc()
+                    await asyncio.sleep(settings.TRANSFER_LOCK_RETRY_BACKOFF * 2 ** attempt * random.random())
+                    continue
+                logging.exception(f'Failed to process {description}: {e}')
+                raise ErrorProcessingException('Unknown exception')
+
+    @classmethod
+    def create_batch(cls: Type[TransactionType], transfers: List[Transfer]) -> List[TransferOutcome]:
+        """
+        Batched version of `create_new`: every affected account is locked once (ordered by id, so concurrent
+        batches can't deadlock on each other), balances are moved in memory and all rows are written with
+        a handful of bulk statements. Transfers are applied in the given order, so an earlier transfer may fund
+        a later one. Business rejections are reported per transfer and don't affect the rest of the batch.
+        """
+        if not transfers:
+            return []
+        return cls._run_atomic(f'batch of {len(transfers)} transactions', cls._transfer_batch, transfers)
+
+    @classmethod
+    def _transfer_batch(cls: Type[TransactionType], transfers: List[Transfer]) -> List[TransferOutcome]:
+        accounts = Account.lock_in_order({t.from_account_id for t in transfers} | {t.to_account_id for t in transfers})
+        # a batch locks sharded accounts completely and works with their total, see the end of the method
+        shards = {}
+        with timed('lock_wait'):
+            locked_shards = list(AccountBalanceShard.objects.select_for_update().filter(
+                account_id__in=[acc.id for acc in accounts.values() if acc.is_sharded]).order_by('account_id', 'index'))
+        for shard in locked_shards:
+            shards.setdefault(shard.account_id, []).append(shard)
+            accounts[shard.account_id].balance += shard.balance
+        initial_balances = {acc_id: acc.balance for acc_id, acc in accounts.items()}
+
+        outcomes = []
+        for t in transfers:
+            try:
+                from_account = Account.pick_or_raise(accounts, t.from_account_id)
+                to_account = Account.pick_or_raise(accounts, t.to_account_id)
+                if settings.LEDGER_MODE and not from_account.is_sharded and from_account.balance < t.amount:
+                    folded = Account.fold_pending_credits(from_account.id)
+                    from_account.balance += folded
+                    initial_balances[from_account.id] += folded
+                cls.check_transfer(from_account, to_account, t.amount, t.currency_code)
+            except TRANSFER_REJECTIONS as e:
+                outcomes.append(TransferOutcome(None, e))
+                continue
+
+            from_account.balance -= t.amount
+            to_account.balance += t.amount
+            outcomes.append(TransferOutcome(cls(
+                from_account=from_account,
+                to_account=to_account,
+                amount=t.amount,
+                state=cls.STATE_SUCCEED,
+                idempotency_key=t.idempotency_key,
+            ), None))
+
+        # rows are locked, so writing absolute balances is safe here
+        changed = [acc for acc_id, acc in accounts.items() if acc.balance != initial_balances[acc_id]]
+        changed_shards = []
+        for acc in changed:
+            if acc.is_sharded:
+                # spread the new total evenly again, all the shards are locked anyway
+                for shard, spread in zip(shards[acc.id], AccountBalanceShard.spread(acc.id, acc.balance,
+                                                                                    acc.shard_count)):
+                    shard.balance = spread.balance
+                    changed_shards.append(shard)
+                acc.balance = Decimal(0)
+        Account.objects.bulk_update(changed, ['balance'])
+        AccountBalanceShard.objects.bulk_update(changed_shards, ['balance'])
+        Account.invalidate_balances_on_commit(acc.id for acc in changed)
+
+        created = [o.transaction for o in outcomes if o.transaction is not None]
+        cls._bulk_insert(created)
+        cls._write_payments(created)
+        return outcomes
+
+    @staticmethod
+    def _run_atomic(description: str, func: Callable[..., T], *args) -> T:
+        """
+        Runs `func` in its own DB transaction. Deadlocks and serialization failures are retried with
+        a jittered backoff (unless we are nested in an outer transaction, which is aborted by then),
+        rejections are raised as is and anything else is reported as `ErrorProcessingException`.
+        """
+        retries = 0 if connection.in_atomic_block else settings.TRANSFER_LOCK_RETRIES
+        for attempt in count():
+            try:
+                with transaction.atomic():
+                    return func(*args)
+            except _TransferRejected as rejection:
+                raise rejection.reason
+            except TRANSFER_REJECTIONS:
+                # raised by the code of the transfer without `_TransferRejected`, still a rejection
+                raise
+            except OperationalError as e:
+                if attempt < retries and is_lock_conflict(e):
+                    transfer_lock_retries.inc()
+                    time.sleep(settings.TRANSFER_LOCK_RETRY_BACKOFF * 2 ** attempt * random.random())
+                    continue
+                logging.exception(f'Failed to process {description}: {e}')
+                raise ErrorProcessingException('Unknown exception') from e
+            except Exception as e:
+                logging.exception(f'Failed to process {description}: {e}')
+                raise ErrorProcessingException('Unknown exception') from e
+
+    @classmethod
+    def _insert_with_payments(cls, tx: TransactionType, deferred: Iterable[str] = ()) -> None:
+        """
+        Inserts the new `tx`, its payments and updates the summaries of its accounts (see
+        `AccountSummary.add_payments` for the `deferred` ones). On PostgreSQL the stored payments are inserted by
+        the same statement as the transaction, from the id its CTE returns.
+        """
+        if connection.vendor != 'postgresql' or settings.SINGLE_ROW_PAYMENTS:
+            tx.save(force_insert=True)
+            cls._write_payments([tx], deferred)
+            return
+
+        columns = ('from_account_id', 'to_account_id', 'amount', 'state', 'credit_pending', 'idempotency_key',
+                   'created_at')
+        payment_columns = ('id', 'transaction_id', 'direction', 'account_id', 'from_account_id', 'to_account_id',
+                           'amount', 'created_at')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'WITH tx AS (INSERT INTO {cls._meta.db_table} ({", ".join(columns)}) '
+                f'VALUES ({", ".join(f"%({c})s" for c in columns)}) RETURNING id) '
+                f'INSERT INTO {Payment._meta.db_table} ({", ".join(payment_columns)}) '
+                f"SELECT id * 2, id, '{Payment.INCOMING}', %(to_account_id)s, %(from_account_id)s, NULL, %(amount)s, "
+                f'%(created_at)s FROM tx UNION ALL '
+                f"SELECT id * 2 + 1, id, '{Payment.OUTGOING}', %(from_account_id)s, NULL, %(to_account_id)s, "
+                f'%(amount)s, %(created_at)s FROM tx RETURNING transaction_id',
+                {c: getattr(tx, c) for c in columns})
+            tx.id = cursor.fetchone()[0]
+        tx._state.adding, tx._state.db = False, connection.alias
+        # last, so the summary row of a hot receiving account is locked only until the commit
+        AccountSummary.add_payments(Payment.build_for_transaction(tx), deferred)
+
+    @classmethod
+    def _write_payments(cls, txs: List[TransactionType], deferred: Iterable[str] = ()) -> None:
+        """ Payments of the saved `txs` and the summaries of their accounts, see `AccountSummary.add_payments` """
+        if settings.SINGLE_ROW_PAYMENTS:
+            payments = list(chain.from_iterable(DerivedPayment.build_for_transaction(tx) for tx in txs))
+        else:
+            payments = list(chain.from_iterable(Payment.build_for_transaction(tx) for tx in txs))
+            # the ids come from the transactions, nothing to return
+            Payment.objects.bulk_create(payments)
+        # last, so the summary row of a hot receiving account is locked only until the commit
+        AccountSummary.add_payments(payments, deferred)
+
+    @staticmethod
+    def _bulk_insert(objects: List[models.Model]) -> None:
+        """ Bulk insert which sets the primary keys of the `objects`, all of the same model """
+        if not objects:
+            return
+        if connection.features.can_return_rows_from_bulk_insert:
+            type(objects[0]).objects.bulk_create(objects)
+            return
+
+        # backends that can't return primary keys from a bulk insert (e.g. SQLite) fall back to row by row inserts
+        for obj in objects:
+            obj.save(force_insert=True)
+
+
+class _PaymentMixin:
+    """
+    Payment rows of a transaction, shared by the stored `Payment` and the `DerivedPayment`. Both get the ids
+    `2 * transaction id` (incoming) and `2 * transaction id + 1` (outgoing), whichever way the payments are stored.
+    """
+
+    def __str__(self) -> str:
+        if self.direction == self.INCOMING:
+            return f'{self.account_id} {self.direction} {self.account_id} from {self.from_account_id}'
+        return f'{self.account_id} {self.direction} {self.account_id} to {self.to_account_id}'
+
+    @classmethod
+    def build_for_transaction(cls: Type[PaymentType], tx: Transaction) -> Iterable[PaymentType]:
+        return cls.build_incoming(tx), cls.build_outgoing(tx)
+
+    @classmethod
+    def build_incoming(cls: Type[PaymentType], tx: Transaction) -> PaymentType:
+        return cls(
+            id=tx.id * 2,
+            transaction=tx,
+            direction=cls.INCOMING,
+            account_id=tx.to_account_id,
+            from_account_id=tx.from_account_id,
+            to_account_id=None,
+            amount=tx.amount,
+            created_at=tx.created_at,
+        )
+
+    @classmethod
+    def build_outgoing(cls: Type[PaymentType], tx: Transaction) -> PaymentType:
+        return cls(
+            id=tx.id * 2 + 1,
+            transaction=tx,
+            direction=cls.OUTGOING,
+            account_id=tx.from_account_id,
+            to_account_id=tx.to_account_id,
+            from_account_id=None,
+            amount=tx.amount,
+            created_at=tx.created_at,
+        )
+
+
+class Payment(_PaymentMixin, models.Model):
     INCOMING = 'incoming'
     OUTGOING = 'outgoing'
 
+    # derived from the id of the transaction, see `_PaymentMixin`
+    id = models.BigIntegerField(primary_key=True)
     transaction = models.ForeignKey('Transaction', on_delete=models.CASCADE)
     direction = models.CharField(max_length=10, choices=((INCOMING, INCOMING), (OUTGOING, OUTGOING)))
-    account = models.ForeignKey('Account', on_delete=models.PROTECT, related_name='account')
-    from_account = models.ForeignKey('Account', on_delete=models.PROTECT, null=True, related_name='from_account+')
-    to_account = models.ForeignKey('Account', on_delete=models.PROTECT, null=True, related_name='to_account+')
+    # single column indexes of the accounts are replaced by the composite ones, see `Meta.indexes`
+    account = models.ForeignKey('Account', on_delete=models.PROTECT, related_name='account', db_index=False)
+    from_account = models.ForeignKey('Account', on_delete=models.PROTECT, null=True, related_name='from_account+',
+                                     db_index=False)
+    to_account = models.ForeignKey('Account', on_delete=models.PROTECT, null=True, related_name='to_account+',
+                                   db_index=False)
     amount = models.DecimalField(max_digits=15, decimal_places=2)
+    # same as the one of the transaction, the key of the monthly partitions on PostgreSQL, see `partitions`
+    created_at = models.DateTimeField(default=timezone.now)
 
-    def __str__(self) -> str:
-        if self.direction == self.INCOMING:
-            return f'{self.account} {self.direction} {self.account} from {self.from_account}'
-        return f'{self.account} {self.direction} {self.account} to {self.to_account}'
+    class Meta:
+        # `PaymentFilter` access paths, all of them ordered by id for the cursor pagination
+        indexes = [
+            models.Index(fields=['account', 'id'], name='payment_account_id_idx'),
+            models.Index(fields=['account', 'direction', 'id'], name='payment_account_dir_id_idx'),
+            # half of the payments have no `from_account` / `to_account`, so there is no point to index them
+            models.Index(fields=['from_account', 'id'], name='payment_from_account_id_idx',
+                         condition=Q(from_account__isnull=False)),
+            models.Index(fields=['to_account', 'id'], name='payment_to_account_id_idx',
+                         condition=Q(to_account__isnull=False)),
+        ]
 
     def save(self, **kwargs):
         # sanity check for field correctness
-        if self.direction == self.INCOMING and not self.from_account:
+        if self.direction == self.INCOMING and not self.from_account_id:
             raise Exception(f'`from_account` is missed for {self.direction}')
-        if self.direction == self.OUTGOING and not self.to_account:
+        if self.direction == self.OUTGOING and not self.to_account_id:
             raise Exception(f'`to_account` is missed for {self.direction}')
 
         super().save(**kwargs)
 
+    @classmethod
+    def signed_amount(cls) -> Case:
+        """ Change of the balance of the account by the payment """
+        return Case(When(direction=cls.OUTGOING, then=-F('amount')), default=F('amount'),
+                    output_field=DecimalField(max_digits=15, decimal_places=2))
+
+    @staticmethod
+    def read_model() -> Type[Union['Payment', 'DerivedPayment']]:
+        """ Model the payments are read from, see `SINGLE_ROW_PAYMENTS` """
+        return DerivedPayment if settings.SINGLE_ROW_PAYMENTS else Payment
+
+    @classmethod
+    def copy_derived(cls) -> int:
+        """
+        Stores the payments of the transactions made with `SINGLE_ROW_PAYMENTS`, i.e. of the ones which have no
+        stored payments, with the same ids. Returns how many were stored
+        """
+        columns = ', '.join(('id', 'transaction_id', 'direction', 'account_id', 'from_account_id', 'to_account_id',
+                             'amount', 'created_at'))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {cls._meta.db_table} ({columns}) SELECT {columns} FROM {DerivedPayment._meta.db_table} d '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {cls._meta.db_table} p WHERE p.transaction_id = d.transaction_id) '
+                f'ORDER BY d.id')
+            return cursor.rowcount
+
     @classmethod
     def new_incoming_from_transaction(cls: Type[PaymentType], tx: Transaction) -> PaymentType:
-        return cls.objects.create(
-            transaction=tx,
-            direction=cls.INCOMING,
-            account=tx.to_account,
-            from_account=tx.from_account,
-            to_account=None,
-            amount=tx.amount,
-        )
+        payment = cls.build_incoming(tx)
+        payment.save()
+        AccountSummary.add_payments([payment])
+        return payment
 
     @classmethod
     def new_outgoing_from_transaction(cls: Type[PaymentType], tx: Transaction) -> PaymentType:
-        return cls.objects.create(
-            transaction=tx,
-            direction=cls.OUTGOING,
-            account=tx.from_account,
-            to_account=tx.to_account,
-            from_account=None,
-            amount=tx.amount,
+        payment = cls.build_outgoing(tx)
+        payment.save()
+        AccountSummary.add_payments([payment])
+        return payment
+
+
+class DerivedPayment(_PaymentMixin, models.Model):
+    """
+    Read-only `Payment` rows derived from the transactions by a DB view (migration 0009): an incoming and
+    an outgoing row per succeeded transaction, with the ids the stored payments get (see `_PaymentMixin`),
+    so switching the storage mode keeps the payment ids and cursors. Payments are read from it with
+    `SINGLE_ROW_PAYMENTS`, where transfers don't write `Payment` rows at all.
+    """
+    INCOMING = Payment.INCOMING
+    OUTGOING = Payment.OUTGOING
+
+    id = models.BigIntegerField(primary_key=True)
+    transaction = models.ForeignKey('Transaction', on_delete=models.DO_NOTHING, db_constraint=False,
+                                    related_name='+')
+    direction = models.CharField(max_length=10, choices=((INCOMING, INCOMING), (OUTGOING, OUTGOING)))
+    account = models.ForeignKey('Account', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    from_account = models.ForeignKey('Account', on_delete=models.DO_NOTHING, db_constraint=False, null=True,
+                                     related_name='+')
+    to_account = models.ForeignKey('Account', on_delete=models.DO_NOTHING, db_constraint=False, null=True,
+                                   related_name='+')
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    created_at = models.DateTimeField()
+
+    # name and columns of the expression indexes the view is filtered and ordered by, the conditions on the ids of
+    # the view only match indexes on the very same expressions. Costly for writes, so only made in this mode,
+    # see `manage.py payment_storage`
+    TRANSACTION_INDEXES = (
+        ('tx_derived_in_idx', '(to_account_id, (id * 2))'),
+        ('tx_derived_in_from_idx', '(from_account_id, (id * 2))'),
+        ('tx_derived_in_all_idx', '((id * 2))'),
+        ('tx_derived_out_idx', '(from_account_id, (id * 2 + 1))'),
+        ('tx_derived_out_to_idx', '(to_account_id, (id * 2 + 1))'),
+        ('tx_derived_out_all_idx', '((id * 2 + 1))'),
+    )
+
+    class Meta:
+        managed = False
+        db_table = 'core_derived_payment'
+
+    @classmethod
+    def create_indexes(cls) -> None:
+        """
+        Indexes of the transactions behind the `PaymentFilter` access paths of the view. Created CONCURRENTLY on
+        PostgreSQL, which can't run inside a transaction, the same goes for `drop_indexes`.
+        """
+        concurrently = ' CONCURRENTLY' if connection.vendor == 'postgresql' else ''
+        with connection.cursor() as cursor:
+            for name, columns in cls.TRANSACTION_INDEXES:
+                cursor.execute(f'CREATE INDEX{concurrently} IF NOT EXISTS {name} ON {Transaction._meta.db_table} '
+                               f"{columns} WHERE state = '{Transaction.STATE_SUCCEED}'")
+
+    @classmethod
+    def drop_indexes(cls) -> None:
+        concurrently = ' CONCURRENTLY' if connection.vendor == 'postgresql' else ''
+        with connection.cursor() as cursor:
+            for name, _ in cls.TRANSACTION_INDEXES:
+                cursor.execute(f'DROP INDEX{concurrently} IF EXISTS {name}')
+
+
+class QueuedTransfer(models.Model):
+    """
+    Transfer accepted in queue mode (`TRANSFER_QUEUE_MODE`) and made later by `manage.py process_transfer_queue`
+    workers, many at once with `Transaction.create_batch` logic
+    """
+    STATE_QUEUED = 'queued'
+
+    id = models.BigAutoField(primary_key=True)
+    # plain ids, the accounts are checked when the transfer is made
+    from_account_id = models.TextField()
+    to_account_id = models.TextField()
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    currency_code = models.CharField(max_length=3)
+    idempotency_key = models.CharField(max_length=IDEMPOTENCY_KEY_MAX_LENGTH, null=True)
+
+    state = models.CharField(max_length=8, default=STATE_QUEUED, choices=(
+        (STATE_QUEUED, STATE_QUEUED), (Transaction.STATE_SUCCEED, Transaction.STATE_SUCCEED),
+        (Transaction.STATE_FAILED, Transaction.STATE_FAILED)))
+    transaction = models.ForeignKey('Transaction', on_delete=models.SET_NULL, null=True)
+    error = models.TextField(null=True)
+
+    class Meta:
+        indexes = [
+            # the queue itself, done transfers drop out of it
+            models.Index(fields=['id'], name='queued_transfer_pending_idx', condition=Q(state='queued')),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['idempotency_key'], name='queued_transfer_idempotency_key_uniq',
+                                    condition=Q(idempotency_key__isnull=False)),
+        ]
+
+    def __str__(self) -> str:
+        return f'#{self.id} {self.amount} ({self.currency_code}) from {self.from_account_id} to {self.to_account_id}'
+
+    @classmethod
+    def enqueue(cls: Type[QueuedType], *, from_account_id: str, to_account_id: str, amount: Decimal,
+                currency_code: str, idempotency_key: str = None) -> QueuedType:
+        """ With an `idempotency_key` a retry gets the originally queued transfer back """
+        fields = dict(from_account_id=from_account_id, to_account_id=to_account_id, amount=amount,
+                      currency_code=currency_code, idempotency_key=idempotency_key)
+        if idempotency_key is None:
+            return cls.objects.create(**fields)
+
+        queued = cls.objects.filter(idempotency_key=idempotency_key).first()
+        if queued is None:
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(**fields)
+            except IntegrityError:
+                # a concurrent request with the same key won the race on the unique index
+                queued = cls.objects.get(idempotency_key=idempotency_key)
+        return Transaction._check_replay(queued, from_account_id, to_account_id, amount, currency_code)
+
+    @property
+    def is_done(self) -> bool:
+        return self.state != self.STATE_QUEUED
+
+    def as_transfer(self) -> Transfer:
+        return Transfer(self.from_account_id, self.to_account_id, self.amount, self.currency_code,
+                        self.idempotency_key)
+
+    @classmethod
+    def process(cls, limit: int) -> int:
+        """
+        Makes up to `limit` oldest queued transfers in a single DB transaction, returns how many were processed.
+        Each account is locked once for the whole batch, concurrent workers skip the transfers claimed by others.
+        If the batch fails as a whole, its transfers are made one by one so a broken one can't block the rest.
+        A transfer which fails for a lock conflict or a lost connection stays queued for the next run.
+        """
+        try:
+            return Transaction._run_atomic(f'batch of up to {limit} queued transfers', cls._process, limit, [])
+        except ErrorProcessingException:
+            if limit == 1:
+                raise
+
+        processed = 0
+        for _ in range(limit):
+            claimed = []
+            try:
+                done = Transaction._run_atomic('queued transfer', cls._process, 1, claimed)
+            except TRANSFER_REJECTIONS + (ErrorProcessingException,) as e:
+                if not claimed:
+                    raise
+                if isinstance(e.__cause__, (OperationalError, InterfaceError)):
+                    # transient, left after the retries of `_run_atomic`
+                    break
+                done = cls.objects.filter(id=claimed[0], state=cls.STATE_QUEUED).update(
+                    state=Transaction.STATE_FAILED, error=str(e))
+            if not done:
+                break
+            processed += done
+        return processed
+
+    @classmethod
+    def _process(cls, limit: int, claimed: List[int]) -> int:
+        queued = list(cls.objects.select_for_update(skip_locked=True).filter(state=cls.STATE_QUEUED).order_by(
+            'id')[:limit])
+        # only the claims of the last attempt, `_run_atomic` may retry with other transfers claimed
+        claimed[:] = [q.id for q in queued]
+        if not queued:
+            return 0
+
+        outcomes = Transaction._transfer_batch([q.as_transfer() for q in queued])
+        for q, outcome in zip(queued, outcomes):
+            if outcome.error is not None:
+                q.state, q.error = Transaction.STATE_FAILED, str(outcome.error)
+            else:
+                q.state, q.transaction = Transaction.STATE_SUCCEED, outcome.transaction
+        cls.objects.bulk_update(queued, ['state', 'transaction', 'error'])
+        return len(queued)
+
+
+class AccountSummary(models.Model):
+    """
+    Payment totals of an account, maintained in the same DB transaction as its payments are created in, except for
+    the hot accounts whose totals are appended as `AccountSummaryDelta`s first.
+    Accounts without payments may have no summary yet.
+    """
+    TOTALS = ('total_in', 'total_out', 'count_in', 'count_out', 'last_payment_id')
+
+    account = models.OneToOneField('Account', on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    total_in = models.DecimalField(default=0, max_digits=17, decimal_places=2)
+    total_out = models.DecimalField(default=0, max_digits=17, decimal_places=2)
+    count_in = models.BigIntegerField(default=0)
+    count_out = models.BigIntegerField(default=0)
+    last_payment_id = models.BigIntegerField(null=True)
+    # bumped by every transfer of the account, validates the cached responses of its reads, see `versions`
+    version = models.BigIntegerField(default=0)
+    modified_at = models.DateTimeField(null=True)
+
+    def __str__(self) -> str:
+        return f'{self.account_id}: in {self.total_in} ({self.count_in}), out {self.total_out} ({self.count_out})'
+
+    @classmethod
+    def deltas(cls: Type[SummaryType], payments: Iterable[Payment]) -> Dict[str, SummaryType]:
+        """ Unsaved summaries of just the `payments`, by account id """
+        summaries, now = {}, timezone.now()
+        for p in payments:
+            summary = summaries.get(p.account_id)
+            if summary is None:
+                summary = summaries[p.account_id] = cls(account_id=p.account_id, total_in=Decimal(0),
+                                                        total_out=Decimal(0), version=1, modified_at=now)
+            if p.direction == Payment.INCOMING:
+                summary.total_in += p.amount
+                summary.count_in += 1
+            else:
+                summary.total_out += p.amount
+                summary.count_out += 1
+            summary.last_payment_id = max(summary.last_payment_id or 0, p.id)
+        return summaries
+
+    @classmethod
+    def add_payments(cls, payments: Iterable[Payment], deferred: Iterable[str] = ()) -> None:
+        """
+        Adds the saved `payments` to the summaries of their accounts with a single UPDATE. The totals of
+        the `deferred` accounts are appended as `AccountSummaryDelta`s instead, their summary rows aren't locked.
+        """
+        deltas = cls.deltas(payments)
+        deferred = deltas.keys() & set(deferred)
+        if deferred:
+            AccountSummaryDelta.objects.bulk_create(AccountSummaryDelta.of(deltas.pop(acc_id)) for acc_id in deferred)
+        cls._apply(deltas, timezone.now())
+
+    @classmethod
+    def _apply(cls, deltas: Dict[str, SummaryType], modified_at: Optional[datetime]) -> None:
+        """
+        Adds the unsaved summaries `deltas` to the saved ones with a single UPDATE, their versions included.
+        `modified_at` is left as it is if None.
+        """
+        if not deltas:
+            return
+
+        def per_account(field: str, output_field: models.Field) -> Case:
+            return Case(*(When(account_id=acc_id, then=Value(getattr(delta, field))) for acc_id, delta in
+                          deltas.items()), default=Value(0), output_field=output_field)
+
+        changes = dict(
+            total_in=F('total_in') + per_account('total_in', cls._meta.get_field('total_in')),
+            total_out=F('total_out') + per_account('total_out', cls._meta.get_field('total_out')),
+            count_in=F('count_in') + per_account('count_in', models.BigIntegerField()),
+            count_out=F('count_out') + per_account('count_out', models.BigIntegerField()),
+            # transactions may commit out of id order
+            last_payment_id=Greatest(Coalesce(F('last_payment_id'), Value(0)),
+                                     per_account('last_payment_id', models.BigIntegerField())),
+            version=F('version') + per_account('version', models.BigIntegerField()),
         )
+        if modified_at is not None:
+            changes['modified_at'] = Value(modified_at, output_field=cls._meta.get_field('modified_at'))
+        updated = cls.objects.filter(account_id__in=deltas.keys()).update(**changes)
+        if updated < len(deltas):
+            # first payments of the accounts, rows which appeared concurrently are updated again
+            missing = set(deltas.keys()) - set(cls.objects.filter(account_id__in=deltas.keys()).values_list(
+                'account_id', flat=True))
+            cls.objects.bulk_create((cls(account_id=acc_id) for acc_id in missing), ignore_conflicts=True)
+            cls._apply({acc_id: deltas[acc_id] for acc_id in missing}, modified_at)
+
+    @classmethod
+    def fold_deltas(cls, limit: int = None) -> int:
+        """
+        Adds up to `limit` pending `AccountSummaryDelta`s to the summaries of their accounts, returns how many were
+        folded. Each of them adds the version its transfer would have. `modified_at` stays, nothing visible changes.
+        """
+        with transaction.atomic():
+            # concurrent rounds fold different deltas
+            pending = AccountSummaryDelta.objects.select_for_update(skip_locked=True).order_by('id')
+            pending = list(pending[:limit] if limit else pending)
+            if not pending:
+                return 0
+            AccountSummaryDelta.objects.filter(id__in=[delta.id for delta in pending]).delete()
+
+            deltas = {}
+            for delta in pending:
+                summary = deltas.get(delta.account_id)
+                if summary is None:
+                    summary = deltas[delta.account_id] = cls(account_id=delta.account_id, total_in=Decimal(0),
+                                                             total_out=Decimal(0), last_payment_id=0)
+                summary.add(delta)
+            cls._apply(deltas, None)
+        return len(pending)
+
+    def add(self, delta: 'AccountSummaryDelta') -> None:
+        """ Adds the totals of an unsaved or pending `delta` of the account and the version it stands for """
+        self.total_in += delta.total_in
+        self.total_out += delta.total_out
+        self.count_in += delta.count_in
+        self.count_out += delta.count_out
+        self.last_payment_id = max(self.last_payment_id or 0, delta.last_payment_id or 0) or None
+        self.version += 1
+
+    @classmethod
+    def current(cls: Type[SummaryType], account_id: str) -> Optional[SummaryType]:
+        """ Summary of the account with its pending deltas added, None if it has neither """
+        summary = cls.objects.filter(account_id=account_id).first()
+        pending = list(AccountSummaryDelta.objects.filter(account_id=account_id))
+        if pending and summary is None:
+            summary = cls(account_id=account_id, total_in=Decimal(0), total_out=Decimal(0))
+        for delta in pending:
+            summary.add(delta)
+        return summary
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """ Recomputes all the summaries from the payments, e.g. after payments were bulk loaded """
+        incoming, outgoing = Q(direction=Payment.INCOMING), Q(direction=Payment.OUTGOING)
+        rows = Payment.read_model().objects.order_by().values('account_id').annotate(
+            total_in=Coalesce(Sum('amount', filter=incoming), Value(0), output_field=cls._meta.get_field('total_in')),
+            total_out=Coalesce(Sum('amount', filter=outgoing), Value(0), output_field=cls._meta.get_field('total_out')),
+            count_in=Count('id', filter=incoming),
+            count_out=Count('id', filter=outgoing),
+            last_payment_id=Max('id'),
+            # a rebuilt summary must not validate a response cached before, `modified_at` tells them apart
+            version=Count('id'),
+        )
+        now = timezone.now()
+        with transaction.atomic():
+            AccountSummaryDelta.objects.all().delete()
+            cls.objects.all().delete()
+            cls.objects.bulk_create((cls(modified_at=now, **row) for row in rows.iterator()), batch_size=5000)
+
+    @staticmethod
+    def versions(account_ids: Iterable[str]) -> Dict[str, tuple]:
+        """
+        `(version, modified_at)` by id of the accounts among `account_ids` which exist, see
+        `AccountQuerySet.with_summary_version`
+        """
+        return {account_id: (version, modified_at) for account_id, version, modified_at in Account.objects.filter(
+            id__in=set(account_ids)).with_summary_version().values_list('id', 'version', 'modified_at')}
+
+
+class AccountSummaryDelta(models.Model):
+    """
+    Payment totals of a single transfer of an account not added to its `AccountSummary` yet. Transfers of accounts
+    credited through the ledger or sharded append them, so they don't queue on the summary row again.
+    `AccountSummary.fold_deltas` adds them up, see `manage.py compact_ledger`.
+    """
+    id = models.BigAutoField(primary_key=True)
+    account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='summary_deltas')
+    total_in = models.DecimalField(default=0, max_digits=17, decimal_places=2)
+    total_out = models.DecimalField(default=0, max_digits=17, decimal_places=2)
+    count_in = models.BigIntegerField(default=0)
+    count_out = models.BigIntegerField(default=0)
+    last_payment_id = models.BigIntegerField(null=True)
+
+    def __str__(self) -> str:
+        return f'{self.account_id}: in {self.total_in} ({self.count_in}), out {self.total_out} ({self.count_out})'
+
+    @classmethod
+    def of(cls, summary: AccountSummary) -> 'AccountSummaryDelta':
+        """ Unsaved delta of an unsaved summary of `AccountSummary.deltas` """
+        return cls(account_id=summary.account_id,
+                   **{field: getattr(summary, field) for field in AccountSummary.TOTALS})
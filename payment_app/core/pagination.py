@@ -0,0 +1,41 @@
+from decimal import Decimal
+from typing import Tuple, Dict
+
+from django.conf import settings
+from django.core import signing
+from rest_framework.pagination import CursorPagination
+
+__all__ = ('IdCursorPagination', 'encode_statement_cursor', 'decode_statement_cursor')
+
+_STATEMENT_CURSOR_SALT = 'core.statement'
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the primary key: every page is a `WHERE id > cursor ORDER BY id LIMIT n` index range
+    scan, so response time and memory don't depend on how deep the client pages or on the table size.
+    """
+    ordering = 'id'
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+def encode_statement_cursor(account_id: str, filters: Dict[str, str], last_id: int, balance: Decimal) -> str:
+    """
+    Cursor of the next statement page: the id of the last line and the balance after it, so the next page
+    continues the running balance with a `WHERE id > cursor` range scan. Signed along with the account and
+    the statement filters, so a client can't alter the balance nor carry it over to another statement
+    """
+    return signing.dumps([account_id, filters, last_id, str(balance)], salt=_STATEMENT_CURSOR_SALT)
+
+
+def decode_statement_cursor(cursor: str, account_id: str, filters: Dict[str, str]) -> Tuple[int, Decimal]:
+    """
+    Raises `signing.BadSignature` for a cursor which wasn't made by `encode_statement_cursor` for the statement of
+    `account_id` with the same `filters`
+    """
+    cursor_account_id, cursor_filters, last_id, balance = signing.loads(cursor, salt=_STATEMENT_CURSOR_SALT)
+    if (cursor_account_id, cursor_filters) != (account_id, filters):
+        raise signing.BadSignature('cursor of another statement')
+    return last_id, Decimal(balance)
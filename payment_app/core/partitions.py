@@ -0,0 +1,94 @@
+"""
+Monthly range partitions of the payments table by `created_at` on PostgreSQL, set up by migration 0008.
+Partitions are named `core_payment_pYYYYMM`, payments of months without one land in the default partition.
+Old months are detached, written to compressed CSV files and dropped instead of being deleted row by row.
+"""
+import datetime
+import gzip
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from django.db import transaction
+
+from .models import Payment
+
+__all__ = ('TABLE', 'DEFAULT_PARTITION', 'is_partitioned', 'month_start', 'add_months', 'partition_name',
+           'partition_month', 'partition_months', 'create_partition', 'archive_partition')
+
+TABLE = Payment._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+
+def month_start(value: datetime.datetime) -> datetime.datetime:
+    """ First instant of the (UTC) month of `value` """
+    value = value.astimezone(datetime.timezone.utc)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def partition_month(name: str) -> Optional[datetime.datetime]:
+    """ Month of the partition named `name`, None if it isn't a monthly one """
+    prefix = f'{TABLE}_p'
+    if not name.startswith(prefix):
+        return None
+    try:
+        return datetime.datetime.strptime(name[len(prefix):], '%Y%m').replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+def is_partitioned(cursor) -> bool:
+    if cursor.db.vendor != 'postgresql':
+        return False
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)', [TABLE])
+    return cursor.fetchone()[0]
+
+
+def partition_months(cursor) -> List[datetime.datetime]:
+    """ Months of the attached monthly partitions, oldest first """
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = %s::regclass', [TABLE])
+    return sorted(month for month in (partition_month(name) for name, in cursor.fetchall()) if month is not None)
+
+
+def create_partition(cursor, month: datetime.datetime) -> None:
+    """
+    Creates the partition of `month` and moves the payments of that month out of the default partition into it.
+    Only inserts which land in the default partition wait meanwhile, the ones into the other partitions don't.
+    """
+    name, start, end = partition_name(month), month.isoformat(), add_months(month, 1).isoformat()
+    with transaction.atomic(using=cursor.db.alias):
+        # no new rows of the month may appear in the default partition between the move and ATTACH
+        cursor.execute(f'LOCK TABLE {DEFAULT_PARTITION} IN SHARE MODE')
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s '
+                       f'RETURNING *) INSERT INTO {name} SELECT * FROM moved', [start, end])
+        # indexes, the primary key and the foreign keys of the table are created on the partition by ATTACH
+        cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def archive_partition(cursor, month: datetime.datetime, directory: Path) -> Path:
+    """
+    Writes the payments of the partition of `month` to a gzipped CSV file in `directory`, then detaches and drops
+    the partition. Returns the path of the file.
+    """
+    name = partition_name(month)
+    path = directory / f'{name}.csv.gz'
+    incomplete = path.with_name(f'{path.name}.part')
+    with gzip.open(incomplete, 'wt', newline='') as f:
+        cursor.copy_expert(f'COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)', f)
+    # the partition is only dropped once the whole archive is on disk
+    os.replace(incomplete, path)
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
+    return path
@@ -0,0 +1,62 @@
+"""
+Opt-in renderers for machine clients: the same JSON encoded by orjson (`?format=orjson`) and msgpack
+(`Accept: application/msgpack` or `?format=msgpack`). Amounts stay the strings with 2 decimal places the serializers
+give in every format, so they are exact and parsed the same way whatever the format.
+"""
+from decimal import Decimal
+
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ('ORJSONRenderer', 'MsgPackRenderer', 'ContentNegotiation')
+
+_encoder = JSONEncoder()
+
+
+def _default(obj):
+    """ Values the encoders don't know natively, as `JSONEncoder` gives them except for the exact decimals """
+    if isinstance(obj, Decimal):
+        return str(obj)
+    return _encoder.default(obj)
+
+
+class ORJSONRenderer(JSONRenderer):
+    format = 'orjson'
+    available = orjson is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return orjson.dumps(data, default=_default)
+
+
+class MsgPackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+class ContentNegotiation(DefaultContentNegotiation):
+    """ Leaves out the renderers whose encoder isn't installed, so they are never selected """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        renderers = [renderer for renderer in renderers if getattr(renderer, 'available', True)]
+        return super().select_renderer(request, renderers, format_suffix)
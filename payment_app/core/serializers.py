@@ -1,29 +1,108 @@
 from collections import OrderedDict
+from decimal import Decimal
 
+from django.conf import settings
 from rest_framework import serializers
 
-from .models import Transaction, Account, Payment
+from .metrics import timed
+from .models import Transaction, Account, Payment, Currency, QueuedTransfer, AccountSummary
 
-__all__ = ('TransactionSerializer', 'NewTransactionSerializer', 'AccountSerializer', 'PaymentSerializer')
+__all__ = ('TransactionSerializer', 'NewTransactionSerializer', 'NewTransactionBatchSerializer',
+           'QueuedTransferSerializer', 'AccountSerializer', 'AccountRowSerializer', 'PaymentSerializer',
+           'PaymentRowSerializer', 'AccountSummarySerializer', 'StatementLineSerializer', 'format_amount')
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+def format_amount(value: Decimal) -> str:
+    """ Same representation as `serializers.DecimalField(decimal_places=2)` gives, without the field machinery """
+    return format(value, '.2f')
+
+
+class TimedSerializerMixin:
+    """ Counts the time spent building the representation as `serializer` time of the request """
+
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class TransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Transaction
-        fields = '__all__'
+        list_serializer_class = TimedListSerializer
+        fields = ('id', 'from_account', 'to_account', 'amount', 'state')
 
 
 class NewTransactionSerializer(serializers.Serializer):
     from_account = serializers.CharField()
     to_account = serializers.CharField()
-    amount = serializers.DecimalField(max_digits=15, decimal_places=2)
+    amount = serializers.DecimalField(max_digits=15, decimal_places=2, min_value=Decimal('0.01'))
     currency = serializers.CharField()
 
+    def validate_currency(self, value):
+        # checked against the cached currency set, so malformed requests don't query the accounts at all
+        if not Currency.is_known(value):
+            raise serializers.ValidationError(f'unknown currency {value}')
+        return value
+
+
+class NewTransactionBatchSerializer(serializers.Serializer):
+    transfers = NewTransactionSerializer(many=True, allow_empty=False)
+
+    def validate_transfers(self, value):
+        if len(value) > settings.TRANSFER_BATCH_MAX_SIZE:
+            raise serializers.ValidationError(f'no more than {settings.TRANSFER_BATCH_MAX_SIZE} transfers per batch')
+        return value
+
+
+class QueuedTransferSerializer(serializers.ModelSerializer):
+    """ State of a queued transfer, with the created transaction or the error once it is made """
+
+    class Meta:
+        model = QueuedTransfer
+        fields = ('id', 'state')
+
+    def to_representation(self, instance):
+        result = super().to_representation(instance)
+        if instance.transaction_id is not None:
+            result['transaction'] = TransactionSerializer(instance=instance.transaction).data
+        elif instance.error is not None:
+            result['error'] = instance.error
+        return result
+
 
 class AccountSerializer(serializers.ModelSerializer):
     class Meta:
         model = Account
-        fields = '__all__'
+        fields = ('id', 'balance', 'currency')
+
+
+class AccountRowSerializer(TimedSerializerMixin, AccountSerializer):
+    """
+    Fast path of `AccountSerializer` for `Account.objects.with_current_balance().values(*AccountRowSerializer.VALUES)`
+    rows, `balance` includes the pending ledger credits
+    """
+    VALUES = ('id', 'current_balance', 'currency_id')
+
+    class Meta(AccountSerializer.Meta):
+        list_serializer_class = TimedListSerializer
+
+    def to_representation(self, row):
+        return {
+            'id': row['id'],
+            'balance': format_amount(row['current_balance']),
+            'currency': row['currency_id'],
+        }
+
+
+class AccountSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AccountSummary
+        fields = ('account', 'total_in', 'total_out', 'count_in', 'count_out', 'last_payment_id')
 
 
 class PaymentSerializer(serializers.ModelSerializer):
@@ -38,3 +117,47 @@ class PaymentSerializer(serializers.ModelSerializer):
 
         return OrderedDict([(key, result[key]) for key in result
                             if result[key] is not None or key not in self.__none_keys_to_skip])
+
+
+class PaymentRowSerializer(TimedSerializerMixin, PaymentSerializer):
+    """
+    Fast path of `PaymentSerializer` for `Payment.objects.values(*PaymentRowSerializer.VALUES)` rows:
+    builds the plain dict straight from the row instead of running every field and rebuilding an `OrderedDict`
+    """
+    VALUES = ('id', 'account_id', 'from_account_id', 'to_account_id', 'amount', 'direction')
+
+    class Meta(PaymentSerializer.Meta):
+        list_serializer_class = TimedListSerializer
+
+    def to_representation(self, row):
+        result = {'account': row['account_id']}
+        if row['from_account_id'] is not None:
+            result['from_account'] = row['from_account_id']
+        if row['to_account_id'] is not None:
+            result['to_account'] = row['to_account_id']
+        result['amount'] = format_amount(row['amount'])
+        result['direction'] = row['direction']
+        return result
+
+
+# formats datetimes the way the model serializers do
+_DATETIME = serializers.DateTimeField()
+
+
+class StatementLineSerializer(TimedSerializerMixin, serializers.Serializer):
+    """ `Account.statement_lines().values(*StatementLineSerializer.VALUES)` rows with the running `balance` added """
+    VALUES = ('id', 'created_at', 'direction', 'from_account_id', 'to_account_id', 'amount', 'running_total')
+
+    class Meta:
+        list_serializer_class = TimedListSerializer
+
+    def to_representation(self, row):
+        result = {'id': row['id'], 'created_at': _DATETIME.to_representation(row['created_at'])}
+        if row['from_account_id'] is not None:
+            result['from_account'] = row['from_account_id']
+        if row['to_account_id'] is not None:
+            result['to_account'] = row['to_account_id']
+        result['amount'] = format_amount(row['amount'])
+        result['direction'] = row['direction']
+        result['balance'] = format_amount(row['balance'])
+        return result
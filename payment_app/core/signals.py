@@ -0,0 +1,25 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Account, Currency
+
+
+@receiver(post_save, sender=Account)
+def account_saved(sender, instance: Account, **kwargs) -> None:
+    # transfers change the balances with updates, which don't send it
+    instance.refresh_cache()
+
+
+@receiver(post_delete, sender=Account)
+def account_deleted(sender, instance: Account, **kwargs) -> None:
+    instance.drop_cache()
+
+
+@receiver(post_save, sender=Currency)
+def currency_saved(sender, instance: Currency, **kwargs) -> None:
+    instance.refresh_cache()
+
+
+@receiver(post_delete, sender=Currency)
+def currency_deleted(sender, instance: Currency, **kwargs) -> None:
+    instance.drop_cache()
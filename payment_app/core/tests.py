@@ -1,14 +1,39 @@
+import csv
+import datetime
+import json
+import tempfile
 from collections import namedtuple
 from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlsplit
 
-from django.test import TestCase, Client
+from asgiref.sync import sync_to_async, async_to_sync
 
-from .models import Account, Currency, Transaction, Payment
+from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.test import TestCase, TransactionTestCase, Client, AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import utc
+
+from . import asyncdb
+from .backends.postgresql.statements import PreparedStatements, is_preparable, to_server_placeholders
+from .benchmark import drive_transfers, total_balance
+from .exceptions import (AccountNotFoundException, InsufficientFundsException, DifferentCurrenciesException,
+                         InvalidAmountException)
+from .metrics import transfer_lock_retries
+from .partitions import month_start, add_months, partition_name, partition_month
+from .models import (Account, AccountBalanceShard, AccountSummary, AccountSummaryDelta, Currency, Transaction,
+                     Transfer, Payment, DerivedPayment, QueuedTransfer)
+from .renderers import MsgPackRenderer, msgpack
+from .serializers import PaymentSerializer, PaymentRowSerializer
 
 account_balance = namedtuple('account_balance', ('currency', 'balance'))
 
 
-class BaseTestCase(TestCase):
+class TestDataMixin:
     test_data = {
         'john': account_balance('USD', Decimal('100.0')),
         'alice': account_balance('EUR', Decimal('200.0')),
@@ -18,6 +43,8 @@ class BaseTestCase(TestCase):
 
     def setUp(self) -> None:
         self.client = Client()
+        # process-wide, the transactions cached by earlier tests are gone
+        Transaction._idempotency_cache.clear()
         self.insert_test_data()
 
     def insert_test_data(self):
@@ -30,6 +57,10 @@ class BaseTestCase(TestCase):
             )
 
 
+class BaseTestCase(TestDataMixin, TestCase):
+    pass
+
+
 class TestCreateTransaction(BaseTestCase):
 
     def test_normal_transfer(self):
@@ -140,20 +171,779 @@ class TestCreateTransaction(BaseTestCase):
         self.assertEqual(from_account.balance, self.test_data[from_account_id].balance)
         self.assertEqual(to_account.balance, self.test_data[to_account_id].balance)
 
+    def test_transfer_statements(self):
+        # the first payments of the accounts create their summaries
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('1'), currency_code='USD')
+        with CaptureQueriesContext(connection) as ctx:
+            tx = Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                        currency_code='USD')
+        # the unlocked pre-check read, one ordered lock of both accounts, debit, credit, the transaction insert,
+        # one insert for both payments (their ids come from the transaction, PostgreSQL inserts them together with
+        # it) and one update of both summaries
+        statements = [q['sql'] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(statements), 6 if connection.vendor == 'postgresql' else 7, statements)
+        self.assertEqual(sorted(tx.payment_set.values_list('id', flat=True)), [tx.id * 2, tx.id * 2 + 1])
+        self.assertEqual(tx.payment_set.count(), 2)
+
+    def test_unknown_account(self):
+        with self.assertRaises(AccountNotFoundException):
+            Transaction.create_new(from_account_id='john', to_account_id='nobody', amount=Decimal('10'),
+                                   currency_code='USD')
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'].balance)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class TestCurrencyValidation(TestDataMixin, TransactionTestCase):
+    # the cached codes change once the currencies are committed
+
+    def test_unknown_currency(self):
+        Currency.codes()
+        with self.assertNumQueries(0):
+            response = self.client.post('/api/v1/transfer/create/', data={
+                'from_account': 'john',
+                'to_account': 'bob',
+                'amount': '10.0',
+                'currency': 'XXX',
+            })
+        self.assertEqual(response.status_code, 400)
+
+    def test_signals(self):
+        self.assertFalse(Currency.is_known('GBP'))
+        gbp = Currency.objects.create(code='GBP')
+        with self.assertNumQueries(0):
+            self.assertTrue(Currency.is_known('GBP'))
+        gbp.delete()
+        self.assertFalse(Currency.is_known('GBP'))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Currency.objects.create(code='CHF')
+            raise IntegrityError('rolled back')
+        self.assertFalse(Currency.is_known('CHF'))
+
+
+class TestAccountCache(TestDataMixin, TransactionTestCase):
+    # invalidation happens once the transfers commit
+
+    def test_prevalidation(self):
+        # currencies are cached once the accounts are saved
+        with self.assertNumQueries(0), self.assertRaises(DifferentCurrenciesException):
+            Transaction.create_new(from_account_id='john', to_account_id='alice', amount=Decimal('10'),
+                                   currency_code='USD')
+        with self.assertNumQueries(1), self.assertRaises(AccountNotFoundException):
+            Transaction.create_new(from_account_id='john', to_account_id='nobody', amount=Decimal('10'),
+                                   currency_code='USD')
+        with self.assertNumQueries(0), self.assertRaises(InvalidAmountException):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('-10'),
+                                   currency_code='USD')
+        # a single unlocked read, no write transaction is opened
+        with self.assertNumQueries(1), self.assertRaises(InsufficientFundsException):
+            Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('60'),
+                                   currency_code='USD')
+        self.assertEqual(Transaction.objects.count(), 0)
+
+        response = self.client.post('/api/v1/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': 'bob',
+            'amount': '-10.0',
+            'currency': 'USD',
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_rolled_back_currency(self):
+        with transaction.atomic():
+            account = Account.objects.get(id='bob')
+            account.currency_id = 'EUR'
+            account.save()
+            transaction.set_rollback(True)
+        # the cached currency is still the committed one
+        self.assertEqual(Account.get_cached_currencies(['bob']), {})
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        self.assertEqual(Account.get_cached_currencies(['bob']), {'bob': 'USD'})
+
+    def test_balance(self):
+        self.assertEqual(self.client.get('/api/v1/accounts/john/').json()['balance'], '100.00')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/v1/accounts/john/').json()['balance'], '100.00')
+
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        self.assertEqual(self.client.get('/api/v1/accounts/john/').json()['balance'], '90.00')
+        self.assertEqual(self.client.get('/api/v1/accounts/bob/').json()['balance'], '60.00')
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/v1/accounts/john/')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/accounts/john/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.content)
+
+        payments = self.client.get('/api/v1/payments/', {'account': 'bob'})
+        self.assertEqual(self.client.get('/api/v1/payments/', {'account': 'bob'},
+                                         HTTP_IF_NONE_MATCH=payments['ETag']).status_code, 304)
+        # validators differ per filter combination
+        self.assertNotEqual(self.client.get('/api/v1/payments/', {'account': 'bob', 'direction': 'incoming'})['ETag'],
+                            payments['ETag'])
+        self.assertFalse(self.client.get('/api/v1/payments/').has_header('ETag'))
+
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        updated = self.client.get('/api/v1/accounts/john/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(updated.status_code, 200)
+        # whole seconds can't validate a balance which may change twice within one
+        self.assertFalse(updated.has_header('Last-Modified'))
+        response = self.client.get('/api/v1/accounts/john/', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/v1/payments/', {'account': 'bob'}, HTTP_IF_NONE_MATCH=payments['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertEqual(AccountSummary.objects.get(account_id='bob').version, 1)
+
+
+class TestIdempotency(BaseTestCase):
+
+    def post_transfer(self, amount, idempotency_key, currency='USD'):
+        return self.client.post('/api/v1/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': 'bob',
+            'amount': amount,
+            'currency': currency,
+        }, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+
+    def test_replay(self):
+        response = self.post_transfer('10.0', 'key-1')
+        self.assertEqual(response.status_code, 201)
+        original = response.json()
+
+        for _ in range(2):
+            response = self.post_transfer('10.0', 'key-1')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json(), original)
+
+        # a replay served from the process cache doesn't touch the database at all
+        with self.assertNumQueries(0):
+            self.post_transfer('10.0', 'key-1')
+
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'].balance - Decimal('10.0'))
+
+        response = self.post_transfer('10.0', 'key-2')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(response.json()['id'], original['id'])
+
+    def test_key_reuse(self):
+        self.assertEqual(self.post_transfer('10.0', 'key-3').status_code, 201)
+
+        response = self.post_transfer('20.0', 'key-3')
+        self.assertEqual(response.status_code, 422)
+        # read from the database first, then from the process cache
+        for _ in range(2):
+            self.assertEqual(self.post_transfer('10.0', 'key-3', currency='EUR').status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        response = self.post_transfer('20.0', 'x' * 65)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(LEDGER_MODE=True)
+class TestLedgerMode(BaseTestCase):
+
+    def get_balance(self, account_id):
+        return Decimal(self.client.get(f'/api/v1/accounts/{account_id}/').json()['balance'])
+
+    def test_credits_are_appended(self):
+        for _ in range(3):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                   currency_code='USD')
+
+        # only the debited account row is updated, the credits wait in the ledger
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'].balance - Decimal('30'))
+        self.assertEqual(Account.objects.get(id='bob').balance, self.test_data['bob'].balance)
+        self.assertEqual(self.get_balance('bob'), self.test_data['bob'].balance + Decimal('30'))
+        self.assertEqual(Payment.objects.count(), 6)
+
+        self.assertEqual(Account.compact_ledger(), 1)
+        self.assertEqual(Account.objects.get(id='bob').balance, self.test_data['bob'].balance + Decimal('30'))
+        self.assertEqual(self.get_balance('bob'), self.test_data['bob'].balance + Decimal('30'))
+        self.assertEqual(Account.compact_ledger(), 0)
+
+    def test_summary_deltas(self):
+        payments = self.client.get('/api/v1/payments/', {'account': 'bob'})
+        for _ in range(2):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                   currency_code='USD')
+
+        # the summary row of the credited account isn't updated, its totals wait as deltas
+        self.assertFalse(AccountSummary.objects.filter(account_id='bob').exists())
+        self.assertEqual(AccountSummaryDelta.objects.filter(account_id='bob').count(), 2)
+        self.assertEqual(AccountSummary.objects.get(account_id='john').version, 2)
+        summary = self.client.get('/api/v1/accounts/bob/summary/').json()
+        self.assertEqual(summary, {
+            'account': 'bob', 'total_in': '20.00', 'total_out': '0.00', 'count_in': 2, 'count_out': 0,
+            'last_payment_id': Payment.objects.filter(account_id='bob').latest('id').id,
+        })
+        self.assertEqual(AccountSummary.versions(['bob', 'nobody']), {'bob': (2, None)})
+        updated = self.client.get('/api/v1/payments/', {'account': 'bob'}, HTTP_IF_NONE_MATCH=payments['ETag'])
+        self.assertEqual(updated.status_code, 200)
+
+        call_command('compact_ledger', stdout=StringIO())
+        self.assertFalse(AccountSummaryDelta.objects.exists())
+        self.assertEqual(self.client.get('/api/v1/accounts/bob/summary/').json(), summary)
+        # folding changes nothing visible, the cached responses stay valid
+        self.assertEqual(AccountSummary.versions(['bob']), {'bob': (2, None)})
+        self.assertEqual(self.client.get('/api/v1/payments/', {'account': 'bob'},
+                                         HTTP_IF_NONE_MATCH=updated['ETag']).status_code, 304)
+
+    def test_debit_folds_pending_credits(self):
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('100'),
+                               currency_code='USD')
+
+        # only covered with the pending credit
+        Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('120'),
+                               currency_code='USD')
+        self.assertEqual(Account.objects.get(id='bob').balance, Decimal('30'))
+        self.assertEqual(self.get_balance('john'), Decimal('120'))
+
+        with self.assertRaises(InsufficientFundsException):
+            Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('31'),
+                                   currency_code='USD')
+
+
+@override_settings(TRANSFER_QUEUE_MODE=1)
+class TestTransferQueue(BaseTestCase):
+
+    def post_transfer(self, to_account, amount, idempotency_key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': idempotency_key} if idempotency_key else {}
+        return self.client.post('/api/v1/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': to_account,
+            'amount': amount,
+            'currency': 'USD',
+        }, **headers)
+
+    def test_queue(self):
+        response = self.post_transfer('bob', '30.0', idempotency_key='q-1')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['state'], 'queued')
+        location = response['Location']
+        self.assertEqual(self.post_transfer('bob', '30.0', idempotency_key='q-1').json(), response.json())
+        self.assertEqual(self.post_transfer('bob', '31.0', idempotency_key='q-1').status_code, 422)
+        rejected = self.post_transfer('bob', '80.0').json()['id']
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'].balance)
+
+        self.assertEqual(QueuedTransfer.process(10), 2)
+        self.assertEqual(QueuedTransfer.process(10), 0)
+
+        json_ = self.client.get(location).json()
+        self.assertEqual(json_['state'], 'succeed')
+        self.assertEqual(json_['transaction']['amount'], '30.00')
+        self.assertEqual(Transaction.objects.get().idempotency_key, 'q-1')
+        self.assertEqual(self.client.get(f'/api/v1/transfer/queued/{rejected}/').json(),
+                         {'id': rejected, 'state': 'failed', 'error': 'insufficient funds'})
+        self.assertEqual(Account.objects.get(id='bob').balance, self.test_data['bob'].balance + Decimal('30'))
+
+    def test_broken_transfer(self):
+        # the key is taken by a transaction made outside of the queue, so the batch can't commit
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('1'), currency_code='USD',
+                               idempotency_key='taken')
+        self.post_transfer('bob', '5.0', idempotency_key='taken')
+        self.post_transfer('bob', '6.0')
+
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(QueuedTransfer.process(10), 2)
+        self.assertEqual(list(QueuedTransfer.objects.order_by('id').values_list('state', flat=True)),
+                         ['failed', 'succeed'])
+
+    @override_settings(TRANSFER_LOCK_RETRIES=0)
+    def test_transient_failure(self):
+        self.post_transfer('bob', '5.0')
+        with mock.patch.object(Transaction, '_transfer_batch', side_effect=OperationalError('deadlock detected')), \
+                self.assertLogs(level='ERROR'):
+            self.assertEqual(QueuedTransfer.process(10), 0)
+        # left for the next run
+        self.assertEqual(QueuedTransfer.objects.get().state, QueuedTransfer.STATE_QUEUED)
+        self.assertEqual(QueuedTransfer.process(10), 1)
+        self.assertEqual(QueuedTransfer.objects.get().state, Transaction.STATE_SUCCEED)
+
+    def test_claims_of_retries(self):
+        # a retried attempt may claim another transfer, the one marked failed is the last one claimed
+        queued = self.post_transfer('bob', '5.0').json()['id']
+        claimed = [queued + 1]
+        self.assertEqual(QueuedTransfer._process(1, claimed), 1)
+        self.assertEqual(claimed, [queued])
+
+
+class TestShardedAccounts(TestDataMixin, TransactionTestCase):
+    # balances read back from the API are cached until the transfers commit
+
+    def get_balance(self, account_id):
+        return Decimal(self.client.get(f'/api/v1/accounts/{account_id}/').json()['balance'])
+
+    def shard_balances(self, account_id):
+        return list(AccountBalanceShard.objects.filter(account_id=account_id).order_by('index').values_list(
+            'balance', flat=True))
+
+    def test_split(self):
+        Account.split_into_shards('bob', 3)
+        self.assertEqual(Account.objects.get(id='bob').balance, Decimal('0'))
+        self.assertEqual(self.shard_balances('bob'), [Decimal('16.68'), Decimal('16.66'), Decimal('16.66')])
+        self.assertEqual(self.get_balance('bob'), self.test_data['bob'].balance)
+
+        Account.split_into_shards('bob', 0)
+        self.assertEqual(Account.objects.get(id='bob').balance, self.test_data['bob'].balance)
+        self.assertEqual(self.shard_balances('bob'), [])
+
+    def test_transfers(self):
+        Account.split_into_shards('bob', 4)
+
+        for _ in range(5):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                   currency_code='USD')
+        # credits land on the shards only, the summary of the account is only appended to
+        self.assertEqual(Account.objects.get(id='bob').balance, Decimal('0'))
+        self.assertFalse(AccountSummary.objects.filter(account_id='bob').exists())
+        self.assertEqual(AccountSummary.current('bob').total_in, Decimal('50'))
+        self.assertEqual(sum(self.shard_balances('bob')), Decimal('100'))
+        self.assertEqual(self.get_balance('bob'), Decimal('100'))
+
+        # needs more than a single shard
+        Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('90'), currency_code='USD')
+        self.assertEqual(self.get_balance('bob'), Decimal('10'))
+        self.assertTrue(all(balance >= 0 for balance in self.shard_balances('bob')))
+
+        with self.assertRaises(InsufficientFundsException):
+            Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('11'),
+                                   currency_code='USD')
+
+    def test_funds_in_the_account_row(self):
+        Account.split_into_shards('bob', 2)
+        # credited to the row while all the shards were busy
+        Account.objects.filter(id='bob').update(balance=Decimal('20'))
+        self.assertEqual(self.get_balance('bob'), Decimal('70'))
+
+        Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('60'), currency_code='USD')
+        self.assertEqual(Account.objects.get(id='bob').balance, Decimal('0'))
+        self.assertEqual(sum(self.shard_balances('bob')), Decimal('10'))
+        with self.assertRaises(InsufficientFundsException):
+            Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('11'),
+                                   currency_code='USD')
+
+    def test_batch(self):
+        Account.split_into_shards('bob', 2)
+        response = self.client.post('/api/v1/transfer/batch/', data={'transfers': [
+            {'from_account': 'bob', 'to_account': 'john', 'amount': '40.0', 'currency': 'USD'},
+            {'from_account': 'john', 'to_account': 'bob', 'amount': '15.0', 'currency': 'USD'},
+        ]}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.shard_balances('bob'), [Decimal('12.50'), Decimal('12.50')])
+        self.assertEqual(self.get_balance('john'), Decimal('125'))
+
+
+class TestLockRetries(TestDataMixin, TransactionTestCase):
+    # transactions are retried only when they are not nested, so the test can't run inside a test transaction
+
+    def test_retry_on_deadlock(self):
+        retries_before = transfer_lock_retries.value
+        transfer = Transaction._transfer
+        attempts = []
+
+        def flaky_transfer(*args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return transfer(*args)
+
+        with mock.patch.object(Transaction, '_transfer', side_effect=flaky_transfer):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                   currency_code='USD')
+
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(transfer_lock_retries.value, retries_before + 1)
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'].balance - Decimal('10'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+class TestTransferLoad(TestDataMixin, TransactionTestCase):
+
+    def test_balance_is_conserved(self):
+        total = total_balance()
+        samples = drive_transfers(['john', 'bob'], requests=20, concurrency=2, amount=Decimal('5'))
+
+        self.assertEqual(len(samples), 20)
+        self.assertTrue(all(sample.statements > 0 for sample in samples))
+        self.assertEqual(total_balance(), total)
+        self.assertEqual(Transaction.objects.count(), sum(1 for sample in samples if sample.status == 201))
+
+
+class TestAsyncEndpoints(TestDataMixin, TransactionTestCase):
+    # the ORM fallback runs in worker threads, which don't see the data of a test transaction.
+    # `AsyncClient` of Django 3.1.3 breaks the `Content-Length` of request bodies and drops `data` of GETs,
+    # so POSTs go through the sync one (which runs async views too) and queries are put into the URL
+
+    def test_transfer(self):
+        response = self.client.post('/api/v1/async/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': 'bob',
+            'amount': '10.00',
+            'currency': 'USD',
+        }, content_type='application/json', HTTP_IDEMPOTENCY_KEY='async-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['amount'], '10.00')
+        self.assertEqual(Transaction.objects.get().idempotency_key, 'async-1')
+
+    async def test_reads(self):
+        await sync_to_async(Transaction.create_new, thread_sensitive=False)(
+            from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        client = AsyncClient()
+
+        response = await client.get('/api/v1/async/accounts/john/')
+        self.assertEqual(response.json(), {'id': 'john', 'balance': '90.00', 'currency': 'USD'})
+
+        response = await client.get('/api/v1/async/payments/?account=bob')
+        self.assertEqual(response.json()['results'], [
+            {'account': 'bob', 'from_account': 'john', 'amount': '10.00', 'direction': 'incoming'},
+        ])
+
+    def test_worker_thread_connections(self):
+        # closed like at the start and end of a request, workers see no request signals
+        with mock.patch('core.asyncdb.close_old_connections') as close_old_connections:
+            self.assertEqual(async_to_sync(asyncdb.in_worker_thread(Account.objects.count))(), 4)
+        self.assertEqual(close_old_connections.call_count, 2)
+
+    @mock.patch('core.models.Account.prevalidate_transfer', side_effect=OperationalError('connection lost'))
+    def test_failed_prevalidation(self, prevalidate_transfer):
+        # the checks under the locks decide then
+        response = self.client.post('/api/v1/async/transfer/create/', data={
+            'from_account': 'bob',
+            'to_account': 'john',
+            'amount': '60.00',
+            'currency': 'USD',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'insufficient funds'})
+        self.assertTrue(prevalidate_transfer.called)
+
+    def test_rejections(self):
+        response = self.client.post('/api/v1/async/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': 'alice',
+            'amount': '10.00',
+            'currency': 'USD',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'target account has currency different from payment currency'})
+
+        response = self.client.get('/api/v1/async/accounts/nobody/')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestPreparedStatements(TestCase):
+
+    def test_placeholders(self):
+        self.assertEqual(to_server_placeholders('SELECT * FROM t WHERE a = %s AND b LIKE \'x%%\' AND c IN (%s, %s)'),
+                         'SELECT * FROM t WHERE a = $1 AND b LIKE \'x%\' AND c IN ($2, $3)')
+        self.assertTrue(is_preparable(' UPDATE t SET a = %s'))
+        self.assertFalse(is_preparable('SAVEPOINT s1'))
+
+    def test_threshold_and_eviction(self):
+        statements = PreparedStatements(threshold=2, maxsize=1)
+        self.assertFalse(statements.hit('SELECT 1'))
+        self.assertTrue(statements.hit('SELECT 1'))
+        name, evicted = statements.add('SELECT 1')
+        self.assertIsNone(evicted)
+        self.assertEqual(statements.get('SELECT 1'), name)
+
+        self.assertEqual(statements.add('SELECT 2'), (statements.get('SELECT 2'), name))
+        self.assertIsNone(statements.get('SELECT 1'))
+
+        statements.discard('SELECT 3')
+        self.assertFalse(statements.hit('SELECT 3'))
+        self.assertFalse(statements.hit('SELECT 3'))
+
+
+@override_settings(SINGLE_ROW_PAYMENTS=1)
+class TestSingleRowPayments(TestDataMixin, TransactionTestCase):
+    # the indexes are created and dropped CONCURRENTLY on PostgreSQL, which can't run in a transaction
+
+    QUERIES = ('', 'account=john', 'account=bob&direction=incoming', 'from_account=alice', 'to_account=bob',
+               'direction=outgoing')
+
+    def list_payments(self):
+        return {query: self.client.get(f'/api/v1/payments/?{query}').json()['results'] for query in self.QUERIES}
+
+    def test_derived_payments(self):
+        call_command('payment_storage', 'single-row', stdout=StringIO())
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        Transaction.create_batch([
+            Transfer('alice', 'mark', Decimal('5'), 'EUR'),
+            Transfer('bob', 'john', Decimal('1'), 'USD'),
+        ])
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(DerivedPayment.objects.count(), 6)
+        self.assertEqual(self.client.get('/api/v1/accounts/bob/summary/').json()['total_in'], '10.00')
+        derived = self.list_payments()
+        self.assertEqual(derived['account=john'], [
+            {'account': 'john', 'to_account': 'bob', 'amount': '10.00', 'direction': Payment.OUTGOING},
+            {'account': 'john', 'from_account': 'bob', 'amount': '1.00', 'direction': Payment.INCOMING},
+        ])
+        payment_id = DerivedPayment.objects.get(account='mark').id
+        self.assertEqual(self.client.get(f'/api/v1/payments/{payment_id}/').json()['from_account'], 'alice')
+
+        # the same API once switched back to stored payments
+        with override_settings(SINGLE_ROW_PAYMENTS=0):
+            call_command('payment_storage', 'two-rows', stdout=StringIO())
+            self.assertEqual(Payment.objects.count(), 6)
+            self.assertEqual(sorted(Payment.objects.values_list('id', flat=True)),
+                             sorted(DerivedPayment.objects.values_list('id', flat=True)))
+            self.assertEqual(self.list_payments(), derived)
+
+
+class TestPaymentPartitions(TestCase):
+
+    def test_months(self):
+        # months are UTC ones
+        minus_one = datetime.timezone(-datetime.timedelta(hours=1))
+        month = month_start(datetime.datetime(2020, 12, 31, 23, 30, tzinfo=minus_one))
+        self.assertEqual(month, datetime.datetime(2021, 1, 1, tzinfo=utc))
+        self.assertEqual(add_months(month, -1), datetime.datetime(2020, 12, 1, tzinfo=utc))
+        self.assertEqual(add_months(month, 14), datetime.datetime(2022, 3, 1, tzinfo=utc))
+        self.assertEqual(partition_name(month), 'core_payment_p202101')
+        self.assertEqual(partition_month('core_payment_p202101'), month)
+        self.assertIsNone(partition_month('core_payment_default'))
+
+    def test_commands_need_partitions(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('payments are partitioned')
+        with self.assertRaises(CommandError):
+            call_command('create_payment_partitions')
+        with self.assertRaises(CommandError):
+            call_command('archive_payments', directory='.')
+
+
+class TestAccountImport(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def import_accounts(self, name: str, content: str, **options) -> str:
+        path = self.directory / name
+        path.write_text(content)
+        out = StringIO()
+        call_command('import_accounts', str(path), stdout=out, **options)
+        return out.getvalue()
+
+    def test_import(self):
+        self.import_accounts('accounts.csv', 'id,currency,balance\ncarol,USD,10.50\njohn,USD,1\ncarl,JPY,0\n',
+                             chunk_size=2)
+        self.assertEqual(Account.objects.get(id='carol').balance, Decimal('10.50'))
+        self.assertEqual(Account.objects.get(id='carl').currency_id, 'JPY')
+        # existing accounts are kept as they are
+        self.assertEqual(Account.objects.get(id='john').balance, self.test_data['john'][1])
+
+        self.import_accounts('accounts.ndjson', '{"id": "dave", "currency": "EUR", "balance": 0.1}\n\n'
+                                                '{"id": 42, "currency": "EUR"}\n')
+        self.assertEqual(Account.objects.get(id='dave').balance, Decimal('0.1'))
+        self.assertEqual(Account.objects.get(id='42').balance, 0)
+        self.assertFalse(list(self.directory.glob('*.checkpoint')))
+
+    def test_invalid_rows(self):
+        with self.assertRaisesMessage(CommandError, 'line 3: invalid balance'):
+            self.import_accounts('accounts.csv', 'id,currency,balance\nalice,USD,1\neve,USD,-1\n')
+        with self.assertRaisesMessage(CommandError, 'Unknown currencies after row 0: XXX'):
+            self.import_accounts('accounts.csv', 'id,currency,balance\nalice,XXX,1\n', create_currencies=False)
+        self.assertFalse(Currency.objects.filter(code='XXX').exists())
+
+    def test_resume(self):
+        path = self.directory / 'accounts.csv'
+        content = 'id,currency,balance\nn1,USD,1\nn2,USD,2\nn3,USD,3\n'
+        (self.directory / 'accounts.csv.checkpoint').write_text(json.dumps({'size': len(content), 'rows': 2}))
+        out = self.import_accounts(path.name, content)
+        self.assertIn('Resuming after 2 rows', out)
+        self.assertEqual(set(Account.objects.filter(id__startswith='n').values_list('id', flat=True)), {'n3'})
+
+        (self.directory / 'accounts.csv.checkpoint').write_text(json.dumps({'size': 1, 'rows': 2}))
+        with self.assertRaisesMessage(CommandError, 'rerun with --restart'):
+            self.import_accounts(path.name, content)
+        self.import_accounts(path.name, content, restart=True)
+        self.assertEqual(Account.objects.filter(id__startswith='n').count(), 3)
+
+
+class TestRequestMetrics(BaseTestCase):
+
+    def test_server_timing(self):
+        response = self.client.post('/api/v1/transfer/create/', data={
+            'from_account': 'john',
+            'to_account': 'bob',
+            'amount': '1.0',
+            'currency': 'USD',
+        })
+        self.assertEqual(response.status_code, 201)
+        timing = {entry.split(';')[0]: entry for entry in response['Server-Timing'].split(', ')}
+        self.assertEqual(set(timing), {'db', 'serializer', 'lock', 'total'})
+        self.assertRegex(timing['db'], r'^db;dur=[0-9.]+;desc="[0-9]+ queries"$')
+
+    def test_prometheus_endpoint(self):
+        self.client.get('/api/v1/payments/')
+        self.client.get('/api/v1/payments/')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE payments_http_requests_total counter', lines)
+        self.assertTrue(any(line.startswith('payments_http_requests_total{endpoint="payment-list",method="GET",'
+                                            'status="200"}') for line in lines))
+        self.assertTrue(any(line.startswith('transfer_lock_retries_total ') for line in lines))
+
+
+class TestCreateTransactionBatch(BaseTestCase):
+
+    def post_batch(self, transfers):
+        return self.client.post('/api/v1/transfer/batch/', data={'transfers': transfers},
+                                content_type='application/json')
+
+    def test_batch_transfer(self):
+        response = self.post_batch([
+            {'from_account': 'john', 'to_account': 'bob', 'amount': '60.0', 'currency': 'USD'},
+            # funded by the previous transfer
+            {'from_account': 'bob', 'to_account': 'john', 'amount': '110.0', 'currency': 'USD'},
+            {'from_account': 'john', 'to_account': 'alice', 'amount': '1.0', 'currency': 'USD'},
+            {'from_account': 'mark', 'to_account': 'alice', 'amount': '11.0', 'currency': 'EUR'},
+            {'from_account': 'nobody', 'to_account': 'alice', 'amount': '1.0', 'currency': 'EUR'},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['state'] for r in results], [Transaction.STATE_SUCCEED, Transaction.STATE_SUCCEED,
+                                                         Transaction.STATE_FAILED, Transaction.STATE_FAILED,
+                                                         Transaction.STATE_FAILED])
+        self.assertEqual(results[2]['error'], 'target account has currency different from payment currency')
+        self.assertEqual(results[3]['error'], 'insufficient funds')
+        self.assertEqual(results[4]['error'], 'nobody not found')
+
+        self.assertEqual(Account.objects.get(id='john').balance, Decimal('150.0'))
+        self.assertEqual(Account.objects.get(id='bob').balance, Decimal('0.0'))
+        self.assertEqual(Account.objects.get(id='mark').balance, self.test_data['mark'].balance)
+
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(Payment.objects.count(), 4)
+        for result in results[:2]:
+            tx = Transaction.objects.get(id=result['transaction']['id'])
+            self.assertEqual(tx.payment_set.count(), 2)
+
+    def test_invalid_batch(self):
+        response = self.post_batch([])
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post_batch([{'from_account': 'john', 'to_account': 'bob', 'amount': 'x', 'currency': 'USD'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class TestRenderers(BaseTestCase):
+
+    def test_orjson(self):
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10.5'), currency_code='USD')
+        queued = QueuedTransfer.enqueue(from_account_id='john', to_account_id='bob', amount=Decimal('1'),
+                                        currency_code='USD')
+        for url in ('/api/v1/accounts/john/', '/api/v1/payments/', f'/api/v1/transfer/queued/{queued.id}/'):
+            default, fast = self.client.get(url), self.client.get(url, {'format': 'orjson'})
+            self.assertEqual(default.status_code, 200)
+            self.assertEqual(fast['Content-Type'], 'application/json')
+            self.assertEqual((fast.status_code, fast.json()), (default.status_code, default.json()))
+        # amounts stay exact strings
+        self.assertEqual(self.client.get('/api/v1/payments/', {'format': 'orjson'}).json()['results'][0]['amount'],
+                         '10.50')
+
+    def test_msgpack(self):
+        response = self.client.get('/api/v1/accounts/john/', HTTP_ACCEPT=MsgPackRenderer.media_type)
+        if msgpack is None:
+            # never selected without the encoder
+            self.assertEqual(response.status_code, 406)
+            return
+        self.assertEqual(response['Content-Type'], MsgPackRenderer.media_type)
+        self.assertEqual(msgpack.unpackb(response.content), {'id': 'john', 'balance': '100.00', 'currency': 'USD'})
+
 
 class TestAccountsEndpoint(BaseTestCase):
 
     def test_all_accounts(self):
         response = self.client.get('/api/v1/accounts/')
         self.assertEqual(response.status_code, 200)
-        json_ = response.json()
+        json_ = response.json()['results']
         self.assertEqual(len(json_), len(self.test_data))
-        for i, account_id in enumerate(self.test_data.keys()):
+        # accounts are ordered by id
+        for i, account_id in enumerate(sorted(self.test_data.keys())):
             resp_entry = json_[i]
             self.assertEqual(resp_entry['id'], account_id)
             self.assertEqual(Decimal(resp_entry['balance']), self.test_data[account_id].balance)
             self.assertEqual(resp_entry['currency'], self.test_data[account_id].currency)
 
+    def test_account(self):
+        response = self.client.get('/api/v1/accounts/john/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'id': 'john', 'balance': '100.00', 'currency': 'USD'})
+
+        response = self.client.get('/api/v1/accounts/nobody/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_account_summary(self):
+        self.assertEqual(self.client.get('/api/v1/accounts/bob/summary/').json(), {
+            'account': 'bob', 'total_in': '0.00', 'total_out': '0.00', 'count_in': 0, 'count_out': 0,
+            'last_payment_id': None,
+        })
+        for amount in ('10', '20'):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal(amount),
+                                   currency_code='USD')
+        Transaction.create_new(from_account_id='bob', to_account_id='john', amount=Decimal('5'), currency_code='USD')
+
+        json_ = self.client.get('/api/v1/accounts/bob/summary/').json()
+        self.assertEqual(json_, {
+            'account': 'bob', 'total_in': '30.00', 'total_out': '5.00', 'count_in': 2, 'count_out': 1,
+            'last_payment_id': Payment.objects.filter(account_id='bob').latest('id').id,
+        })
+        # the maintained summaries match the ones computed from the payments, a rebuild only moves `modified_at`
+        fields = ('account_id', 'total_in', 'total_out', 'count_in', 'count_out', 'last_payment_id', 'version')
+        summaries = list(AccountSummary.objects.order_by('account_id').values(*fields))
+        AccountSummary.rebuild()
+        self.assertEqual(list(AccountSummary.objects.order_by('account_id').values(*fields)), summaries)
+
+        self.assertEqual(self.client.get('/api/v1/accounts/nobody/summary/').status_code, 404)
+
+    def test_account_statement(self):
+        for from_account, to_account, amount in (('john', 'bob', '10'), ('bob', 'john', '5'), ('john', 'bob', '20')):
+            Transaction.create_new(from_account_id=from_account, to_account_id=to_account, amount=Decimal(amount),
+                                   currency_code='USD')
+        Transaction.create_new(from_account_id='alice', to_account_id='mark', amount=Decimal('1'), currency_code='EUR')
+
+        with self.assertNumQueries(2):
+            json_ = self.client.get('/api/v1/accounts/john/statement/?page_size=2').json()
+        self.assertEqual((json_['opening_balance'], json_['closing_balance']), ('100.00', '95.00'))
+        self.assertEqual([(line['direction'], line['amount'], line['balance']) for line in json_['results']],
+                         [(Payment.OUTGOING, '10.00', '90.00'), (Payment.INCOMING, '5.00', '95.00')])
+        # the cursor only continues the statement it was made for
+        cursor = parse_qs(urlsplit(json_['next']).query)['cursor'][0]
+        for account, filters in (('bob', {}), ('john', {'id_after': 1})):
+            response = self.client.get(f'/api/v1/accounts/{account}/statement/', {'cursor': cursor, **filters})
+            self.assertEqual(response.status_code, 400)
+        # the next page continues the running balance without computing it again
+        with self.assertNumQueries(1):
+            json_ = self.client.get(json_['next']).json()
+        self.assertEqual([line['balance'] for line in json_['results']], ['75.00'])
+        self.assertEqual((json_['opening_balance'], json_['closing_balance'], json_['next']), ('95.00', '75.00', None))
+
+        first = Payment.objects.filter(account_id='john').earliest('id')
+        json_ = self.client.get(f'/api/v1/accounts/john/statement/?id_after={first.id}').json()
+        self.assertEqual(json_['opening_balance'], '90.00')
+        self.assertEqual([line['balance'] for line in json_['results']], ['95.00', '75.00'])
+        with override_settings(SINGLE_ROW_PAYMENTS=1):
+            json_ = self.client.get('/api/v1/accounts/john/statement/?created_after=2020-01-01T00:00:00Z').json()
+        self.assertEqual([line['balance'] for line in json_['results']], ['90.00', '95.00', '75.00'])
+
+        self.assertEqual(self.client.get('/api/v1/accounts/nobody/statement/').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/accounts/john/statement/?cursor=forged').status_code, 400)
+
 
 class TestPaymentsEndpoint(BaseTestCase):
 
@@ -164,9 +954,97 @@ class TestPaymentsEndpoint(BaseTestCase):
         # sanity check
         self.assertEqual(Payment.objects.all().count(), 4)
 
-        response = self.client.get('/api/v1/accounts/')
+        response = self.client.get('/api/v1/payments/')
         self.assertEqual(response.status_code, 200)
-        json_ = response.json()
+        json_ = response.json()['results']
 
         # should be 4 payments from 2 transactions (2 incoming, 2 outgoing)
         self.assertEqual(len(json_), 4)
+
+    def test_payments_pagination(self):
+        for _ in range(3):
+            Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                   currency_code='USD')
+
+        pages = []
+        url = '/api/v1/payments/?page_size=4'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            json_ = response.json()
+            pages.append(json_['results'])
+            url = json_['next']
+
+        self.assertEqual([len(page) for page in pages], [4, 2])
+
+    def test_payments_filter(self):
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        Transaction.create_new(from_account_id='alice', to_account_id='mark', amount=Decimal('10'), currency_code='EUR')
+
+        response = self.client.get('/api/v1/payments/?account=john')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [
+            {'account': 'john', 'to_account': 'bob', 'amount': '10.00', 'direction': Payment.OUTGOING},
+        ])
+
+    def test_payments_date_filter(self):
+        old = Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'),
+                                     currency_code='USD')
+        Transaction.objects.filter(id=old.id).update(created_at=datetime.datetime(2020, 1, 31, tzinfo=utc))
+        Payment.objects.filter(transaction_id=old.id).update(created_at=datetime.datetime(2020, 1, 31, tzinfo=utc))
+        new = Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('5'),
+                                     currency_code='USD')
+        self.assertEqual({p.created_at for p in new.payment_set.all()}, {new.created_at})
+
+        response = self.client.get('/api/v1/payments/?account=john&created_before=2020-02-01T00:00:00Z')
+        self.assertEqual([p['amount'] for p in response.json()['results']], ['10.00'])
+        response = self.client.get('/api/v1/payments/?account=john&created_after=2020-02-01T00:00:00Z')
+        self.assertEqual([p['amount'] for p in response.json()['results']], ['5.00'])
+        self.assertEqual(self.client.get('/api/v1/payments/?created_after=yesterday').status_code, 400)
+
+    def test_row_serializer(self):
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+
+        # fast path gives exactly what the model serializer does
+        for payment in Payment.objects.all():
+            row = Payment.objects.values(*PaymentRowSerializer.VALUES).get(id=payment.id)
+            self.assertEqual(PaymentRowSerializer(row).data, PaymentSerializer(payment).data)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/payments/')
+        self.assertEqual(len(response.json()['results']), 2)
+
+        response = self.client.get(f'/api/v1/payments/{payment.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), PaymentSerializer(payment).data)
+
+    def test_export(self):
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        Transaction.create_new(from_account_id='alice', to_account_id='mark', amount=Decimal('5'), currency_code='EUR')
+
+        response = self.client.get('/api/v1/payments/export/?direction=incoming')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(line['account'], line['from_account'], line['amount']) for line in lines],
+                         [('bob', 'john', '10.00'), ('mark', 'alice', '5.00')])
+        self.assertTrue(all('to_account' not in line for line in lines))
+
+        response = self.client.get('/api/v1/payments/export/?output=csv&account=john')
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'account', 'from_account', 'to_account', 'amount', 'direction'])
+        self.assertEqual(rows[1][1:], ['john', '', 'bob', '10.00', Payment.OUTGOING])
+        self.assertEqual(len(rows), 2)
+
+        response = self.client.get('/api/v1/payments/export/?output=xml')
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(connection.vendor == 'postgresql', 'prepared statements are made by the PostgreSQL backend only')
+    def test_export_prepared_statements(self):
+        # the export reads through a named cursor, its statement is never prepared
+        Transaction.create_new(from_account_id='john', to_account_id='bob', amount=Decimal('10'), currency_code='USD')
+        for _ in range(settings.DB_PREPARE_THRESHOLD + 2):
+            response = self.client.get('/api/v1/payments/export/?account=john')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1)
@@ -1,42 +1,206 @@
+import hashlib
+import json
 from decimal import Decimal
+from typing import Optional, Callable
 
+from django.conf import settings
+from django.core import signing
+from django.http import (StreamingHttpResponse, HttpResponse, JsonResponse, HttpResponseNotAllowed, QueryDict,
+                         Http404)
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
 from rest_framework import viewsets
-from rest_framework.generics import CreateAPIView
+from rest_framework.decorators import action
+from rest_framework.generics import CreateAPIView, RetrieveAPIView
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
+from . import asyncdb
 from .exceptions import *
-from .filters import PaymentFilter
-from .models import Payment, Account, Transaction
-from .serializers import PaymentSerializer, AccountSerializer, NewTransactionSerializer, TransactionSerializer
+from .export import EXPORT_FORMATS, payment_rows
+from .filters import PaymentFilter, DerivedPaymentFilter, StatementFilter
+from .metrics import render_prometheus
+from .models import (Payment, DerivedPayment, Account, AccountSummary, Transaction, Transfer, QueuedTransfer,
+                     IDEMPOTENCY_KEY_MAX_LENGTH, TRANSFER_REJECTIONS)
+from .pagination import IdCursorPagination, encode_statement_cursor, decode_statement_cursor
+from .serializers import (PaymentRowSerializer, AccountRowSerializer, NewTransactionSerializer, TransactionSerializer,
+                          NewTransactionBatchSerializer, QueuedTransferSerializer, AccountSummarySerializer,
+                          StatementLineSerializer, format_amount)
 
-__all__ = ('PaymentsViewSet', 'AccountsViewSet', 'CreateTransactionView')
+__all__ = ('PaymentsViewSet', 'AccountsViewSet', 'CreateTransactionView', 'CreateTransactionBatchView',
+           'QueuedTransferView', 'metrics', 'create_transaction_async', 'account_async', 'payments_async')
+
+
+# query parameters of `PaymentFilter` narrowing the payments down to those of an account
+PAYMENT_ACCOUNT_FILTERS = ('account', 'from_account', 'to_account')
+
+
+def _conditional(request, validators: tuple, render: Callable[[], HttpResponse]) -> HttpResponse:
+    """
+    `304 Not Modified` if the client sent the current ETag (made of the `validators`), without calling `render`.
+    The response of `render` with the ETag otherwise. There is no `Last-Modified`: its whole seconds can't tell
+    apart the states of an account within a second, so `If-Modified-Since` would get stale 304s.
+    """
+    etag = quote_etag(hashlib.md5(repr((request.accepted_renderer.format,) + validators).encode()).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+    response['ETag'] = etag
+    # cached by the client, but revalidated on every use
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 class PaymentsViewSet(viewsets.ReadOnlyModelViewSet):
-    serializer_class = PaymentSerializer
-    queryset = Payment.objects.all()
-    filter_class = PaymentFilter
+    serializer_class = PaymentRowSerializer
+    queryset = Payment.objects.values(*PaymentRowSerializer.VALUES)
+    filter_backends = (DjangoFilterBackend,)
+    pagination_class = IdCursorPagination
+
+    # `SINGLE_ROW_PAYMENTS` derives the payments from the transactions
+    @property
+    def filterset_class(self):
+        return DerivedPaymentFilter if settings.SINGLE_ROW_PAYMENTS else PaymentFilter
+
+    def get_queryset(self):
+        if settings.SINGLE_ROW_PAYMENTS:
+            return DerivedPayment.objects.values(*PaymentRowSerializer.VALUES)
+        return super().get_queryset()
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('output', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=list(EXPORT_FORMATS),
+                          default='ndjson', description='Export format'),
+    ], responses={200: 'Stream of matching payments ordered by id'})
+    @action(detail=False, methods=['get'], pagination_class=None)
+    def export(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            return Response(data={'error': f'unknown output format {output}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        content_type, lines = EXPORT_FORMATS[output]
+        rows = payment_rows(self.filter_queryset(self.get_queryset()), settings.EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(lines(rows), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="payments.{output}"'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        # a list of the payments of some accounts only changes along with the versions of their summaries
+        account_ids = {request.query_params[name] for name in PAYMENT_ACCOUNT_FILTERS if request.query_params.get(name)}
+        if not account_ids:
+            return super().list(request, *args, **kwargs)
+        versions = AccountSummary.versions(account_ids)
+        validators = (settings.SINGLE_ROW_PAYMENTS, sorted(request.query_params.lists()), sorted(versions.items()))
+        return _conditional(request, validators, lambda: super(PaymentsViewSet, self).list(request, *args, **kwargs))
 
 
 class AccountsViewSet(viewsets.ReadOnlyModelViewSet):
-    serializer_class = AccountSerializer
-    queryset = Account.objects.all()
+    serializer_class = AccountRowSerializer
+    queryset = Account.objects.with_current_balance().values(*AccountRowSerializer.VALUES)
+    pagination_class = IdCursorPagination
+
+    def retrieve(self, request, *args, **kwargs):
+        row = Account.get_current_balance_row(kwargs['pk'])
+        if row is None:
+            raise Http404
+        # rows cached before summaries had versions lack them
+        validators = (row['id'], row['current_balance'], row['currency_id'], row.get('version'), row.get('modified_at'))
+        return _conditional(request, validators, lambda: Response(self.get_serializer(row).data))
+
+    @swagger_auto_schema(responses={200: AccountSummarySerializer()})
+    @action(detail=True, methods=['get'])
+    def summary(self, request, *args, **kwargs):
+        summary = AccountSummary.current(kwargs['pk'])
+        if summary is None:
+            if not Account.objects.filter(id=kwargs['pk']).exists():
+                raise Http404
+            # no payments yet
+            summary = AccountSummary(account_id=kwargs['pk'])
+        return Response(AccountSummarySerializer(summary).data)
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('created_after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                          format=openapi.FORMAT_DATETIME),
+        openapi.Parameter('created_before', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                          format=openapi.FORMAT_DATETIME),
+        openapi.Parameter('id_after', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+        openapi.Parameter('id_before', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+        openapi.Parameter('page_size', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+        openapi.Parameter('cursor', openapi.IN_QUERY, type=openapi.TYPE_STRING, description='`next` of a page'),
+    ], responses={200: 'Payments of the account ordered by id with the balance after each of them, '
+                       'the balances before and after the page'})
+    @action(detail=True, methods=['get'], pagination_class=None)
+    def statement(self, request, *args, **kwargs):
+        filterset = StatementFilter(request.query_params, queryset=Account.statement_lines(kwargs['pk']))
+        if not filterset.is_valid():
+            return Response(data=filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page_size = min(int(request.query_params.get('page_size') or settings.API_PAGE_SIZE),
+                            settings.API_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response(data={'error': 'wrong page size'}, status=status.HTTP_400_BAD_REQUEST)
+
+        lines, opening = filterset.qs, None
+        # a cursor only continues the statement it was made for
+        filters = {name: str(value) for name, value in filterset.form.cleaned_data.items() if value not in (None, '')}
+        if request.query_params.get('cursor'):
+            try:
+                last_id, opening = decode_statement_cursor(request.query_params['cursor'], kwargs['pk'], filters)
+            except signing.BadSignature:
+                return Response(data={'error': 'wrong cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            # the running total of the page starts after the cursor, the balance carried by it is added
+            lines = lines.filter(id__gt=last_id)
+
+        rows = list(lines.values(*StatementLineSerializer.VALUES)[:page_size + 1])
+        has_next, rows = len(rows) > page_size, rows[:page_size]
+        if opening is None:
+            opening = Account.balance_before(kwargs['pk'], rows[0]['id'] if rows else None)
+            if opening is None:
+                raise Http404
+        for row in rows:
+            row['balance'] = opening + row['running_total']
+        closing = rows[-1]['balance'] if rows else opening
+
+        next_url = None
+        if has_next:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor',
+                                           encode_statement_cursor(kwargs['pk'], filters, rows[-1]['id'], closing))
+        return Response({
+            'account': kwargs['pk'],
+            'opening_balance': format_amount(opening),
+            'closing_balance': format_amount(closing),
+            'next': next_url,
+            'results': StatementLineSerializer(rows, many=True).data,
+        })
 
 
 class CreateTransactionView(CreateAPIView):
     serializer_class = NewTransactionSerializer
     model = Transaction
 
-    @swagger_auto_schema(responses={
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('Idempotency-Key', openapi.IN_HEADER, type=openapi.TYPE_STRING, required=False,
+                          description='Retries with the same key get the originally created transaction'),
+    ], responses={
         201: TransactionSerializer(),
+        202: openapi.Response('Queued, in `TRANSFER_QUEUE_MODE`. Poll `Location` for the outcome',
+                              QueuedTransferSerializer()),
         400: openapi.Schema(
             type=openapi.TYPE_OBJECT, properties={
                 "error": openapi.Schema(type=openapi.TYPE_STRING, description="Error description"),
             }
         ),
+        422: openapi.Schema(
+            type=openapi.TYPE_OBJECT, properties={
+                "error": openapi.Schema(type=openapi.TYPE_STRING, description="Idempotency key reuse description"),
+            }
+        ),
     })
     def post(self, request, *args, **kwargs) -> Response:
         data = request.data
@@ -45,21 +209,200 @@ class CreateTransactionView(CreateAPIView):
         if not serializer.is_valid(raise_exception=False):
             return Response(data={'error': 'provided data is not valid'}, status=status.HTTP_400_BAD_REQUEST)
 
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return Response(data={'error': 'wrong idempotency key'}, status=status.HTTP_400_BAD_REQUEST)
+
         data = serializer.data
         try:
             amount = Decimal(data['amount'])
         except ValueError:
             return Response(data={'error': 'wrong amount'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if settings.TRANSFER_QUEUE_MODE:
+            return self.enqueue(data, amount, idempotency_key)
+
         try:
             created = self.model.create_new(
                 from_account_id=data['from_account'],
                 to_account_id=data['to_account'],
                 amount=amount,
                 currency_code=data['currency'],
+                idempotency_key=idempotency_key,
             )
-        except (AccountNotFoundException, DifferentCurrenciesException,
-                InsufficientFundsException, ErrorProcessingException) as e:
+        except TRANSFER_REJECTIONS + (ErrorProcessingException,) as e:
             return Response(data={'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except IdempotencyKeyReusedException as e:
+            return Response(data={'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
         return Response(data=TransactionSerializer(instance=created).data, status=status.HTTP_201_CREATED)
+
+    def enqueue(self, data: dict, amount: Decimal, idempotency_key: Optional[str]) -> Response:
+        try:
+            queued = QueuedTransfer.enqueue(
+                from_account_id=data['from_account'],
+                to_account_id=data['to_account'],
+                amount=amount,
+                currency_code=data['currency'],
+                idempotency_key=idempotency_key,
+            )
+        except IdempotencyKeyReusedException as e:
+            return Response(data={'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        return Response(data=QueuedTransferSerializer(instance=queued).data, status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': reverse('transfer-queued', args=[queued.id])})
+
+
+class QueuedTransferView(RetrieveAPIView):
+    """ Outcome of a transfer accepted in queue mode """
+    serializer_class = QueuedTransferSerializer
+    queryset = QueuedTransfer.objects.select_related('transaction')
+
+
+class CreateTransactionBatchView(CreateAPIView):
+    serializer_class = NewTransactionBatchSerializer
+    model = Transaction
+
+    @swagger_auto_schema(responses={
+        200: openapi.Schema(
+            type=openapi.TYPE_OBJECT, properties={
+                "results": openapi.Schema(
+                    type=openapi.TYPE_ARRAY, description="Per transfer results in request order",
+                    items=openapi.Schema(type=openapi.TYPE_OBJECT, properties={
+                        "state": openapi.Schema(type=openapi.TYPE_STRING, enum=[Transaction.STATE_SUCCEED,
+                                                                                 Transaction.STATE_FAILED]),
+                        "transaction": openapi.Schema(type=openapi.TYPE_OBJECT, description="Created transaction"),
+                        "error": openapi.Schema(type=openapi.TYPE_STRING, description="Error description"),
+                    }),
+                ),
+            }
+        ),
+        400: openapi.Schema(
+            type=openapi.TYPE_OBJECT, properties={
+                "error": openapi.Schema(type=openapi.TYPE_STRING, description="Error description"),
+            }
+        ),
+    })
+    def post(self, request, *args, **kwargs) -> Response:
+        serializer = self.serializer_class(data=request.data)
+
+        if not serializer.is_valid(raise_exception=False):
+            return Response(data={'error': 'provided data is not valid'}, status=status.HTTP_400_BAD_REQUEST)
+
+        transfers = [
+            Transfer(
+                from_account_id=item['from_account'],
+                to_account_id=item['to_account'],
+                amount=item['amount'],
+                currency_code=item['currency'],
+            )
+            for item in serializer.validated_data['transfers']
+        ]
+
+        try:
+            outcomes = self.model.create_batch(transfers)
+        except ErrorProcessingException as e:
+            return Response(data={'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        for outcome in outcomes:
+            if outcome.error is not None:
+                results.append({'state': Transaction.STATE_FAILED, 'error': str(outcome.error)})
+            else:
+                results.append({'state': Transaction.STATE_SUCCEED,
+                                'transaction': TransactionSerializer(instance=outcome.transaction).data})
+
+        return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+def metrics(request) -> HttpResponse:
+    """ Request and transfer metrics of this process for Prometheus """
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4')
+
+
+# Asyncio variants of the endpoints, they don't hold a thread per request when served by ASGI. DRF views are sync
+# only, so these are plain Django views with the same inputs and representations as the DRF ones.
+
+async def create_transaction_async(request) -> JsonResponse:
+    """ `CreateTransactionView` on top of `Transaction.create_new_async` """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+    except ValueError:
+        return JsonResponse({'error': 'provided data is not valid'}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = NewTransactionSerializer(data=data)
+    # the currency set may have to be (re)loaded from the database
+    if not await asyncdb.in_worker_thread(serializer.is_valid)(raise_exception=False):
+        return JsonResponse({'error': 'provided data is not valid'}, status=status.HTTP_400_BAD_REQUEST)
+
+    idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return JsonResponse({'error': 'wrong idempotency key'}, status=status.HTTP_400_BAD_REQUEST)
+
+    data = serializer.validated_data
+    try:
+        created = await Transaction.create_new_async(
+            from_account_id=data['from_account'],
+            to_account_id=data['to_account'],
+            amount=data['amount'],
+            currency_code=data['currency'],
+            idempotency_key=idempotency_key,
+        )
+    except TRANSFER_REJECTIONS + (ErrorProcessingException,) as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except IdempotencyKeyReusedException as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    return JsonResponse(TransactionSerializer(instance=created).data, status=status.HTTP_201_CREATED)
+
+
+# no session auth here, same as in the DRF views (`csrf_exempt` would wrap the coroutine into a sync view)
+create_transaction_async.csrf_exempt = True
+
+
+async def account_async(request, pk: str) -> JsonResponse:
+    """ `AccountsViewSet.retrieve` on top of `Account.get_current_balance_row_async` """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    row = await Account.get_current_balance_row_async(pk)
+    if row is None:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse(AccountRowSerializer(row).data)
+
+
+def _payments_page(params: QueryDict) -> dict:
+    view = PaymentsViewSet()
+    filterset = view.filterset_class(params, queryset=view.get_queryset().order_by('id'))
+    if not filterset.is_valid():
+        return {'errors': filterset.errors}
+
+    queryset = filterset.qs
+    if params.get('after'):
+        queryset = queryset.filter(id__gt=params['after'])
+    page_size = min(int(params.get('page_size') or settings.API_PAGE_SIZE), settings.API_MAX_PAGE_SIZE)
+    rows = list(queryset[:page_size])
+    return {
+        'after': rows[-1]['id'] if len(rows) == page_size else None,
+        'results': PaymentRowSerializer(rows, many=True).data,
+    }
+
+
+async def payments_async(request) -> JsonResponse:
+    """
+    `PaymentsViewSet.list` with the same filters, paged by `?after=<id of the last payment of the previous page>`.
+    Reads don't wait for row locks, so they run on the ORM in a worker thread.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        page = await asyncdb.in_worker_thread(_payments_page)(request.GET)
+    except ValueError:
+        return JsonResponse({'error': 'wrong page parameters'}, status=status.HTTP_400_BAD_REQUEST)
+    if 'errors' in page:
+        return JsonResponse(page['errors'], status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse(page)
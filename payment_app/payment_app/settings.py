@@ -24,10 +24,19 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'drf_yasg',
-    'core',
+    'core.apps.CoreConfig',
 ]
 
+# `ACCOUNT_SHARED_CACHE` may name one of these, e.g. a Redis one, to share the account cache between processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 MIDDLEWARE = [
+    # outermost, so it measures the whole request
+    'core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,12 +68,15 @@ WSGI_APPLICATION = 'payment_app.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        # persistent connections with health checks and prepared statements, see `core.backends.postgresql`
+        'ENGINE': 'core.backends.postgresql',
         'NAME': os.environ.get('DB_NAME'),
         'USER': os.environ.get('DB_USER'),
         'HOST': os.environ.get('DB_HOST'),
         'PASSWORD': os.environ.get('DB_PASSWORD'),
         'PORT': os.environ.get('DB_PORT'),
+        # seconds a connection is kept open for the next requests of its thread, 0 closes it after every request
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 0)),
     }
 }
 
@@ -89,3 +101,71 @@ USE_I18N = True
 USE_L10N = True
 USE_TZ = True
 STATIC_URL = '/static/'
+
+REST_FRAMEWORK = {
+    # JSON by default, orjson (`?format=orjson`) and msgpack (`Accept: application/msgpack`) on request
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'core.renderers.ORJSONRenderer',
+        'core.renderers.MsgPackRenderer',
+    ),
+    # skips the renderers whose encoder isn't installed
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'core.renderers.ContentNegotiation',
+}
+
+# default and max number of entries per page of the list endpoints
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+
+# send per request timings back in the `Server-Timing` header
+SERVER_TIMING_HEADER = int(os.environ.get('SERVER_TIMING_HEADER', 1))
+
+# number of rows fetched per round trip by the streaming payments export
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 2000))
+
+# max number of transfers accepted by a single `transfer/batch/` request
+TRANSFER_BATCH_MAX_SIZE = int(os.environ.get('TRANSFER_BATCH_MAX_SIZE', 10000))
+
+# number of recently used transfer idempotency keys each process remembers
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# append-only ledger mode: credits are written as pending transactions only and folded into the balances
+# by `manage.py compact_ledger`, so hot receiving accounts are never locked by transfers
+LEDGER_MODE = int(os.environ.get('LEDGER_MODE', 0))
+
+# how many times a transfer is retried after a deadlock or serialization failure
+TRANSFER_LOCK_RETRIES = int(os.environ.get('TRANSFER_LOCK_RETRIES', 3))
+# base of the exponential backoff between those retries, in seconds
+TRANSFER_LOCK_RETRY_BACKOFF = float(os.environ.get('TRANSFER_LOCK_RETRY_BACKOFF', 0.01))
+
+# connections of the asyncpg pool behind the `api/v1/async/` endpoints, per process
+ASYNC_DB_POOL_MIN_SIZE = int(os.environ.get('ASYNC_DB_POOL_MIN_SIZE', 2))
+ASYNC_DB_POOL_MAX_SIZE = int(os.environ.get('ASYNC_DB_POOL_MAX_SIZE', 20))
+
+# check a kept connection with a `SELECT 1` before its first use in a request
+DB_CONN_HEALTH_CHECKS = int(os.environ.get('DB_CONN_HEALTH_CHECKS', 1))
+# statements run that many times on a connection become server-side prepared statements, 0 disables them
+DB_PREPARE_THRESHOLD = int(os.environ.get('DB_PREPARE_THRESHOLD', 5))
+# max number of prepared statements per connection
+DB_PREPARED_STATEMENTS_MAX = int(os.environ.get('DB_PREPARED_STATEMENTS_MAX', 100))
+
+# accounts each process keeps in its cache of currencies and balances
+ACCOUNT_CACHE_SIZE = int(os.environ.get('ACCOUNT_CACHE_SIZE', 10000))
+# seconds a cached balance is served at most, it is dropped earlier once a transfer of the account commits
+ACCOUNT_BALANCE_CACHE_TTL = float(os.environ.get('ACCOUNT_BALANCE_CACHE_TTL', 5))
+# seconds a cached account currency is used at most, changes made by the process itself apply once committed
+ACCOUNT_CURRENCY_CACHE_TTL = float(os.environ.get('ACCOUNT_CURRENCY_CACHE_TTL', 60))
+# alias of the `CACHES` entry used as the shared tier of the account cache, empty for the process tier only
+ACCOUNT_SHARED_CACHE = os.environ.get('ACCOUNT_SHARED_CACHE', '')
+
+# seconds after which each process reloads its set of currency codes, changes made by itself apply at once
+CURRENCY_CACHE_TTL = float(os.environ.get('CURRENCY_CACHE_TTL', 60))
+
+# queue mode: `transfer/create/` only queues transfers and answers 202, `manage.py process_transfer_queue`
+# workers make them in batches
+TRANSFER_QUEUE_MODE = int(os.environ.get('TRANSFER_QUEUE_MODE', 0))
+
+# single-row storage: transfers write no `Payment` rows, payments are read from the `DerivedPayment` view over
+# the transactions. Switch with `manage.py payment_storage`
+SINGLE_ROW_PAYMENTS = int(os.environ.get('SINGLE_ROW_PAYMENTS', 0))
@@ -21,11 +21,21 @@ router.register(r'payments', core_views.PaymentsViewSet)
 router.register(r'accounts', core_views.AccountsViewSet)
 
 endpoints = [
-                path('transfer/create/', core_views.CreateTransactionView.as_view())
+                path('transfer/create/', core_views.CreateTransactionView.as_view(), name='transfer-create'),
+                path('transfer/batch/', core_views.CreateTransactionBatchView.as_view(), name='transfer-batch'),
+                path('transfer/queued/<int:pk>/', core_views.QueuedTransferView.as_view(), name='transfer-queued'),
             ] + router.urls
 
+async_endpoints = [
+    path('transfer/create/', core_views.create_transaction_async, name='async-transfer-create'),
+    path('accounts/<str:pk>/', core_views.account_async, name='async-account-detail'),
+    path('payments/', core_views.payments_async, name='async-payment-list'),
+]
+
 urlpatterns = [
+    url(r'^api/v1/async/', include(async_endpoints)),
     url(r'^api/v1/', include(endpoints)),
+    path('metrics', core_views.metrics, name='metrics'),
     url(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     url(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),